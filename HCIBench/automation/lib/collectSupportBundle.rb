@@ -22,6 +22,8 @@ end
 @vm_support_manifest_template = "/opt/automation/lib/vsan-perfsvc-stats-hcibench.mfx.template"
 @vm_support_manifest_script = "/opt/automation/lib/vsan-perfsvc-stats-hcibench.mfx"
 @vsan_perfsvc_status_script = "/opt/automation/lib/perf-svc-vsan1/vsan-perfsvc-status.py"
+# modules imported by some versions of the script, uploaded next to it
+@vsan_perfsvc_status_modules = ["perfStatsCollector.py", "soapStreamer.py"]
 @collect_support_bundle_log = "#{$log_path}/supportBundleCollect.log"
 @failure = false
 
@@ -32,7 +34,7 @@ end_time = ARGV[2] || File.mtime("#{ARGV[0]}-res.txt").to_i
 @update_end_time = "sed -i 's/END_TIME/#{end_time}/g' #{@vm_support_manifest_script}"
 
 @cmd_delete_manifest = "rm -f /etc/vmware/vm-support/vsan-perfsvc-stats-hcibench.mfx"
-@cmd_delete_vsan_perfsvc_status_script = "rm -f /tmp/vsan-perfsvc-status.py"
+@cmd_delete_vsan_perfsvc_status_script = "rm -f /tmp/vsan-perfsvc-status.py #{@vsan_perfsvc_status_modules.map { |m| "/tmp/#{m}" }.join(' ')}"
 @determine_vsphere_version = "vmware -v | awk '{print $3}' | cut -d '.' -f1"
 @determins_vsan_sub_version = "python -c 'import vsanPerfPyMo, VsanHealthUtil; print(\"2\" if (\"IsVsanMaxEnabledInHost\" in dir(VsanHealthUtil)) else \"2U3\")'"
 
@@ -64,6 +66,15 @@ def run_cmd(host)
       @failure = true
       return
     end
+    @vsan_perfsvc_status_modules.each do |module_name|
+      module_file = "#{File.dirname(@vsan_perfsvc_status_script)}/#{module_name}"
+      next if not File.exist?(module_file)
+      if not scp_item(host,host_username,host_password, module_file,"/tmp")
+        puts "Unable to upload #{module_file} to #{host}:/tmp"
+        @failure = true
+        return
+      end
+    end
 
     puts "Downloading bundle from #{host}...", @collect_support_bundle_log
     `wget --output-document "#{@dest_folder}/#{host}-vm-support-bundle.tgz" --no-check-certificate --user '#{host_username}' --password '#{host_password}' https://#{host}/cgi-bin/vm-support.cgi?manifests=Storage:VSANMinimal%20Storage:VSANPerfHcibench`
@@ -4,6 +4,7 @@ require_relative "rvc-util.rb"
 
 @dest_folder = ARGV[0]
 @post_process = ARGV[1]
+@duration = ARGV[2].to_i
 
 @hosts_list = []
 @vsan_clusters = _get_all_vsan_clusters
@@ -19,6 +20,13 @@ end
 @collect_vmkstats_script = "/opt/automation/lib/vmkstats/vmkstats.py"
 @collect_vmkstats_log = "#{$log_path}/vmkstatsCollect.log"
 @failure = false
+@collect_vmkstats_opts = "-c default"
+if $vmkstats_slice.to_i > 0
+  # vmkstats_postprocess.py writes the timelines and the reports of every slice
+  @collect_vmkstats_opts += " --slice #{$vmkstats_slice} --max-slices #{$vmkstats_max_slices.to_i}"
+  # the slices cover the whole test, warm-up included
+  @collect_vmkstats_opts += " -d #{@duration}" if @duration > 0
+end
 
 def run_cmd(host)
   parent_folder = "/vmfs/volumes/hcibench-volume/#{host}"
@@ -30,7 +38,7 @@ def run_cmd(host)
     puts "Uploading collection script to #{host}",@collect_vmkstats_log
     scp_item(host,host_username,host_password, @collect_vmkstats_script, parent_folder)
     puts "Start collecting vmkstats on #{host}", @collect_vmkstats_log
-    puts ssh_cmd_with_return(host,host_username,host_password,"python #{parent_folder}/vmkstats.py -c default -o #{parent_folder} > #{parent_folder}/vmkstatsCollect.log 2>&1"), @collect_vmkstats_log
+    puts ssh_cmd_with_return(host,host_username,host_password,"python #{parent_folder}/vmkstats.py #{@collect_vmkstats_opts} -o #{parent_folder} > #{parent_folder}/vmkstatsCollect.log 2>&1"), @collect_vmkstats_log
   else
     puts "Unable to SSH to #{host}",@collect_vmkstats_log
     @failure = true
@@ -43,7 +51,7 @@ def post_process(host)
   host_password = $hosts_credential[host_key]["host_password"]
   `sed -i '/#{host} /d' /root/.ssh/known_hosts`
   if ssh_valid(host, host_username, host_password)
-    `python3 /opt/automation/lib/vmkstats/vmkstats_postprocess.py --jar /opt/automation/lib/vmkstats/vmcallstackview.jar --flamegraph -o #{@dest_folder}/#{host}/hcibench_vmkstats_dumpDir --scriptdir /opt/automation/lib/vmkstats/`
+    `python3 /opt/automation/lib/vmkstats/vmkstats_postprocess.py --flamegraph -o #{@dest_folder}/#{host}/hcibench_vmkstats_dumpDir`
     #ssh_cmd(host,host_username,host_password,@clear_vmkstats)
   else
     puts "Unable to SSH to #{host}",@collect_vmkstats_log
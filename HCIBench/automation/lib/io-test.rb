@@ -49,7 +49,40 @@ if $testing_duration and $testing_duration.is_a?(Integer)
   duration_var = "--short-duration #{$testing_duration}"
 end
 
-def collectVmkStats(res_path,sleep_time)
+# Secs the workload of the param file runs for, warm-up included
+def getTestDuration(file_path)
+  duration = 0
+  warmup = 0
+  File.readlines(file_path).each do |line|
+    next if line.start_with?("*", "#")
+    # vdbench puts the pairs of a line after commas, fio one pair per line
+    line.strip.split(",").each do |pair|
+      k, v = pair.split("=", 2)
+      next if v.nil?
+      case k
+      when "elapsed", "runtime"
+        duration = v.to_i
+      when "warmup", "ramp_time"
+        warmup = v.to_i
+      end
+    end
+  end
+  duration = $testing_duration if $testing_duration and $testing_duration.is_a?(Integer)
+  return duration + warmup
+end
+
+# Sliced vmkstats are collected from the start of the test till its end,
+# the others for a while after @sleep_time secs of testing
+def startVmkStats(res_path, file_paths)
+  if $vmkstats_slice.to_i > 0
+    duration = file_paths.map{|file_path| getTestDuration(file_path)}.max
+    Thread.start { collectVmkStats(res_path, 0, duration) }
+  else
+    Thread.start { collectVmkStats(res_path, @sleep_time, 0) }
+  end
+end
+
+def collectVmkStats(res_path,sleep_time,duration)
   sleep(sleep_time)
   puts "Create NFS Share on HCIBench, the path is #{$nfs_export_base}/#{$share_folder_name}",@log_file
   _create_shared_folder($nfs_export_base,$share_folder_name)
@@ -58,7 +91,7 @@ def collectVmkStats(res_path,sleep_time)
   puts "Mount Shared Folder to Hosts...",@log_file
   `ruby /opt/automation/lib/prep-host-vsan-debug.rb #{$nfs_export_base}/#{$share_folder_name} false`
 
-  `ruby /opt/automation/lib/collectVmkstats.rb #{res_path} "false"`
+  `ruby /opt/automation/lib/collectVmkstats.rb #{res_path} "false" #{duration}`
   @vmk_collected = true
   puts "Unmount Shared Folder from Hosts...",@log_file
   `ruby /opt/automation/lib/prep-host-vsan-debug.rb #{$nfs_export_base}/#{$share_folder_name} true`
@@ -116,7 +149,8 @@ if !$vm_groups.empty?
   if @debug_mode
     _create_shared_folder($output_path_dir + "/mixed-#{time}",$share_folder_name)
     @vmk_collected = false
-    Thread.start { collectVmkStats("#{$output_path_dir}/mixed-#{time}",@sleep_time)}
+    startVmkStats("#{$output_path_dir}/mixed-#{time}",
+                  $vm_groups.map{|grp| "#{$self_defined_param_file_path}/#{grp["param_file"]}"})
   end
 
   puts "Started Testing VM Groups (#{$vm_groups.size} groups in parallel)", @status_log_file
@@ -235,11 +269,11 @@ for item in Dir.entries($self_defined_param_file_path).sort
 
   #Thread.start {snapshot(600,10,60,600)}
 
-  #after testing running for sleep_time seconds, collect vmkstats, for vSAN engrs only.
+  #after testing running for sleep_time seconds, or from the start if sliced, collect vmkstats, for vSAN engrs only.
   if @debug_mode 
     _create_shared_folder($output_path_dir + "/#{item}-#{time}",$share_folder_name)
     @vmk_collected = false
-    Thread.start { collectVmkStats("#{$output_path_dir}/#{item}-#{time}",@sleep_time)}
+    startVmkStats("#{$output_path_dir}/#{item}-#{time}",[file_path])
   end
   cluster_path_arr = ""
   $observer_target_clusters_arr.each do |target_cluster|
@@ -0,0 +1,110 @@
+# **********************************************************
+# Copyright 2022 VMware, Inc.  All rights reserved. -- VMware Confidential
+# **********************************************************
+"""
+Cached snapshot of the pyVmomi type registry
+
+Replaying the typeinfo index (see TypeInfoIndex.py) at startup means
+importing the large _typeinfoindex module and declaring every version again.
+After the first replay, the resulting version registry and the index tables
+are saved with marshal next to the byte-compiled modules, and later
+interpreters restore them with a single read.
+
+The snapshot records the sizes and mtimes of the sources it was built from
+and is ignored, then rewritten, when any of them changed. Snapshots are
+specific to the interpreter (marshal is not portable across Python
+versions), so one is kept per cache tag. The first import of pyVmomi
+writes it, so it can be prebuilt along with the byte-compiled modules,
+e.g. when packaging, with:
+
+    python -c "import pyVmomi"
+"""
+
+import marshal
+import os
+import sys
+
+from . import VmomiSupport
+
+SNAPSHOT_VERSION = 1
+
+_pyVmomiDir = os.path.dirname(os.path.abspath(__file__))
+
+
+def _GetCacheTag():
+    implementation = getattr(sys, 'implementation', None)
+    cacheTag = getattr(implementation, 'cache_tag', None)
+    if cacheTag is None:
+        cacheTag = 'cpython-%d%d' % sys.version_info[:2]
+    return cacheTag
+
+
+def GetSnapshotPath():
+    """ Path of the snapshot for the running interpreter """
+    return os.path.join(_pyVmomiDir, '__pycache__',
+                        'typeinforegistry.%s.snapshot' % _GetCacheTag())
+
+
+def GetSources(typeinfos):
+    """ Sizes and mtimes of the modules the registry is built from """
+    sources = []
+    names = ['_typeinfo_%s.py' % typeinfo for typeinfo in typeinfos]
+    names.extend(('_typeinfoindex.py', 'VmomiSupport.py'))
+    for name in names:
+        try:
+            st = os.stat(os.path.join(_pyVmomiDir, name))
+            sources.append((name, st.st_size, int(st.st_mtime)))
+        except OSError:
+            sources.append((name, None, None))
+    return tuple(sources)
+
+
+def Load(sources, importer):
+    """
+    Restore the registry from the snapshot
+
+    @param sources result of GetSources
+    @param importer function importing a typeinfo module by name
+    @return True if the snapshot was up to date and restored
+    """
+    try:
+        with open(GetSnapshotPath(), 'rb') as f:
+            header, snapshot = marshal.loads(f.read())
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return False
+    if header != (SNAPSHOT_VERSION, sources):
+        return False
+    VmomiSupport.RestoreRegistry(snapshot, importer)
+    return True
+
+
+def Save(sources):
+    """
+    Save the registry left by VmomiSupport.SetTypeInfoIndex
+
+    Failures, e.g. a read-only installation, are ignored.
+
+    @param sources result of GetSources
+    @return the path of the snapshot, or None if it was not written
+    """
+    data = marshal.dumps(((SNAPSHOT_VERSION, sources),
+                          VmomiSupport.SnapshotRegistry()))
+    path = GetSnapshotPath()
+    # Write a private file first, concurrent interpreters may race here
+    tmpPath = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(tmpPath, 'wb') as f:
+            f.write(data)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmpPath, path)
+    except (IOError, OSError):
+        try:
+            os.remove(tmpPath)
+        except OSError:
+            pass
+        return None
+    return path
+
@@ -4,11 +4,13 @@
 # **********************************************************
 
 import base64
+import collections
 import contextlib
 import copy
 import os
 import platform
 import re
+import select
 import ssl
 import socket
 import subprocess
@@ -606,6 +608,8 @@ def Deserialize(data, resultType=object, stub=None):
     # Adding unicode input support to make it more test friendly.
     if isinstance(data, six.binary_type) or isinstance(data, six.text_type):
         parser.Parse(data)
+    elif isinstance(data, GzipReader):
+        data.Parse(parser)
     else:
         parser.ParseFile(data)
     return ds.GetResult()
@@ -932,6 +936,8 @@ class SoapResponseDeserializer(ExpatDeserializerNSHandlers):
         if isinstance(response, six.binary_type) or isinstance(
                 response, six.text_type):
             self.parser.Parse(response)
+        elif isinstance(response, GzipReader):
+            response.Parse(self.parser)
         else:
             self.parser.ParseFile(response)
         result = self.deser.GetResult()
@@ -1236,18 +1242,28 @@ class SSLTunnelConnection(object):
         return retval
 
 
+# Decompressing reader for gzip/deflate encoded responses
+#
+# The compressed stream is read in chunks that start at readChunkSize and
+# double on every read up to maxReadChunkSize, so small responses are not
+# over-read and large ones are read in few calls. Parse() feeds the inflated
+# data straight to an expat parser. read() serves file-like readers from a
+# reusable buffer.
 class GzipReader:
     GZIP = 1
     DEFLATE = 2
 
-    def __init__(self, rfile, encoding=GZIP, readChunkSize=512):
+    def __init__(self, rfile, encoding=GZIP, readChunkSize=16384,
+                 maxReadChunkSize=262144):
         self.rfile = rfile
-        self.chunks = []
-        self.bufSize = 0  # Remaining buffer
+        self.buf = bytearray()
+        self.pos = 0  # Start of the unread data in buf
         assert (encoding in (GzipReader.GZIP, GzipReader.DEFLATE))
         self.encoding = encoding
         self.unzip = None
         self.readChunkSize = readChunkSize
+        self.maxReadChunkSize = max(readChunkSize, maxReadChunkSize)
+        self.eof = False
 
     def _CreateUnzip(self, firstChunk):
         import zlib
@@ -1255,15 +1271,15 @@ class GzipReader:
             wbits = zlib.MAX_WBITS + 16
         elif self.encoding == GzipReader.DEFLATE:
             # Sniff out real deflate format
-            chunkLen = len(firstChunk)
+            head = bytearray(firstChunk[:3])
             # Assume raw deflate
             wbits = -zlib.MAX_WBITS
-            if firstChunk[:3] == ['\x1f', '\x8b', '\x08']:
+            if head == bytearray(b'\x1f\x8b\x08'):
                 # gzip: Apache mod_deflate will send gzip. Yurk!
                 wbits = zlib.MAX_WBITS + 16
-            elif chunkLen >= 2:
-                b0 = ord(firstChunk[0])
-                b1 = ord(firstChunk[1])
+            elif len(head) >= 2:
+                b0 = head[0]
+                b1 = head[1]
                 if (b0 & 0xf) == 8 and (((b0 * 256 + b1)) % 31) == 0:
                     # zlib deflate
                     wbits = min(((b0 & 0xf0) >> 4) + 8, zlib.MAX_WBITS)
@@ -1272,40 +1288,219 @@ class GzipReader:
         self.unzip = zlib.decompressobj(wbits)
         return self.unzip
 
-    def read(self, bytes=-1):
-        chunks = self.chunks
-        bufSize = self.bufSize
+    # Read and inflate the next chunk of the stream
+    #
+    # @return the inflated data, which may be empty before the end of the
+    #   stream, or None at the end of the stream
+    def _Inflate(self):
+        if self.eof:
+            return None
+        chunk = self.rfile.read(self.readChunkSize)
+        if self.readChunkSize < self.maxReadChunkSize:
+            self.readChunkSize = min(self.readChunkSize * 2,
+                                     self.maxReadChunkSize)
+        if self.unzip is None:
+            self._CreateUnzip(chunk)
+        if chunk:
+            return self.unzip.decompress(chunk)
+        self.eof = True
+        return self.unzip.flush()
+
+    # Feed the whole inflated stream to an expat parser
+    #
+    # @param parser an expat parser
+    def Parse(self, parser):
+        if self.pos < len(self.buf):
+            parser.Parse(memoryview(self.buf)[self.pos:].tobytes(), False)
+        self.buf = bytearray()
+        self.pos = 0
+        while True:
+            data = self._Inflate()
+            if data is None:
+                break
+            if data:
+                parser.Parse(data, False)
+        parser.Parse(b"", True)
 
-        while bufSize < bytes or bytes == -1:
-            # Read and decompress
-            chunk = self.rfile.read(self.readChunkSize)
+    def read(self, bytes=-1):
+        buf = self.buf
+        while bytes < 0 or len(buf) - self.pos < bytes:
+            data = self._Inflate()
+            if data is None:
+                break
+            if self.pos and self.pos >= len(buf) // 2:
+                # Drop the consumed data once it is at least half the buffer
+                del buf[:self.pos]
+                self.pos = 0
+            buf += data
+
+        start = self.pos
+        if bytes < 0:
+            end = len(buf)
+        else:
+            end = min(len(buf), start + bytes)
+        self.pos = end
+        return memoryview(buf)[start:end].tobytes()
 
-            if self.unzip is None:
-                self._CreateUnzip(chunk)
 
-            if chunk:
-                inflatedChunk = self.unzip.decompress(chunk)
-                bufSize += len(inflatedChunk)
-                chunks.append(inflatedChunk)
+# Check whether an idle pooled connection can still be used
+#
+# A keep-alive connection that is readable while no request is outstanding
+# has either been closed by the server or has stray data on it. Neither can
+# be reused.
+def _IsConnectionAlive(conn):
+    sock = getattr(conn, 'sock', None)
+    if sock is None:
+        return False
+    try:
+        pending = getattr(sock, 'pending', None)
+        if pending and pending():
+            return False
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (ValueError, socket.error, select.error):
+        return False
+    return not readable
+
+
+# Thread-safe pool of HTTP connections to one host
+#
+# Idle connections are reused most recently returned first, so the warm ones
+# are kept busy and the rest age out after idleTimeout. Every checkout of an
+# idle connection is checked with _IsConnectionAlive. If maxConnections is
+# set, at most that many connections are handed out at once and further
+# callers wait in GetConnection until one is returned or retired.
+class _ConnectionPool(object):
+    # Constructor
+    #
+    # @param self self
+    # @param create called without arguments to create a new connection
+    # @param size max number of idle connections kept
+    # @param idleTimeout secs after which idle connections are closed. Use -1
+    #   to disable any timeout.
+    # @param maxConnections max number of connections handed out at once, or
+    #   None for no limit
+    def __init__(self, create, size, idleTimeout, maxConnections=None):
+        self.create = create
+        self.size = size
+        self.idleTimeout = idleTimeout
+        self.maxConnections = maxConnections
+        self.cond = threading.Condition(threading.Lock())
+        # (conn, lastAccessTime), most recently returned last
+        self.idle = collections.deque()
+        self.inUse = 0
+        self.hits = 0
+        self.misses = 0
+        self.creates = 0
+        self.retired = 0
+        self.waits = 0
+        self.waitTime = 0.0
+
+    # Remove idle timed-out connections from the pool
+    #  The pool lock must be acquired before this method is called.
+    # @return the removed connections
+    def _RemoveIdleConnections(self):
+        idleConnections = []
+        if self.idleTimeout >= 0:
+            oldest = time.time() - self.idleTimeout
+            while self.idle and self.idle[0][1] <= oldest:
+                idleConnections.append(self.idle.popleft()[0])
+        return idleConnections
+
+    # Get a connection, waiting for one if maxConnections are in use
+    def GetConnection(self):
+        deadConnections = []
+        result = None
+        with self.cond:
+            deadConnections.extend(self._RemoveIdleConnections())
+            startTime = None
+            while True:
+                while self.idle:
+                    conn, _ = self.idle.pop()
+                    if _IsConnectionAlive(conn):
+                        result = conn
+                        break
+                    deadConnections.append(conn)
+                    self.retired += 1
+                if result is not None or self.maxConnections is None \
+                        or self.inUse < self.maxConnections:
+                    break
+                if startTime is None:
+                    startTime = time.time()
+                    self.waits += 1
+                self.cond.wait()
+            if startTime is not None:
+                self.waitTime += time.time() - startTime
+            self.inUse += 1
+            if result is not None:
+                self.hits += 1
             else:
-                # Returns whatever we have
-                break
-
-        if bufSize <= bytes or bytes == -1:
-            leftoverBytes = 0
-            leftoverChunks = []
-        else:
-            leftoverBytes = bufSize - bytes
-            # Adjust last chunk to hold only the left over bytes
-            lastChunk = chunks.pop()
-            chunks.append(lastChunk[:-leftoverBytes])
-            leftoverChunks = [lastChunk[-leftoverBytes:]]
+                self.misses += 1
+        for conn in deadConnections:
+            conn.close()
+        if result is None:
+            try:
+                result = self.create()
+            except:  # noqa: E722
+                self._Release()
+                raise
+            with self.cond:
+                self.creates += 1
+        return result
 
-        self.chunks = leftoverChunks
-        self.bufSize = leftoverBytes
+    # Give a connection back to the pool
+    #
+    # @param conn the connection
+    # @param reuse False to close the connection instead of keeping it
+    def ReturnConnection(self, conn, reuse=True):
+        with self.cond:
+            idleConnections = self._RemoveIdleConnections()
+            if reuse and len(self.idle) < self.size:
+                self.idle.append((conn, time.time()))
+            else:
+                idleConnections.append(conn)
+                if not reuse:
+                    self.retired += 1
+            self.inUse -= 1
+            self.cond.notify()
+        for idleConn in idleConnections:
+            idleConn.close()
+
+    # Close a connection that failed and free its slot
+    def RetireConnection(self, conn):
+        self.ReturnConnection(conn, reuse=False)
+
+    # Free the slot of a connection that is not returned
+    def _Release(self):
+        with self.cond:
+            self.inUse -= 1
+            self.cond.notify()
+
+    # Close all idle connections
+    def DropConnections(self):
+        with self.cond:
+            oldConnections = [conn for conn, _ in self.idle]
+            self.idle.clear()
+        for conn in oldConnections:
+            conn.close()
 
-        buf = b"".join(chunks)
-        return buf
+    # Get the pool metrics
+    #
+    # @return a dict with the number of checkouts served by an idle
+    #   connection (hits) or not (misses), of connections created and
+    #   retired, of checkouts that had to wait and the total secs they
+    #   waited, and of connections currently idle and in use
+    def GetStats(self):
+        with self.cond:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'creates': self.creates,
+                'retired': self.retired,
+                'waits': self.waits,
+                'waitTime': self.waitTime,
+                'idle': len(self.idle),
+                'inUse': self.inUse,
+            }
 
 
 # SOAP stub adapter object
@@ -1322,6 +1517,9 @@ class SoapStubAdapter(SoapStubAdapterBase):
     # @param url URL (overrides host, port, path if set)
     # @param sock unix domain socket path (overrides host, port, url if set)
     # @param poolSize size of HTTP connection pool
+    # @param maxConnections max number of HTTP connections in use at once.
+    #   Further requests wait for a connection to be returned. None for no
+    #   limit.
     # @param certKeyFile **** Deprecated. Please load cert to context and pass
     #                       context instread ****
     #                       sslContext.load_cert_chain(key_file, cert_file)
@@ -1372,7 +1570,8 @@ class SoapStubAdapter(SoapStubAdapterBase):
                  samlToken=None,
                  sslContext=None,
                  httpConnectionTimeout=None,
-                 customHeaders=None):
+                 customHeaders=None,
+                 maxConnections=None):
         self._customHeaders = customHeaders
         if ns:
             assert (version is None)
@@ -1430,9 +1629,9 @@ class SoapStubAdapter(SoapStubAdapterBase):
             # Swap the actual host with the proxy.
             self.host = "%s:%d" % (httpProxyHost, httpProxyPort)
         self.poolSize = poolSize
-        self.pool = []
         self.connectionPoolTimeout = connectionPoolTimeout
-        self.lock = six.moves._thread.allocate_lock()
+        self.pool = _ConnectionPool(self._CreateConnection, poolSize,
+                                    connectionPoolTimeout, maxConnections)
         self.schemeArgs = {}
         if sslContext:
             self.schemeArgs['context'] = sslContext
@@ -1504,8 +1703,9 @@ class SoapStubAdapter(SoapStubAdapterBase):
             conn.request('POST', self.path, req, headers)
             resp = conn.getresponse()
         except (socket.error, six.moves.http_client.HTTPException):
-            # The server is probably sick, drop all of the cached connections.
-            self.DropConnections()
+            # Only this connection is known to be bad, the pooled ones are
+            # checked when they are taken out again.
+            self.pool.RetireConnection(conn)
             raise
         cookie = resp.getheader('set-cookie')
         status = resp.status
@@ -1525,9 +1725,7 @@ class SoapStubAdapter(SoapStubAdapterBase):
                     fd, info.result)
             # TODO Add specific exception(s)
             except:  # noqa: E722
-                conn.close()
-                # The server might be sick, drop all of the cached connections.
-                self.DropConnections()
+                self.pool.RetireConnection(conn)
                 raise
             else:
                 resp.read()
@@ -1548,64 +1746,40 @@ class SoapStubAdapter(SoapStubAdapterBase):
                     raise Exception(msg)
                 raise obj  # pylint: disable-msg=E0702
         else:
-            conn.close()
+            self.pool.RetireConnection(conn)
             raise six.moves.http_client.HTTPException(
                 "%d %s" % (resp.status, resp.reason))
 
-    # Clean up connection pool to throw away idle timed-out connections
-    #  SoapStubAdapter lock must be acquired before this method is called.
-    def _CloseIdleConnections(self):
-        if self.connectionPoolTimeout >= 0:
-            currentTime = time.time()
-            idleConnections = []
-            for conn, lastAccessTime in self.pool:
-                idleTime = currentTime - lastAccessTime
-                if idleTime >= self.connectionPoolTimeout:
-                    i = self.pool.index((conn, lastAccessTime))
-                    idleConnections = self.pool[i:]
-                    self.pool = self.pool[:i]
-                    break
-
-            for conn, _ in idleConnections:
-                conn.close()
+    # Create a new HTTP connection to the server
+    def _CreateConnection(self):
+        result = self.scheme(self.host, **self.schemeArgs)
+        _VerifyThumbprint(self.thumbprint, result)
+        return result
 
     # Get a HTTP connection from the pool
+    #
+    # The connection must be given back with ReturnConnection.
     def GetConnection(self):
-        self.lock.acquire()
-        self._CloseIdleConnections()
-        if self.pool:
-            result, _ = self.pool.pop(0)
-            self.lock.release()
-        else:
-            self.lock.release()
-            result = self.scheme(self.host, **self.schemeArgs)
-
-            _VerifyThumbprint(self.thumbprint, result)
-
-        return result
+        self.pool.idleTimeout = self.connectionPoolTimeout
+        return self.pool.GetConnection()
 
     # Drop all cached connections to the server.
     def DropConnections(self):
-        self.lock.acquire()
-        oldConnections = self.pool
-        self.pool = []
-        self.lock.release()
-        for conn, _ in oldConnections:
-            conn.close()
+        self.pool.DropConnections()
 
     # Return a HTTP connection to the pool
     def ReturnConnection(self, conn):
-        self.lock.acquire()
-        self._CloseIdleConnections()
+        self.pool.size = self.poolSize
         # In case of ssl tunneling, only add the conn if the conn has
         # not been closed
-        if len(self.pool) < self.poolSize and (not self.is_ssl_tunnel
-                                               or conn.sock):
-            self.pool.insert(0, (conn, time.time()))
-            self.lock.release()
-        else:
-            self.lock.release()
-            conn.close()
+        self.pool.ReturnConnection(
+            conn, not self.is_ssl_tunnel or conn.sock is not None)
+
+    # Get the HTTP connection pool metrics
+    #
+    # @return a dict, see _ConnectionPool.GetStats
+    def GetPoolStats(self):
+        return self.pool.GetStats()
 
     # Need to override the depcopy method. Since, the stub is not deep copyable
     # due to the thread lock and connection pool, deep copy of a managed object
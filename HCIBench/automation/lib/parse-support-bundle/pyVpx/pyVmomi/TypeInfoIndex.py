@@ -0,0 +1,222 @@
+# **********************************************************
+# Copyright 2022 VMware, Inc.  All rights reserved. -- VMware Confidential
+# **********************************************************
+"""
+Generator of the typeinfo index (_typeinfoindex.py)
+
+The index lets pyVmomi import a _typeinfo_* module only when one of its types
+or methods is first looked up. It holds the version declarations of all the
+modules, which are replayed at startup, and maps every VMODL name (and every
+prefix of it), WSDL type name and WSDL method name to the modules defining it.
+A module is given by its index in typeinfos, as an int for the names defined
+by a single module and a tuple of ints for the others.
+
+The typeinfo modules are parsed, not imported, so the index can be rebuilt
+with any Python interpreter:
+
+    python TypeInfoIndex.py
+
+pyVmomi ignores the index and imports every typeinfo module when the index is
+missing or its recorded module sizes or SHA-1 digests do not match the
+modules on disk.
+"""
+
+import ast
+import hashlib
+import os
+import sys
+
+INDEX_MODULE = '_typeinfoindex'
+# Must match _TYPEINFO_INDEX_VERSION in __init__.py
+INDEX_VERSION = 3
+
+_typeFunctions = ('CreateDataType', 'CreateManagedType', 'CreateEnumType')
+_maturitySets = ('newestVersions', 'ltsVersions', 'dottedVersions',
+                 'oldestVersions')
+
+
+def GetTypeInfoPath(typeinfoDir, typeinfo):
+    """ Path of the source of a typeinfo module """
+    return os.path.join(typeinfoDir, '_typeinfo_%s.py' % typeinfo)
+
+
+def GetTypeInfoSizes(typeinfoDir, typeinfos):
+    """ Sizes of the sources of the typeinfo modules which exist """
+    sizes = {}
+    for typeinfo in typeinfos:
+        try:
+            sizes[typeinfo] = os.path.getsize(
+                GetTypeInfoPath(typeinfoDir, typeinfo))
+        except OSError:
+            pass
+    return sizes
+
+
+def GetTypeInfoDigest(typeinfoDir, typeinfo):
+    """ SHA-1 digest of the source of a typeinfo module """
+    with open(GetTypeInfoPath(typeinfoDir, typeinfo), 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _GetCallName(call):
+    func = call.func
+    if isinstance(func, ast.Name):
+        return func.id
+    if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) \
+            and func.value.id in _maturitySets and func.attr == 'Add':
+        return func.value.id
+    return None
+
+
+def _Uncapitalize(vmodlName):
+    return ".".join(name[0].lower() + name[1:]
+                    for name in vmodlName.split("."))
+
+
+class _Index(object):
+    def __init__(self):
+        self.typeinfos = []
+        self.versions = []
+        self.versionNames = set()
+        self.versionParents = {}
+        self.maturities = []
+        self.breakingChanges = []
+        self.topLevelNames = set()
+        self.vmodlNames = {}
+        self.wsdlNames = {}
+        self.wsdlMethods = {}
+
+    def _Add(self, table, name, typeinfo):
+        modules = table.setdefault(name, [])
+        if typeinfo not in modules:
+            modules.append(typeinfo)
+
+    def AddTypeInfo(self, typeinfo, source, filename):
+        self.typeinfos.append(typeinfo)
+        for stmt in ast.parse(source, filename).body:
+            if isinstance(stmt, (ast.Import, ast.ImportFrom)):
+                continue
+            call = isinstance(stmt, ast.Expr) and stmt.value
+            name = isinstance(call, ast.Call) and _GetCallName(call)
+            if not name:
+                raise ValueError("%s:%d: unexpected statement" %
+                                 (filename, stmt.lineno))
+            if name in _typeFunctions:
+                self._AddType(typeinfo, name, call.args)
+                continue
+            args = tuple(ast.literal_eval(arg) for arg in call.args)
+            if name == 'AddVersion':
+                # Only the first declaration of a version takes effect
+                if args[0] not in self.versionNames:
+                    self.versionNames.add(args[0])
+                    self.versions.append(args)
+            elif name == 'AddVersionParent':
+                self.versionParents.setdefault(args[0], set()).add(args[1])
+            elif name == 'AddBreakingChangesInfo':
+                self.breakingChanges.append(args)
+            else:
+                self.maturities.append((name, args[0]))
+
+    def _AddType(self, typeinfo, function, args):
+        vmodlName = ast.literal_eval(args[0])
+        wsdlName = ast.literal_eval(args[1])
+        names = _Uncapitalize(vmodlName).split(".")
+        self.topLevelNames.add(vmodlName.split(".")[0])
+        for i in range(len(names)):
+            self._Add(self.vmodlNames, ".".join(names[:i + 1]), typeinfo)
+        self._Add(self.wsdlNames, wsdlName, typeinfo)
+        if function == 'CreateManagedType' \
+                and isinstance(args[5], (ast.List, ast.Tuple)):
+            for method in args[5].elts:
+                self._Add(self.wsdlMethods, ast.literal_eval(method.elts[1]),
+                          typeinfo)
+
+    def Write(self, out, sizes, digests):
+        moduleIndices = dict((typeinfo, i)
+                             for i, typeinfo in enumerate(self.typeinfos))
+
+        def WriteTable(name, table):
+            out.write("%s = {\n" % name)
+            for key in sorted(table):
+                indices = tuple(moduleIndices[typeinfo]
+                                for typeinfo in table[key])
+                if len(indices) == 1:
+                    indices = indices[0]
+                out.write("    %r: %r,\n" % (key, indices))
+            out.write("}\n\n")
+
+        out.write("# ******* WARNING - AUTO GENERATED CODE - DO NOT EDIT "
+                  "*******\n")
+        out.write("# Generated by TypeInfoIndex.py from the _typeinfo_* "
+                  "modules\n\n")
+        out.write("version = %d\n\n" % INDEX_VERSION)
+        out.write("typeinfos = %r\n\n" % (tuple(self.typeinfos), ))
+        out.write("sizes = {\n")
+        for typeinfo in self.typeinfos:
+            out.write("    %r: %d,\n" % (typeinfo, sizes[typeinfo]))
+        out.write("}\n\n")
+        out.write("digests = {\n")
+        for typeinfo in self.typeinfos:
+            out.write("    %r: %r,\n" % (typeinfo, digests[typeinfo]))
+        out.write("}\n\n")
+        out.write("versions = (\n")
+        for args in self.versions:
+            out.write("    %r,\n" % (args, ))
+        out.write(")\n\n")
+        out.write("versionParents = (\n")
+        for version in sorted(self.versionParents):
+            out.write("    (%r, %r),\n" %
+                      (version, tuple(sorted(self.versionParents[version]))))
+        out.write(")\n\n")
+        out.write("maturities = (\n")
+        for args in self.maturities:
+            out.write("    %r,\n" % (args, ))
+        out.write(")\n\n")
+        out.write("breakingChanges = (\n")
+        for args in self.breakingChanges:
+            out.write("    %r,\n" % (args, ))
+        out.write(")\n\n")
+        out.write("topLevelNames = %r\n\n" %
+                  (tuple(sorted(self.topLevelNames)), ))
+        WriteTable("vmodlNames", self.vmodlNames)
+        WriteTable("wsdlNames", self.wsdlNames)
+        WriteTable("wsdlMethods", self.wsdlMethods)
+
+
+def _GetTypeInfos(typeinfoDir):
+    # _typeinfos.py imports pyVmomi, so read the list from its source
+    filename = os.path.join(typeinfoDir, '_typeinfos.py')
+    with open(filename) as f:
+        source = f.read()
+    for stmt in ast.parse(source, filename).body:
+        if isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 \
+                and getattr(stmt.targets[0], 'id', None) == 'typeinfos':
+            return ast.literal_eval(stmt.value)
+    raise ValueError("%s: typeinfos not found" % filename)
+
+
+def Build(typeinfoDir=None):
+    """ Regenerate the index of the typeinfo modules in typeinfoDir """
+    if typeinfoDir is None:
+        typeinfoDir = os.path.dirname(os.path.abspath(__file__))
+    typeinfos = _GetTypeInfos(typeinfoDir)
+    sizes = GetTypeInfoSizes(typeinfoDir, typeinfos)
+    digests = {}
+    index = _Index()
+    for typeinfo in typeinfos:
+        if typeinfo not in sizes:
+            continue
+        filename = GetTypeInfoPath(typeinfoDir, typeinfo)
+        with open(filename) as f:
+            index.AddTypeInfo(typeinfo, f.read(), filename)
+        digests[typeinfo] = GetTypeInfoDigest(typeinfoDir, typeinfo)
+    filename = os.path.join(typeinfoDir, INDEX_MODULE + '.py')
+    tmpFilename = filename + '.tmp'
+    with open(tmpFilename, 'w') as out:
+        index.Write(out, sizes, digests)
+    os.rename(tmpFilename, filename)
+    return filename
+
+
+if __name__ == '__main__':
+    sys.stdout.write("Wrote %s\n" % Build(*sys.argv[1:2]))
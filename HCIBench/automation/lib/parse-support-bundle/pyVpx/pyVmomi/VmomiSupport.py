@@ -63,6 +63,13 @@ _wsdlDefMap = {}
 # then _dependencyMap[a.b] = {c,d}
 _dependencyMap = {}
 
+# Index of the typeinfo modules that are imported on demand (see
+# SetTypeInfoIndex), the function importing one of them by name and the names
+# of those already imported
+_typeInfoIndex = None
+_typeInfoImporter = None
+_importedTypeInfos = set()
+
 
 # Update the dependency map
 # Note: Must be holding the _lazyLock
@@ -85,6 +92,7 @@ def _AddToDependencyMap(names):
 # @return True, if name depends on parent, False otherwise
 def _CheckForDependency(parent, name):
     """ Note: Must be holding the _lazyLock """
+    _ImportTypeInfosForVmodlName(parent + "." + name)
     if _allowCapitalizedNames:
         # If the flag is set, check for both capitalized and
         # uncapitalized form. This is a temporary fix for handling
@@ -123,15 +131,198 @@ def _LoadVmodlType(name):
         name = UncapitalizeVmodlName(name)
 
     with _lazyLock:
-        for defMap, loadFn in [(_dataDefMap, LoadDataType),
-                               (_managedDefMap, LoadManagedType),
-                               (_enumDefMap, LoadEnumType)]:
-            dic = defMap.get(name)
-            if dic:
-                typ = loadFn(*dic)
-                return isArray and typ.Array or typ
+        while True:
+            for defMap, loadFn in [(_dataDefMap, LoadDataType),
+                                   (_managedDefMap, LoadManagedType),
+                                   (_enumDefMap, LoadEnumType)]:
+                dic = defMap.get(name)
+                if dic:
+                    typ = loadFn(*dic)
+                    return isArray and typ.Array or typ
+            if not _ImportTypeInfosForVmodlName(name):
+                return None
+
+
+# Use an index of the typeinfo modules to import them on demand
+#
+# The version declarations of the indexed modules are applied right away. A
+# module is imported the first time one of its types or methods, or a type
+# nested in one of them, is looked up. See TypeInfoIndex.py.
+#
+# @param index the index module
+# @param importer function importing a typeinfo module by name
+def SetTypeInfoIndex(index, importer):
+    global _typeInfoIndex, _typeInfoImporter
+    with _lazyLock:
+        for args in index.versions:
+            AddVersion(*args)
+        for version, parents in index.versionParents:
+            parentMap[version].update(parents)
+        _ApplyMaturities(index)
+        for args in index.breakingChanges:
+            AddBreakingChangesInfo(*args)
+        _topLevelNames.update(index.topLevelNames)
+        _typeInfoIndex = index
+        _typeInfoImporter = importer
+
+
+# Get the version maturity sets by name
+def _GetMaturitySets():
+    return {
+        'newestVersions': newestVersions,
+        'ltsVersions': ltsVersions,
+        'dottedVersions': dottedVersions,
+        'oldestVersions': oldestVersions
+    }
+
+
+# Names of the index attributes used after SetTypeInfoIndex
+_typeInfoIndexTables = ('typeinfos', 'maturities', 'topLevelNames',
+                        'vmodlNames', 'wsdlNames', 'wsdlMethods')
+
+
+# Get the version registry and the typeinfo index as plain data
+#
+# Only valid right after SetTypeInfoIndex, before other modules declare
+# versions of their own. See RegistrySnapshot.py.
+#
+# @return a dict for RestoreRegistry, made of dicts, tuples and strings only
+def SnapshotRegistry():
+    with _lazyLock:
+        if _typeInfoIndex is None:
+            raise RuntimeError("No typeinfo index to snapshot")
+        maturitySets = _GetMaturitySets()
+        return {
+            'nsMap': dict(nsMap),
+            'versionIdMap': dict(versionIdMap),
+            'versionMap': dict(versionMap),
+            'serviceNsMap': dict(serviceNsMap),
+            'parentMap': dict((version, tuple(parents))
+                              for version, parents in six.iteritems(parentMap)),
+            'maturitySets': dict(
+                (name, (dict(s._verNameMap), dict(s._verNameMapW),
+                        dict(s._wireIdMap), dict(s._wireIdMapW)))
+                for name, s in six.iteritems(maturitySets)),
+            'breakingChanges': dict(_breakingChanges),
+            'index': dict((name, getattr(_typeInfoIndex, name))
+                          for name in _typeInfoIndexTables),
+        }
 
-        return None
+
+# Restore the state left by SetTypeInfoIndex from a SnapshotRegistry result
+#
+# @param snapshot the snapshot
+# @param importer function importing a typeinfo module by name
+def RestoreRegistry(snapshot, importer):
+    global _typeInfoIndex, _typeInfoImporter
+    with _lazyLock:
+        nsMap.update(snapshot['nsMap'])
+        versionIdMap.update(snapshot['versionIdMap'])
+        versionMap.update(snapshot['versionMap'])
+        serviceNsMap.update(snapshot['serviceNsMap'])
+        for version, parents in six.iteritems(snapshot['parentMap']):
+            parentMap.setdefault(version, set()).update(parents)
+        maturitySets = _GetMaturitySets()
+        for name, maps in six.iteritems(snapshot['maturitySets']):
+            s = maturitySets[name]
+            for target, source in zip((s._verNameMap, s._verNameMapW,
+                                       s._wireIdMap, s._wireIdMapW), maps):
+                target.update(source)
+        for branchName, counts in six.iteritems(snapshot['breakingChanges']):
+            _breakingChanges.setdefault(branchName, {}).update(counts)
+        index = Object(**snapshot['index'])
+        _topLevelNames.update(index.topLevelNames)
+        _typeInfoIndex = index
+        _typeInfoImporter = importer
+
+
+# Register the version maturities of an index in the order of its modules
+def _ApplyMaturities(index):
+    maturitySets = _GetMaturitySets()
+    for setName, version in index.maturities:
+        maturitySets[setName].Add(version)
+
+
+# Import the indexed typeinfo modules listed for a name
+# Note: Must be holding the _lazyLock
+#
+# @param modules names of the typeinfo modules
+# @return True if any of the modules was not imported yet
+def _ImportTypeInfos(modules):
+    """ Note: Must be holding the _lazyLock """
+    imported = False
+    for module in modules:
+        if module not in _importedTypeInfos:
+            _importedTypeInfos.add(module)
+            _typeInfoImporter(module)
+            imported = True
+    if imported:
+        # The modules have declared their versions again, restore the
+        # maturities to what importing all of them in order gives
+        _ApplyMaturities(_typeInfoIndex)
+    return imported
+
+
+# Get the names of the typeinfo modules of an entry of the index tables
+#
+# @param modules index in typeinfos of the module, or tuple of the indices of
+#   the modules, see TypeInfoIndex.py
+# @return the names of the modules
+def _GetIndexedTypeInfos(modules):
+    typeinfos = _typeInfoIndex.typeinfos
+    if isinstance(modules, int):
+        return (typeinfos[modules], )
+    return tuple(typeinfos[i] for i in modules)
+
+
+# Import the typeinfo modules defining a vmodl type or types nested in it
+# Note: Must be holding the _lazyLock
+#
+# @param name vmodl name of the type
+# @return True if any module was imported
+def _ImportTypeInfosForVmodlName(name):
+    """ Note: Must be holding the _lazyLock """
+    if _typeInfoIndex is None:
+        return False
+    modules = _typeInfoIndex.vmodlNames.get(UncapitalizeVmodlName(name))
+    return modules is not None and \
+        _ImportTypeInfos(_GetIndexedTypeInfos(modules))
+
+
+# Import the typeinfo modules defining a wsdl type name in any namespace
+# Note: Must be holding the _lazyLock
+#
+# @param name wsdl name of the type
+# @return True if any module was imported
+def _ImportTypeInfosForWsdlName(name):
+    """ Note: Must be holding the _lazyLock """
+    if _typeInfoIndex is None:
+        return False
+    modules = _typeInfoIndex.wsdlNames.get(name)
+    return modules is not None and \
+        _ImportTypeInfos(_GetIndexedTypeInfos(modules))
+
+
+# Import the typeinfo modules defining a wsdl method in any namespace
+# Note: Must be holding the _lazyLock
+#
+# @param name wsdl name of the method
+# @return True if any module was imported
+def _ImportTypeInfosForWsdlMethod(name):
+    """ Note: Must be holding the _lazyLock """
+    if _typeInfoIndex is None:
+        return False
+    modules = _typeInfoIndex.wsdlMethods.get(name)
+    return modules is not None and \
+        _ImportTypeInfos(_GetIndexedTypeInfos(modules))
+
+
+# Import all the indexed typeinfo modules
+# Note: Must be holding the _lazyLock
+def _ImportAllTypeInfos():
+    """ Note: Must be holding the _lazyLock """
+    if _typeInfoIndex is not None:
+        _ImportTypeInfos(_typeInfoIndex.typeinfos)
 
 
 # Simple class to store named attributes
@@ -190,6 +381,7 @@ class LazyType(type):
             searchName = attr
 
         with _lazyLock:
+            _ImportTypeInfosForVmodlName(self.__name__ + "." + searchName)
             nestedClasses = _dependencyMap.get(self.__name__, [])
             if searchName in nestedClasses:
                 return GetVmodlType(self.__name__ + "." + attr)
@@ -649,6 +841,7 @@ def CreateAndLoadMethodFaultType():
 def _CheckNestedClasses(typ, parent):
     with _lazyLock:
         vmodlName = typ.__name__
+        _ImportTypeInfosForVmodlName(vmodlName)
         nestedClasses = _dependencyMap.get(vmodlName, [])
         for nestedClass in nestedClasses:
             if hasattr(parent, nestedClass):
@@ -1142,7 +1335,12 @@ def GetWsdlType(ns, name):
                 raise KeyError("%s %s" % (ns, name))
         else:
             # Type is not loaded yet, load it
-            typ = _LoadVmodlType(_wsdlDefMap[(ns, name)][0])
+            dic = _wsdlDefMap.get((ns, name))
+            if dic is None and _ImportTypeInfosForWsdlName(name):
+                dic = _wsdlDefMap.get((ns, name))
+            if dic is None:
+                raise KeyError("%s %s" % (ns, name))
+            typ = _LoadVmodlType(dic[0])
             if typ:
                 return typ
 
@@ -1161,6 +1359,9 @@ def GuessWsdlType(name):
         # the wrong one will cause a deserialization error (1656837).
         # Since in python3 the order of entries in set is not deterministic,
         # we will try to get the type from vim25 namespace first.
+        _ImportTypeInfosForWsdlName(name)
+        if name.startswith("ArrayOf"):
+            _ImportTypeInfosForWsdlName(name[7:])
         try:
             return GetWsdlType(XMLNS_VMODL_BASE, name)
         except KeyError:
@@ -1182,6 +1383,7 @@ def GuessWsdlType(name):
 # @return iterator to the wsdl type map
 def GetWsdlTypes():
     with _lazyLock:
+        _ImportAllTypeInfos()
         for ns, name in _wsdlDefMap:
             GetWsdlType(ns, name)
         return six.itervalues(_wsdlTypeMap)
@@ -1395,7 +1597,11 @@ def _SetWsdlMethod(ns, wsdlName, inputMM):
 def GetWsdlMethod(ns, wsdlName):
     """ Get wsdl method from ns, wsdlName """
     with _lazyLock:
-        method = _wsdlMethodMap[(ns, wsdlName)]
+        method = _wsdlMethodMap.get((ns, wsdlName))
+        if method is None and _ImportTypeInfosForWsdlMethod(wsdlName):
+            method = _wsdlMethodMap.get((ns, wsdlName))
+        if method is None:
+            raise KeyError("%s %s" % (ns, wsdlName))
         if isinstance(method, ManagedMethod):
             # The type corresponding to the method is loaded,
             # just return the method object
@@ -1422,6 +1628,7 @@ def GuessWsdlMethod(name):
         # the wrong one will cause a deserialization error (1656837).
         # Since in python3 the order of entries in set is not deterministic,
         # we will try to get the method from vim25 namespace first.
+        _ImportTypeInfosForWsdlMethod(name)
         try:
             return GetWsdlMethod(XMLNS_VMODL_BASE, name)
         except KeyError:
@@ -1808,6 +2015,9 @@ def GetPythonTypeName(wsdlTypeName, ns):
 # @return python method name
 def GetPythonMethodName(wsdlTypeName, ns, wsdlMethodName):
     try:
+        with _lazyLock:
+            if (ns, wsdlTypeName) not in _wsdlDefMap:
+                _ImportTypeInfosForWsdlName(wsdlTypeName)
         _, _, _, _, _, methods = _wsdlDefMap[(ns, wsdlTypeName)]
     except KeyError:
         raise NameError('No type found with namespace %s and name %s' %
@@ -1862,11 +2072,13 @@ def _GetActualName(name):
     """ Note: Must be holding the _lazyLock """
     if _allowCapitalizedNames:
         name = UncapitalizeVmodlName(name)
-    for defMap in _dataDefMap, _managedDefMap, _enumDefMap:
-        dic = defMap.get(name)
-        if dic:
-            return dic[0]
-    return None
+    while True:
+        for defMap in _dataDefMap, _managedDefMap, _enumDefMap:
+            dic = defMap.get(name)
+            if dic:
+                return dic[0]
+        if not _ImportTypeInfosForVmodlName(name):
+            return None
 
 
 # Retrieves the actual wsdl name from type dictionaries
@@ -1878,17 +2090,20 @@ def _GetWsdlInfo(name):
         name = UncapitalizeVmodlName(name)
 
     with _lazyLock:
-        # For data and managed objects, emitter puts version in field #3 and in
-        # enum objects, it is in field #2. So, have to handle them differently
-        for defMap in _dataDefMap, _managedDefMap:
-            dic = defMap.get(name)
+        while True:
+            # For data and managed objects, emitter puts version in field #3
+            # and in enum objects, it is in field #2. So, have to handle them
+            # differently
+            for defMap in _dataDefMap, _managedDefMap:
+                dic = defMap.get(name)
+                if dic:
+                    return GetWsdlNamespace(dic[3]), dic[1]
+
+            dic = _enumDefMap.get(name)
             if dic:
-                return GetWsdlNamespace(dic[3]), dic[1]
-
-        dic = _enumDefMap.get(name)
-        if dic:
-            return GetWsdlNamespace(dic[2]), dic[1]
-        return None, None
+                return GetWsdlNamespace(dic[2]), dic[1]
+            if not _ImportTypeInfosForVmodlName(name):
+                return None, None
 
 
 # Checks if the definition exists for a vmodl name
@@ -3,6 +3,7 @@
 # -- VMware Confidential
 # **********************************************************
 
+import os
 import sys
 import importlib
 
@@ -12,6 +13,9 @@ if sys.version_info < (2, 7, 9):
 
 _initialized = False
 
+# Format version of _typeinfoindex.py, see TypeInfoIndex.INDEX_VERSION
+_TYPEINFO_INDEX_VERSION = 3
+
 
 # Definition precedes pyVmomi modules imports to escape circular
 # dependency error if modules import is_initialized()
@@ -27,8 +31,57 @@ def _import_typeinfo(typeinfo):
         pass
 
 
+def _is_typeinfo_index_current(index, typeinfoDir, typeinfos):
+    # The index is stale if any typeinfo module was changed since it was
+    # generated by TypeInfoIndex.py. The sizes are compared first, as they
+    # are cheaper to check, then the digests of the sources.
+    if getattr(index, 'version', None) != _TYPEINFO_INDEX_VERSION:
+        return False
+    paths = {}
+    for typeinfo in typeinfos:
+        path = os.path.join(typeinfoDir, '_typeinfo_%s.py' % typeinfo)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = None
+        if index.sizes.get(typeinfo) != size:
+            return False
+        if size is not None:
+            paths[typeinfo] = path
+    import hashlib
+    for typeinfo, path in paths.items():
+        try:
+            with open(path, 'rb') as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+        except (IOError, OSError):
+            return False
+        if index.digests.get(typeinfo) != digest:
+            return False
+    return True
+
+
+def _load_typeinfo_index(typeinfos):
+    try:
+        from . import _typeinfoindex as index
+    except ImportError:
+        return None
+    typeinfoDir = os.path.dirname(os.path.abspath(__file__))
+    if not _is_typeinfo_index_current(index, typeinfoDir, typeinfos):
+        return None
+    return index
+
+
 def _load_typeinfos():
     from ._typeinfos import typeinfos
+    from . import RegistrySnapshot
+    sources = RegistrySnapshot.GetSources(typeinfos)
+    if RegistrySnapshot.Load(sources, _import_typeinfo):
+        return
+    index = _load_typeinfo_index(typeinfos)
+    if index is not None:
+        VmomiSupport.SetTypeInfoIndex(index, _import_typeinfo)
+        RegistrySnapshot.Save(sources)
+        return
     for typeinfo in typeinfos:
         _import_typeinfo(typeinfo)
 
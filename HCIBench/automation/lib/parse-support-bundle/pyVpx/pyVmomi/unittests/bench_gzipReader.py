@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# **********************************************************
+# Copyright 2022 VMware, Inc.  All rights reserved. -- VMware Confidential
+# **********************************************************
+"""
+Micro-benchmark of SoapAdapter.GzipReader
+
+Parses a large array response, of the shape of QueryVsanPerf results, from
+memory: as is, and gzip, zlib or raw deflate encoded. Every encoding is
+parsed by expat alone, which shows the cost of the reader, and deserialized
+by SoapResponseDeserializer. The reader which GzipReader replaced, which
+read 512 bytes at a time and joined its chunks on every read(), and zlib's
+own inflate time are printed for reference. Compressed responses should
+parse at about the speed of identity ones plus the inflate time.
+
+Run from pyVpx with:
+    python pyVmomi/unittests/bench_gzipReader.py [--entities N] [--repeat N]
+"""
+
+from __future__ import print_function
+
+import io
+import os
+import random
+import sys
+import time
+import zlib
+from argparse import ArgumentParser
+from xml.parsers.expat import ParserCreate
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, os.pardir))
+
+from pyVmomi import SoapAdapter, vim  # noqa: E402
+from pyVmomi.SoapAdapter import GzipReader  # noqa: E402
+from pyVmomi.VmomiSupport import Object  # noqa: E402
+
+VERSION = 'vim.version.version10'
+RESULT_TYPE = vim.PerformanceManager.EntityMetricCSV.Array
+
+
+# GzipReader before it inflated into a reusable buffer (gzip only)
+class BaselineGzipReader:
+    def __init__(self, rfile, readChunkSize=512):
+        self.rfile = rfile
+        self.chunks = []
+        self.bufSize = 0
+        self.unzip = zlib.decompressobj(zlib.MAX_WBITS + 16)
+        self.readChunkSize = readChunkSize
+
+    def read(self, bytes=-1):
+        chunks = self.chunks
+        bufSize = self.bufSize
+        while bufSize < bytes or bytes == -1:
+            chunk = self.rfile.read(self.readChunkSize)
+            if chunk:
+                inflatedChunk = self.unzip.decompress(chunk)
+                bufSize += len(inflatedChunk)
+                chunks.append(inflatedChunk)
+            else:
+                break
+        if bufSize <= bytes or bytes == -1:
+            leftoverBytes = 0
+            leftoverChunks = []
+        else:
+            leftoverBytes = bufSize - bytes
+            lastChunk = chunks.pop()
+            chunks.append(lastChunk[:-leftoverBytes])
+            leftoverChunks = [lastChunk[-leftoverBytes:]]
+        self.chunks = leftoverChunks
+        self.bufSize = leftoverBytes
+        return b"".join(chunks)
+
+
+def MakeResponse(numEntities, numSamples=144, numSeries=10):
+    rand = random.Random(0)
+    entities = RESULT_TYPE()
+    sampleInfo = ','.join('2024-01-02 %02d:%02d:00' % divmod(i * 5, 60)
+                          for i in range(numSamples))
+    for i in range(numEntities):
+        entities.append(vim.PerformanceManager.EntityMetricCSV(
+            entity=vim.HostSystem('host-%d' % i),
+            sampleInfoCSV=sampleInfo,
+            value=[vim.PerformanceManager.MetricSeriesCSV(
+                id=vim.PerformanceManager.MetricId(counterId=j, instance=''),
+                value=','.join(str(rand.randint(0, 99999))
+                               for k in range(numSamples)))
+                   for j in range(numSeries)]))
+    body = SoapAdapter.SerializeToStr(
+        entities, Object(name='returnval', type=RESULT_TYPE, version=VERSION,
+                         flags=SoapAdapter.F_OPTIONAL), VERSION, {})
+    return (SoapAdapter.SOAP_START + '<QueryPerfResponse xmlns="urn:vim25">' +
+            body + '</QueryPerfResponse>' + SoapAdapter.SOAP_END).encode('utf-8')
+
+
+def Encode(xml, encoding):
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS + 16)
+    elif encoding == 'zlib':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS)
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(xml) + compressor.flush()
+
+
+def OpenResponse(data, encoding, reader):
+    fd = io.BytesIO(data)
+    if encoding == 'identity':
+        return fd
+    if reader == 'baseline':
+        return BaselineGzipReader(fd)
+    if encoding == 'gzip':
+        return GzipReader(fd, encoding=GzipReader.GZIP)
+    return GzipReader(fd, encoding=GzipReader.DEFLATE)
+
+
+def ExpatParse(fd):
+    parser = ParserCreate(namespace_separator=SoapAdapter.NS_SEP)
+    parser.buffer_text = True
+    if isinstance(fd, GzipReader):
+        fd.Parse(parser)
+    else:
+        parser.ParseFile(fd)
+
+
+def Deserialize(fd):
+    result = SoapAdapter.SoapResponseDeserializer(None).Deserialize(
+        fd, RESULT_TYPE)
+    assert isinstance(result, list)
+
+
+def Best(repeat, fn):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--entities', type=int, default=2000,
+                        help='number of entities in the response')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each case, the best one is printed')
+    args = parser.parse_args()
+
+    xml = MakeResponse(args.entities)
+    payloads = dict((encoding, Encode(xml, encoding))
+                    for encoding in ('gzip', 'zlib', 'deflate'))
+    payloads['identity'] = xml
+    mb = len(xml) / 1e6
+    print('response: %.1f MB, gzip %.1f MB, best of %d' %
+          (mb, len(payloads['gzip']) / 1e6, args.repeat))
+    inflate = Best(args.repeat, lambda: zlib.decompress(payloads['gzip'],
+                                                        zlib.MAX_WBITS + 16))
+    print('%-32s %7.3fs %8.1f MB/s' % ('zlib inflate only', inflate, mb / inflate))
+
+    cases = [('identity', 'GzipReader'), ('gzip', 'baseline'),
+             ('gzip', 'GzipReader'), ('zlib', 'GzipReader'),
+             ('deflate', 'GzipReader')]
+    for name, fn in (('expat', ExpatParse), ('deserialize', Deserialize)):
+        for encoding, reader in cases:
+            if encoding == 'identity':
+                label = '%s %s' % (name, encoding)
+            else:
+                label = '%s %s %s' % (name, encoding, reader)
+            data = payloads[encoding]
+            elapsed = Best(args.repeat,
+                           lambda: fn(OpenResponse(data, encoding, reader)))
+            print('%-32s %7.3fs %8.1f MB/s' % (label, elapsed, mb / elapsed))
+
+    # read() serves the readers which don't hand over their parser
+    for reader in ('baseline', 'GzipReader'):
+        def ReadAll():
+            fd = OpenResponse(payloads['gzip'], 'gzip', reader)
+            while fd.read(8192):
+                pass
+        elapsed = Best(args.repeat, ReadAll)
+        print('%-32s %7.3fs %8.1f MB/s' % ('read(8192) gzip ' + reader,
+                                           elapsed, mb / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# **********************************************************
+# Copyright 2022 VMware, Inc.  All rights reserved. -- VMware Confidential
+# **********************************************************
+"""
+Startup benchmark of pyVmomi
+
+Times "import pyVmomi", and the lookup of a few types after it, in fresh
+interpreters on copies of the package, as it is loaded:
+  eager     without _typeinfoindex.py, every typeinfo module is imported
+  index     from the typeinfo index, the registry snapshot is removed first
+  snapshot  from the registry snapshot written by the previous run
+The byte-compiled modules are warm in every case. The best time of the runs
+and the peak RSS of that run are printed.
+
+Run from pyVpx with:
+    python pyVmomi/unittests/bench_startup.py [--repeat N]
+"""
+
+from __future__ import print_function
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from argparse import ArgumentParser
+
+pyVmomiDir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir)
+sys.path.insert(0, os.path.join(pyVmomiDir, os.pardir))
+
+from pyVmomi import RegistrySnapshot  # noqa: E402
+
+CHILD = '''
+import resource, sys, time
+sys.path.insert(0, PKG_DIR)
+start = time.time()
+import pyVmomi
+imported = time.time()
+pyVmomi.vim.VirtualMachine, pyVmomi.vim.HostSystem, pyVmomi.vmodl.MethodFault
+end = time.time()
+print('%f %f %d' % (imported - start, end - imported,
+                    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+'''
+
+
+def CopyPackage(dstDir):
+    shutil.copytree(pyVmomiDir, os.path.join(dstDir, 'pyVmomi'),
+                    ignore=shutil.ignore_patterns('__pycache__', '*.pyc',
+                                                  'unittests'))
+
+
+def Run(pkgDir):
+    child = CHILD.replace('PKG_DIR', repr(pkgDir))
+    output = subprocess.check_output([sys.executable, '-c', child])
+    importTime, lookupTime, maxRss = output.split()
+    return float(importTime), float(lookupTime), int(maxRss)
+
+
+def SnapshotPath(pkgDir):
+    # RegistrySnapshot places the snapshot relative to its own package
+    return os.path.join(pkgDir, 'pyVmomi', os.path.relpath(
+        RegistrySnapshot.GetSnapshotPath(), pyVmomiDir))
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs of each case, the best one is printed')
+    args = parser.parse_args()
+
+    tmpDir = tempfile.mkdtemp()
+    try:
+        eagerDir = os.path.join(tmpDir, 'eager')
+        indexDir = os.path.join(tmpDir, 'index')
+        CopyPackage(eagerDir)
+        CopyPackage(indexDir)
+        os.remove(os.path.join(eagerDir, 'pyVmomi', '_typeinfoindex.py'))
+
+        def RemoveSnapshot():
+            path = SnapshotPath(indexDir)
+            if os.path.exists(path):
+                os.remove(path)
+
+        cases = [('eager', eagerDir, None),
+                 ('index', indexDir, RemoveSnapshot),
+                 ('snapshot', indexDir, None)]
+        print('%-10s %10s %10s %10s' % ('', 'import', 'lookup', 'max RSS'))
+        for name, pkgDir, prepare in cases:
+            # compiles the modules, and writes the snapshot
+            Run(pkgDir)
+            results = []
+            for _ in range(args.repeat):
+                if prepare:
+                    prepare()
+                results.append(Run(pkgDir))
+            importTime, lookupTime, maxRss = min(results)
+            print('%-10s %9.3fs %9.3fs %7.1f MB' %
+                  (name, importTime, lookupTime, maxRss / 1024.0))
+        if not os.path.exists(SnapshotPath(indexDir)):
+            print('warning: no snapshot was written', file=sys.stderr)
+    finally:
+        shutil.rmtree(tmpDir)
+
+
+if __name__ == '__main__':
+    main()
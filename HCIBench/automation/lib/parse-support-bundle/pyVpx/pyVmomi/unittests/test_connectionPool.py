@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# **********************************************************
+# Copyright 2022 VMware, Inc.  All rights reserved. -- VMware Confidential
+# **********************************************************
+"""
+Tests of the HTTP connection pool of SoapAdapter with fake connections,
+backed by socket pairs so that _IsConnectionAlive sees real sockets.
+
+Run from pyVpx with:
+    python pyVmomi/unittests/test_connectionPool.py
+"""
+
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+
+pyVmomiDir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir)
+sys.path.insert(0, os.path.join(pyVmomiDir, os.pardir))
+
+from pyVmomi.SoapAdapter import _ConnectionPool  # noqa: E402
+
+
+# Keep-alive connection to a server, the server end being peer
+class FakeConnection(object):
+    def __init__(self, name):
+        self.name = name
+        self.sock, self.peer = socket.socketpair()
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+        self.sock.close()
+        self.peer.close()
+
+    def __repr__(self):
+        return 'FakeConnection(%r)' % self.name
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.created = []
+
+    def tearDown(self):
+        for conn in self.created:
+            if not conn.closed:
+                conn.close()
+
+    def Create(self):
+        conn = FakeConnection(len(self.created))
+        self.created.append(conn)
+        return conn
+
+    def MakePool(self, size=4, idleTimeout=-1, maxConnections=None):
+        return _ConnectionPool(self.Create, size, idleTimeout, maxConnections)
+
+    def testReuse(self):
+        pool = self.MakePool()
+        conn = pool.GetConnection()
+        pool.ReturnConnection(conn)
+        self.assertIs(pool.GetConnection(), conn)
+        self.assertEqual(len(self.created), 1)
+        self.assertFalse(conn.closed)
+
+    def testMostRecentlyReturnedFirst(self):
+        pool = self.MakePool()
+        conns = [pool.GetConnection() for _ in range(3)]
+        for conn in conns:
+            pool.ReturnConnection(conn)
+        self.assertIs(pool.GetConnection(), conns[-1])
+        self.assertIs(pool.GetConnection(), conns[-2])
+
+    def testBlockWhenExhausted(self):
+        pool = self.MakePool(maxConnections=2)
+        conns = [pool.GetConnection(), pool.GetConnection()]
+        got = []
+        started = threading.Event()
+
+        def Get():
+            started.set()
+            got.append(pool.GetConnection())
+
+        waiter = threading.Thread(target=Get)
+        waiter.daemon = True
+        waiter.start()
+        started.wait()
+        time.sleep(0.2)
+        # still waiting, no connection was created past the limit
+        self.assertEqual(got, [])
+        self.assertEqual(len(self.created), 2)
+        self.assertEqual(pool.GetStats()['waits'], 1)
+
+        pool.ReturnConnection(conns[1])
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(got, [conns[1]])
+        stats = pool.GetStats()
+        self.assertEqual(stats['inUse'], 2)
+        self.assertEqual(stats['hits'], 1)
+        self.assertGreaterEqual(stats['waitTime'], 0.2)
+
+    def testWakeUpOnRetire(self):
+        pool = self.MakePool(maxConnections=1)
+        conn = pool.GetConnection()
+        got = []
+        waiter = threading.Thread(target=lambda: got.append(pool.GetConnection()))
+        waiter.daemon = True
+        waiter.start()
+        time.sleep(0.1)
+        # the slot freed by the retired connection goes to a new one
+        pool.RetireConnection(conn)
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertTrue(conn.closed)
+        self.assertEqual(got, [self.created[1]])
+        self.assertEqual(pool.GetStats()['misses'], 2)
+
+    def testRetireKeepsOthersPooled(self):
+        pool = self.MakePool()
+        conns = [pool.GetConnection() for _ in range(3)]
+        pool.ReturnConnection(conns[0])
+        pool.RetireConnection(conns[1])
+        pool.ReturnConnection(conns[2])
+        self.assertEqual([conn.closed for conn in conns], [False, True, False])
+        stats = pool.GetStats()
+        self.assertEqual(stats['idle'], 2)
+        self.assertEqual(stats['retired'], 1)
+        self.assertEqual(stats['inUse'], 0)
+        self.assertIs(pool.GetConnection(), conns[2])
+        self.assertIs(pool.GetConnection(), conns[0])
+
+    def testDeadIdleConnectionReplaced(self):
+        pool = self.MakePool()
+        conns = [pool.GetConnection() for _ in range(2)]
+        for conn in conns:
+            pool.ReturnConnection(conn)
+        # closed by the server
+        conns[1].peer.close()
+        self.assertIs(pool.GetConnection(), conns[0])
+        self.assertTrue(conns[1].closed)
+        # stray data on an idle connection
+        pool.ReturnConnection(conns[0])
+        conns[0].peer.sendall(b'HTTP/1.1 408 Request Timeout\r\n\r\n')
+        conn = pool.GetConnection()
+        self.assertIs(conn, self.created[2])
+        self.assertTrue(conns[0].closed)
+        stats = pool.GetStats()
+        self.assertEqual(stats['retired'], 2)
+        self.assertEqual(stats['creates'], 3)
+
+    def testIdleTimeout(self):
+        pool = self.MakePool(idleTimeout=0.5)
+        conns = [pool.GetConnection() for _ in range(2)]
+        pool.ReturnConnection(conns[0])
+        time.sleep(1)
+        pool.ReturnConnection(conns[1])
+        # conns[0] timed out as conns[1] was returned
+        self.assertTrue(conns[0].closed)
+        self.assertEqual(pool.GetStats()['idle'], 1)
+        time.sleep(1)
+        conn = pool.GetConnection()
+        self.assertTrue(conns[1].closed)
+        self.assertIs(conn, self.created[2])
+
+    def testNoIdleTimeout(self):
+        pool = self.MakePool(idleTimeout=-1)
+        conn = pool.GetConnection()
+        pool.ReturnConnection(conn)
+        time.sleep(0.1)
+        self.assertIs(pool.GetConnection(), conn)
+
+    def testPoolSize(self):
+        pool = self.MakePool(size=1)
+        conns = [pool.GetConnection() for _ in range(2)]
+        for conn in conns:
+            pool.ReturnConnection(conn)
+        # not kept, but not retired either
+        self.assertEqual([conn.closed for conn in conns], [False, True])
+        self.assertEqual(pool.GetStats()['retired'], 0)
+
+    def testCreateFails(self):
+        def Create():
+            raise socket.error('connection refused')
+
+        pool = _ConnectionPool(Create, 4, -1, maxConnections=1)
+        self.assertRaises(socket.error, pool.GetConnection)
+        # the slot is freed
+        self.assertEqual(pool.GetStats()['inUse'], 0)
+        self.assertRaises(socket.error, pool.GetConnection)
+
+    def testDropConnections(self):
+        pool = self.MakePool()
+        conns = [pool.GetConnection() for _ in range(2)]
+        pool.ReturnConnection(conns[0])
+        pool.DropConnections()
+        self.assertTrue(conns[0].closed)
+        self.assertFalse(conns[1].closed)
+        self.assertEqual(pool.GetStats()['idle'], 0)
+
+    def testStats(self):
+        pool = self.MakePool(size=2)
+        self.assertEqual(pool.GetStats(), {
+            'hits': 0, 'misses': 0, 'creates': 0, 'retired': 0,
+            'waits': 0, 'waitTime': 0.0, 'idle': 0, 'inUse': 0,
+        })
+        conns = [pool.GetConnection() for _ in range(3)]
+        pool.ReturnConnection(conns[0])
+        pool.ReturnConnection(conns[1])
+        pool.RetireConnection(conns[2])
+        pool.GetConnection()
+        self.assertEqual(pool.GetStats(), {
+            'hits': 1, 'misses': 3, 'creates': 3, 'retired': 1,
+            'waits': 0, 'waitTime': 0.0, 'idle': 1, 'inUse': 1,
+        })
+
+
+if __name__ == '__main__':
+    unittest.main()
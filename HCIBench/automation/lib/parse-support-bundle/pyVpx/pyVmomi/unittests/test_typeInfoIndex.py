@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# **********************************************************
+# Copyright 2022 VMware, Inc.  All rights reserved. -- VMware Confidential
+# **********************************************************
+"""
+Tests that the checked-in _typeinfoindex.py matches the typeinfo modules it
+is generated from, and that pyVmomi detects a stale index.
+
+Run from pyVpx with:
+    python pyVmomi/unittests/test_typeInfoIndex.py
+"""
+
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+
+pyVmomiDir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir)
+sys.path.insert(0, os.path.join(pyVmomiDir, os.pardir))
+
+import pyVmomi  # noqa: E402
+from pyVmomi import TypeInfoIndex  # noqa: E402
+from pyVmomi._typeinfos import typeinfos  # noqa: E402
+
+
+def LoadIndex(filename):
+    index = types.ModuleType(TypeInfoIndex.INDEX_MODULE)
+    with open(filename) as f:
+        exec(compile(f.read(), filename, 'exec'), index.__dict__)
+    return index
+
+
+class TypeInfoIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.typeinfoDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.typeinfoDir)
+        for filename in glob.glob(os.path.join(pyVmomiDir, '_typeinfo*.py')):
+            if os.path.basename(filename) != TypeInfoIndex.INDEX_MODULE + '.py':
+                shutil.copy(filename, self.typeinfoDir)
+        self.filename = TypeInfoIndex.Build(self.typeinfoDir)
+
+    def testCheckedInIndexIsCurrent(self):
+        with open(self.filename) as f:
+            built = f.read()
+        with open(os.path.join(pyVmomiDir,
+                               TypeInfoIndex.INDEX_MODULE + '.py')) as f:
+            checkedIn = f.read()
+        self.assertTrue(built == checkedIn,
+                        "_typeinfoindex.py is stale, regenerate it with "
+                        "python TypeInfoIndex.py")
+
+    def testStaleIndex(self):
+        index = LoadIndex(self.filename)
+        self.assertTrue(pyVmomi._is_typeinfo_index_current(
+            index, self.typeinfoDir, typeinfos))
+
+        # A change which keeps the size of the module
+        path = TypeInfoIndex.GetTypeInfoPath(self.typeinfoDir, 'core')
+        with open(path) as f:
+            source = f.read()
+        self.assertTrue('version1' in source)
+        with open(path, 'w') as f:
+            f.write(source.replace('version1', 'version9', 1))
+        self.assertEqual(os.path.getsize(path), index.sizes['core'])
+        self.assertFalse(pyVmomi._is_typeinfo_index_current(
+            index, self.typeinfoDir, typeinfos))
+
+        # A module which is removed
+        os.remove(path)
+        self.assertFalse(pyVmomi._is_typeinfo_index_current(
+            index, self.typeinfoDir, typeinfos))
+
+    def testOtherFormat(self):
+        index = LoadIndex(self.filename)
+        index.version = TypeInfoIndex.INDEX_VERSION - 1
+        self.assertFalse(pyVmomi._is_typeinfo_index_current(
+            index, self.typeinfoDir, typeinfos))
+
+
+if __name__ == '__main__':
+    unittest.main()
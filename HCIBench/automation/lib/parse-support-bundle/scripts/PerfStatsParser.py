@@ -28,27 +28,24 @@ import pyVmomi
 os.environ['VSAN_PYMO_SKIP_VC_CONN'] = '1'
 import vsanmgmtObjects
 import cmmds
+import sampleDecoder
+import metricCache
 import json
 import subprocess
 import StringIO
+import cStringIO
 import logging
-import uuid
 #from humbugRedis import HumbugRedisInstance as Redis
 
 import threading
 import Queue
+import multiprocessing
 from multiprocessing.pool import ThreadPool
 MAX_ITEMS = 4
-THREAD_RUNNING_TIME = 180 # thread will abort if running more than 3 mins
-gQueue = Queue.Queue(MAX_ITEMS)
-producer = ThreadPool(MAX_ITEMS)
-consumer = ThreadPool(MAX_ITEMS)
-producerLock = threading.Lock()
-consumerLock = threading.Lock()
-producerResult = []
-consumerResult = []
+# At most this many dump lines per worker are read ahead of the parse stage,
+# so the reader blocks instead of queueing the whole file in memory.
+PENDING_LINES_PER_WORKER = 2
 INFLUX_BATCH = 20000
-gEntities = []
 
 try:
    # try to avoid module' object has no attribute '_strptime' error
@@ -70,8 +67,131 @@ def chunks(l, n):
     for i in range(0, len(l), n):
         yield l[i:i + n]
 
+class SegmentReader(object):
+   """
+   File-like view of one line of a dump file, so that a segment can be
+   parsed straight from the file without reading the whole line first.
+   """
+   def __init__(self, fp):
+      self.fp = fp
+      self.done = False
+
+   def read(self, size=-1):
+      if self.done:
+         return ""
+      data = self.fp.readline(size if size > 0 else -1)
+      if not data or data.endswith("\n"):
+         self.done = True
+      return data
+
+def IterMetricCsv(source):
+   """
+   Incrementally parse a serialized VsanPerfEntityMetricCSV array and yield
+   its entries one at a time. Each entry is freed as soon as the caller
+   asks for the next one, so only one entity is held in memory.
+   """
+   depth = 0
+   root = None
+   for event, elem in ET.iterparse(source, events=('start', 'end')):
+      if event == 'start':
+         if root is None:
+            root = elem
+         depth += 1
+      else:
+         depth -= 1
+         if depth == 1:
+            yield elem
+            root.clear()
+
+def LoadCmmdsIndex(dumpPath, hostDiskMapFile=None):
+   if hostDiskMapFile:
+      with open(hostDiskMapFile) as data_file:
+         return cmmds.CmmdsIndex.build(json.load(data_file))
+   return cmmds.loadCmmdsIndexByDir(os.path.dirname(dumpPath))
+
+class ParsePipeline(object):
+   """
+   Parse and write stages of a single dump file.
+
+   Lines are parsed by a pool of producer threads, which hand finished
+   batches of data points to the consumer threads through a bounded queue.
+   Both handoffs block, so a slow writer throttles the parsers and a slow
+   parser throttles the reader.
+   """
+   _STOP = object()
+
+   def __init__(self, writeFn, numWorkers=MAX_ITEMS):
+      if numWorkers < 1:
+         raise ValueError("Invalid number of workers %s" % numWorkers)
+      self.writeFn = writeFn
+      self.numWorkers = numWorkers
+      self.queue = Queue.Queue(numWorkers)
+      self.lineSlots = threading.BoundedSemaphore(
+         numWorkers * PENDING_LINES_PER_WORKER)
+      self.lock = threading.Lock()
+      self.waitInProducer = 0
+      self.waitInConsumer = 0
+      self.producer = ThreadPool(numWorkers)
+      self.consumers = []
+      for i in range(numWorkers):
+         consumer = threading.Thread(target=self._Consume,
+                                     name="PerfStatsWriter-%d" % i)
+         consumer.daemon = True
+         consumer.start()
+         self.consumers.append(consumer)
+
+   def Submit(self, parseFn, *args):
+      """Run parseFn(*args) on a producer thread, blocking while the
+      parse stage is full."""
+      self.lineSlots.acquire()
+      try:
+         self.producer.apply_async(self._Produce, (parseFn, args))
+      except:
+         self.lineSlots.release()
+         raise
+
+   def _Produce(self, parseFn, args):
+      try:
+         parseFn(*args)
+      except Exception as e:
+         logging.exception("Parse stage failed: %s" % e)
+      finally:
+         self.lineSlots.release()
+
+   def Put(self, item):
+      """Hand a batch to the write stage, blocking while the queue is full."""
+      startWaitTime = time.time()
+      self.queue.put(item)
+      with self.lock:
+         self.waitInProducer += (time.time() - startWaitTime)
+
+   def _Consume(self):
+      while True:
+         startWaitTime = time.time()
+         item = self.queue.get()
+         with self.lock:
+            self.waitInConsumer += (time.time() - startWaitTime)
+         if item is self._STOP:
+            return
+         try:
+            self.writeFn(*item)
+         except Exception as e:
+            logging.exception("Write stage failed: %s" % e)
+         del item # clean memory
+
+   def Close(self):
+      """Wait for all submitted lines to be parsed and written, then stop
+      the worker threads."""
+      self.producer.close()
+      self.producer.join()
+      for _ in self.consumers:
+         self.queue.put(self._STOP)
+      for consumer in self.consumers:
+         consumer.join()
+
 class VSANPerfDumpParser:
-   def __init__(self, dumpPath, parser, hostDiskMapFile=None, redisKey=None):
+   def __init__(self, dumpPath, parser, hostDiskMapFile=None, redisKey=None,
+                numWorkers=MAX_ITEMS, newLayout=False, cmmdsIndex=None):
       self.dumpPath = dumpPath
       self.data=[]
       self.dataByTag = {}
@@ -80,10 +200,13 @@ class VSANPerfDumpParser:
          self.parser = parser
       else:
          raise Exception("Illegal parser %s" % parser)
-      self.dateFormat = "%Y-%m-%d %H:%M:%S"
-      self.timeStampCache = {}
-      self.cmmdsByUuid = None
-      self.newLayout = False
+      self.dateFormat = sampleDecoder.DATE_FORMAT
+      self.sampleDecoder = sampleDecoder.SampleDecoder(self.dateFormat)
+      # Shared by all the dump files of a bundle, loaded on Parse otherwise
+      self.cmmdsIndex = cmmdsIndex
+      # One measurement per entity type with all metrics as fields,
+      # instead of one measurement per metric with a single value field
+      self.newLayout = newLayout
 #      self.redis = Redis.instance()
       self.redisKey = redisKey
       self.entities = []
@@ -93,17 +216,20 @@ class VSANPerfDumpParser:
       self.waitQueueInConsumer = 0
       self.influxTime = 0
       self.fileNumLines = 0
+      self.readTime = 0
+      self.linesParsed = 0
+      self.entityRefIds = set()
+      self.numWorkers = numWorkers
+      self.pipeline = None
+      self.statsLock = threading.Lock()
+      # Records the parsed points, see metricCache.MetricCache
+      self.metricCache = None
 
    def Parse(self, writeFn):
       self.numSkipped = 0
       self.numValues = 0
-      dir = os.path.dirname(self.dumpPath)
-      if self.hostDiskMapFile:
-         with open(self.hostDiskMapFile) as data_file:
-            self.cmmdsByUuid = json.load(data_file)
-      else:
-         self.cmmdsByUuid = cmmds.parseCmmdsFileByDir(dir)
-      self.cmmdsCache = {'host': {}, 'disk': {}}
+      if self.cmmdsIndex is None:
+         self.cmmdsIndex = LoadCmmdsIndex(self.dumpPath, self.hostDiskMapFile)
       if self.parser == "SoapParser":
          try:
             self.ParseVmodlDumpFile(self.dumpPath, writeFn)
@@ -143,51 +269,71 @@ class VSANPerfDumpParser:
    def ParseVmodlDumpFile(self, dumpPath, writeFn):
       beginMarker = "--------------SOAP stats dump--------------\n"
       separationMarker = "--------------Stats Segment Separator--------------\n"
-      state = 0
-      vmodl = None
-      entities = []
       lineCount = 0
       self.fileNumLines = self.file_len(dumpPath)
-      with open(dumpPath, 'r') as fp:
-         for line in fp:
-            lineCount += 1
-            if line == beginMarker or line == separationMarker:
-               continue
-            try:
-               # consumer thread is launched inside producer thread
-               result = producer.apply_async(self.ParseXML, (line, writeFn, lineCount,))
-               producerResult.append(result)
-            except Exception as e:
-               logging.error("Failed to parse line \"%s\": %s" % (line, e))
+      self.pipeline = ParsePipeline(
+         lambda dataList, index: self.FlushBatchDataThreading(
+            writeFn, dataList, index),
+         self.numWorkers)
+
+      startTime = time.time()
+      try:
+         with open(dumpPath, 'r') as fp:
+            for line in fp:
+               lineCount += 1
+               if line == beginMarker or line == separationMarker:
+                  continue
+               try:
+                  self.pipeline.Submit(self.ParseXML, line, lineCount)
+               except Exception as e:
+                  logging.error("Failed to parse line %d: %s" % (lineCount, e))
+         self.readTime = time.time() - startTime
+      finally:
+         self.pipeline.Close()
+      self.waitQueueInProducer = self.pipeline.waitInProducer
+      self.waitQueueInConsumer = self.pipeline.waitInConsumer
       try:
-          [result.wait(THREAD_RUNNING_TIME) for result in producerResult]
-          [result.wait(THREAD_RUNNING_TIME) for result in consumerResult]
-          gQueue.put(self._ProcessEntities(gEntities, {}))
-          self.FlushBatchDataThreading(writeFn, self.fileNumLines)
+          entityPoints = self._ProcessEntities(self.entityRefIds, {})
+          if self.metricCache:
+             self.metricCache.AddLines(entityPoints)
+          self.FlushBatchDataThreading(writeFn, entityPoints, self.fileNumLines)
           logging.info("producer threads waitting time for having queue is not full %f" % self.waitQueueInProducer)
           logging.info("consumer threads waitting time for having queue is not empty %f" % self.waitQueueInConsumer)
+          self.LogThroughput(lineCount, time.time() - startTime)
       except Exception as e:
          logging.exception("Failed to parse entity: %s" % (e))
 
+   def LogThroughput(self, lineCount, elapsed):
+      def _rate(count, seconds):
+         return count / seconds if seconds > 0 else 0.0
+
+      logging.info("Read stage: %d lines in %.3fs (%.1f lines/s)" % (
+         lineCount, self.readTime, _rate(lineCount, self.readTime)))
+      # parsingTime is summed over all producer threads
+      logging.info("Parse stage: %d segments, %d points in %.3fs "
+                   "(%.1f lines/s, %.1f points/s)" % (
+         self.linesParsed, self.dataPointsNum, self.parsingTime,
+         _rate(self.linesParsed, self.parsingTime),
+         _rate(self.dataPointsNum, self.parsingTime)))
+      logging.info("Write stage: %d points in %.3fs (%.1f points/s)" % (
+         self.dataPointsNum, self.influxTime,
+         _rate(self.dataPointsNum, self.influxTime)))
+      logging.info("Pipeline: %d lines, %d points in %.3fs "
+                   "(%.1f lines/s, %.1f points/s)" % (
+         lineCount, self.dataPointsNum, elapsed,
+         _rate(lineCount, elapsed), _rate(self.dataPointsNum, elapsed)))
+
    def ResolveName(self, entityRefId):
-      if self.cmmdsByUuid is None:
+      if self.cmmdsIndex is None:
          colonIndex = entityRefId.index(':')
          entityType = entityRefId[:colonIndex]
          entityId = entityRefId[colonIndex+1:]
          return [(entityType, None, None, None, entityId)]
 
-      return cmmds.lookupEntityId(
-         entityRefId, self.cmmdsByUuid, self.cmmdsCache)
+      return self.cmmdsIndex.lookupEntityId(entityRefId)
 
    def _ProcessSampleInfo(self, sampleInfo):
-      if sampleInfo not in self.timeStampCache.keys():
-         dates = sampleInfo.split(',')
-         dates[:] = [ self.ConvertTimestamp(dt)
-                      for dt in dates
-                    ]
-         self.timeStampCache[sampleInfo] = dates
-      else:
-         dates = self.timeStampCache[sampleInfo]
+      epochs, dates = self.sampleDecoder.DecodeSampleInfo(sampleInfo)
       return dates
 
    # The space is a special char for influxdb, it need to be escaped or the influx will meet exception.
@@ -196,24 +342,32 @@ class VSANPerfDumpParser:
          return stringValue.replace(" ", "\ ")
       return stringValue
 
+   # Tags of the points of a resolved entity. In the old layout every metric
+   # is its own measurement and the entity type is a tag, in the new layout
+   # the entity type is the measurement and every metric is a field.
+   def _FormatTags(self, resolvedEntity, withEntityType):
+      entityType, hostName, entityName, extraKey, uuid = resolvedEntity
+      objKey = entityName or hostName
+      if extraKey:
+         objKey = extraKey
+      if not hostName:
+         tags = 'objKey=\"%s\",object=\"%s:%s\"' % (
+            uuid, entityType, uuid)
+      else:
+         tags = 'host=\"%s\",objKey=\"%s\",object=\"%s:%s-%s\"' \
+                % (hostName, objKey, hostName, entityType, entityName)
+      if withEntityType:
+         tags = 'entityType=\"%s\",%s' % (entityType, tags)
+      return tags
+
    # The data is grouped by tag, followed by timestamp.
    # This is ideal for insertion into influxDB, as we want all
    # metrics of a given entityType to have one row per timestamp.
    def _ProcessTaggedDataPoints(self):
-      for tag, tsVals in self.dataByTag.items():
-         (entityType, hostName, entityName) = tag
-
-         entityType = self._EscapeSpace(entityType)
-         hostName = self._EscapeSpace(hostName)
-         entityName = self._EscapeSpace(entityName)
-
-         objKey = entityName or hostName
-         measurement = entityType
-         if not hostName:
-            linePrefix = '%s,object=\"%s\" ' % (measurement, entityType)
-         else:
-            linePrefix = '%s,object=\"%s:%s-%s\",objKey=\"%s\" ' \
-                         % (measurement, hostName, entityType, entityName, objKey)
+      for resolvedEntity, tsVals in self.dataByTag.items():
+         resolvedEntity = tuple(self._EscapeSpace(v) for v in resolvedEntity)
+         linePrefix = '%s,%s' % (resolvedEntity[0],
+                                 self._FormatTags(resolvedEntity, False))
          for ts, valTuples in tsVals.items():
             vals = ",".join(["%s=%s" % (k, v) for k, v in valTuples])
             line = "%s %s %s" % (linePrefix, vals, ts)
@@ -221,15 +375,11 @@ class VSANPerfDumpParser:
       self.dataByTag = {}
 
    def ConvertPerfUuidFromCapacityDiskUuidIfSingleTier(self, originalUuid):
-      capacityInt = uuid.UUID(originalUuid).int
-      perfInt = capacityInt + 1
-      perfStr = hex(perfInt)[2:]
-      perfUuidStr = str(uuid.UUID(perfStr[0:-1])) # humbug use python2
-      logging.debug("If single tier, the perf uuid str for capacity uuid %s is %s", originalUuid, perfUuidStr)
-      if cmmds.isConvertedPerfUuidExisting(perfUuidStr, self.cmmdsByUuid):
-         return perfUuidStr
-      else:
+      # The perf tier uuid is only in CMMDS for single tier disks, otherwise
+      # the original uuid is returned
+      if self.cmmdsIndex is None:
          return originalUuid
+      return self.cmmdsIndex.lookupPerfUuid(originalUuid)
 
    def _HackForVsan2DiskAndDomSchedulerMetrics(self, metricLabel, entityRefId):
       LSOM2_IO_STATS_ENTITY_TYPES = (
@@ -331,13 +481,13 @@ class VSANPerfDumpParser:
 #         logInfo[entityType]['entities'].append(entityId)
 
       if self.newLayout:
-         tag = self.ResolveName(entityRefId)
-         self.dataByTag.setdefault(tag, {})
-         for ts, val in zip(dates, values.split(",")):
-            if val == "None" or val == "":
-               continue
-            self.dataByTag[tag].setdefault(ts, [])
-            self.dataByTag[tag][ts].append((metricLabel, val))
+         for resolvedEntity in self.ResolveName(entityRefId):
+            tsVals = self.dataByTag.setdefault(resolvedEntity, {})
+            for ts, val in zip(dates, values.split(",")):
+               if val == "None" or val == "":
+                  continue
+               tsVals.setdefault(ts, [])
+               tsVals[ts].append((self._EscapeSpace(metricLabel), val))
       else:
          resolvedEntityDetails = self.ResolveName(entityRefId)
          for resolvedEntity in resolvedEntityDetails:
@@ -372,14 +522,12 @@ class VSANPerfDumpParser:
                obj = entityType
             else:
                obj = "%s:%s-%s" % (hostName, entityType, entityValue)
-            if self.newLayout:
-               if hostName:
-                  cmd = "entities,host=\"%s\" value=\"foo\"" % (hostName)
+            # Both layouts share the entities measurement, dashboard
+            # templating looks up its host and object tags
+            if not hostName:
+               cmd = "entities,object=\"%s\" value=\"foo\"" % (entityType)
             else:
-               if not hostName:
-                  cmd = "entities,object=\"%s\" value=\"foo\"" % (entityType)
-               else:
-                  cmd = "entities,host=\"%s\",object=\"%s\" value=\"foo\"" % (hostName, obj)
+               cmd = "entities,host=\"%s\",object=\"%s\" value=\"foo\"" % (hostName, obj)
             entityInfo = {
                'obj': obj,
                'host': hostName,
@@ -387,9 +535,9 @@ class VSANPerfDumpParser:
                'val': entityValue,
                'diskUuid': uuid,
             }
-            if entityType == 'capacity-disk':
+            if entityType == 'capacity-disk' and self.cmmdsIndex is not None:
                diskUuid = e.split("|")[0].split(":")[1]
-               disk, host, parent = cmmds.lookupDisk(diskUuid, self.cmmdsByUuid, self.cmmdsCache)
+               disk, host, parent = self.cmmdsIndex.lookupDisk(diskUuid)
                if parent is not None:
                   parentObj = "%s:%s-%s" % (parent[1], 'cache-disk', parent[0])
                   entityInfo['parent'] = parentObj
@@ -401,97 +549,130 @@ class VSANPerfDumpParser:
 #              print cmd
       return dataList
 
-   def ParseXML(self, line, writeFn, lineIndex):
-      def _processEntityWithValue(dataList, dates, metricValue, entityRefId, entities):
+   def ParseXML(self, line, lineIndex):
+      for dataList in self.ParseSegment(line):
+         self.pipeline.Put((dataList, lineIndex))
+
+   def ParseSegment(self, segment):
+      """
+      Yield batches of InfluxDB line protocol points for one SOAP stats
+      segment of the dump, and record the entities seen in entityRefIds.
+      The segment is either the line itself or a file object positioned at
+      the start of the line.
+      """
+      def _iterSeries(dates, metricValue, entityRefId):
          for value in metricValue:
-            values = value[1].text.split(",")
-            # skip it when all values are None
-            if len(set(values).difference({"None", ""})) == 0:
+            valuesCsv = value[1].text
+            if not valuesCsv:
                continue
 
             newlabel, newRefId = \
                self._HackForVsan2DiskAndDomSchedulerMetrics(value[0][0].text,
                                                          entityRefId)
             # TODO: Remove this since it is hacking nanoseconds value
+            scale = None
             if 'lsom2-io-stats' in newRefId and newlabel in avgLatMetrics:
-               values = [str(int(val) * 1000) for val in values]                                                  
-            if newRefId not in entities:
-               resolvedEntityList = self.ResolveName(newRefId)
-               entities[newRefId] = resolvedEntityList
-            else:
-               resolvedEntityList = entities[newRefId]
-            for resolvedEntity in resolvedEntityList:
-               entityType, hostName, entityName, extraKey, uuid = resolvedEntity
-               objKey = entityName or hostName
-               if extraKey:
-                  objKey = extraKey
-               if not hostName:
-                  elementTemp = 'entityType=\"%s\",objKey=\"%s\",object=\"%s:%s\"' % (
-                  entityType, uuid, entityType, uuid)
-               else:
-                  elementTemp = 'entityType=\"%s\",host=\"%s\",objKey=\"%s\",object=\"%s:%s-%s\"' \
-                                % (entityType, hostName, objKey, hostName,
-                                   entityType, entityName)
-               label = newlabel
-
-               labelValues = ['%s,%s value=%s %s' % (label, elementTemp, val, ts)
-                              for ts, val in itertools.izip(dates, values)
-                              if val not in {"None", ""}]
-               # logging.info(labelValues[0])
-               dataList.extend(labelValues)
+               scale = 1000
+            indexes, values = self.sampleDecoder.DecodeValues(valuesCsv, scale)
+            # skip it when all values are None
+            if len(values) == 0:
+               continue
+            if indexes[-1] >= len(dates):
+               # more values than samples, drop the ones without a timestamp
+               values = [val for i, val in itertools.izip(indexes, values)
+                         if i < len(dates)]
+               indexes = indexes[:len(values)]
+            yield newlabel, newRefId, indexes, values
+
+      def _resolve(newRefId, entities):
+         if newRefId not in entities:
+            entities[newRefId] = self.ResolveName(newRefId)
+         return entities[newRefId]
+
+      def _processEntityWithValue(dataList, columns, epochs, dates, metricValue, entityRefId, entities):
+         for newlabel, newRefId, indexes, values in _iterSeries(
+               dates, metricValue, entityRefId):
+            for resolvedEntity in _resolve(newRefId, entities):
+               seriesPrefix = '%s,%s ' % (
+                  newlabel, self._FormatTags(resolvedEntity, True))
+               prefix = seriesPrefix + 'value='
+
+               dataList.extend([prefix + val + ' ' + dates[i]
+                                for i, val in itertools.izip(indexes, values)])
+               if columns is not None:
+                  columns.AddSeries(seriesPrefix, 'value', epochs, indexes, values)
+
+      def _processEntityWithFields(dataList, columns, epochs, dates, metricValue, entityRefId, entities):
+         # All metrics of an entity go into one row per timestamp. The hack
+         # for vsan2 metrics can move some of them to another entity.
+         rowsByRefId = {}
+         for newlabel, newRefId, indexes, values in _iterSeries(
+               dates, metricValue, entityRefId):
+            rows = rowsByRefId.setdefault(newRefId, {})
+            field = self._EscapeSpace(newlabel) + '='
+            for i, val in itertools.izip(indexes, values):
+               rows.setdefault(i, []).append(field + val)
+         for newRefId, rows in rowsByRefId.items():
+            points = sorted(rows.items())
+            for resolvedEntity in _resolve(newRefId, entities):
+               prefix = '%s,%s ' % (resolvedEntity[0],
+                                    self._FormatTags(resolvedEntity, False))
+               dataList.extend([prefix + ",".join(fields) + ' ' + dates[i]
+                                for i, fields in points])
+               if columns is not None:
+                  columns.AddPoints(prefix, epochs, points)
 
-      startWaitTime = time.time()
-      while gQueue.full():
-         time.sleep(0.1)
-      with producerLock:
-         self.waitQueueInProducer += (time.time() - startWaitTime)
+      if self.newLayout:
+         _processEntity = _processEntityWithFields
+      else:
+         _processEntity = _processEntityWithValue
 
       entities = {}
       dataList = []
+      columns = None
+      if self.metricCache is not None:
+         columns = metricCache.ColumnBatch()
       startTime = time.time()
-      xmlData = ET.fromstring(line)
+      if isinstance(segment, basestring):
+         segment = cStringIO.StringIO(segment)
+      else:
+         segment = SegmentReader(segment)
       try:
-         for metricCsv in xmlData:
+         for metricCsv in IterMetricCsv(segment):
             entityRefId = self._EscapeSpace(str(metricCsv[0].text))
             sampleInfo = metricCsv[1].text
             metricValue = metricCsv[2:]
-            if sampleInfo == "":
+            if not sampleInfo:
                # There were no samples collected, so skip this one
                continue
             try:
-               dates = self._ProcessSampleInfo(sampleInfo)
+               epochs, dates = self.sampleDecoder.DecodeSampleInfo(sampleInfo)
             except Exception as e:
                logging.exception("Failed to process sample info : %s" % (e))
 
 
-            _processEntityWithValue(dataList, dates, metricValue, entityRefId, entities)
+            _processEntity(dataList, columns, epochs, dates, metricValue,
+                           entityRefId, entities)
             if len(dataList) > INFLUX_BATCH * 2.0:
-               while gQueue.full():
-                  time.sleep(0.1)
-               gQueue.put(dataList)
+               if columns is not None:
+                  self.metricCache.Add(columns)
+                  columns = metricCache.ColumnBatch()
+               yield dataList
                dataList = [] # new dataList
-               # the matched consumer thread is launched
-               result = consumer.apply_async(self.FlushBatchDataThreading,
-                                             (writeFn, lineIndex,))
-               consumerResult.append(result)
 
       except:
          import traceback
          logging.info(traceback.format_exc())
-      gEntities.extend(list(entities.keys()))
 
-      startWaitTime = time.time()
-      with producerLock:
-         self.waitQueueInProducer += (time.time() - startWaitTime)
+      with self.statsLock:
+         self.entityRefIds.update(entities.keys())
+         self.linesParsed += 1
          self.parsingTime += (time.time() - startTime)
 
       if len(dataList) > 0:
-         while gQueue.full():
-            time.sleep(0.1)
-         gQueue.put(dataList)
-         # the matched consumer thread is launched
-         result = consumer.apply_async(self.FlushBatchDataThreading, (writeFn, lineIndex,))
-         consumerResult.append(result)
+         if columns is not None:
+            self.metricCache.Add(columns)
+         yield dataList
 
    def ParseVmodl(self, vmodl):
       logInfo = {}
@@ -571,26 +752,18 @@ class VSANPerfDumpParser:
       self._ProcessTaggedDataPoints()
       return self.data
 
-   def FlushBatchDataThreading(self, writeFn, index):
-      startWaitTime = time.time()
-      while gQueue.empty():
-         time.sleep(0.1)
-      with consumerLock:
-         self.waitQueueInConsumer += (time.time() - startWaitTime)
-
-      # checking queue is not empty
+   def FlushBatchDataThreading(self, writeFn, dataList, index):
       startTime = time.time()
-      dataList = gQueue.get()
-
-      self.dataPointsNum += len(dataList)
+      with self.statsLock:
+         self.dataPointsNum += len(dataList)
+         dataPointsNum = self.dataPointsNum
       if len(dataList) == 0:
          logging.info("Processing %s/%s lines for dataList len %d" % (index, self.fileNumLines, len(dataList)))
       progress = "Processing %s/%s lines, batching dataPoints %s" % (
-      index, self.fileNumLines, self.dataPointsNum)
+      index, self.fileNumLines, dataPointsNum)
       writeFn(dataList, progress)
 
-      del dataList # clean memory
-      with consumerLock:
+      with self.statsLock:
          self.influxTime += (time.time() - startTime)
 
       logging.info("The elapsed time for processing data %f and influxDb %f" % (
@@ -599,6 +772,8 @@ class VSANPerfDumpParser:
    def FlushBatchData(self, writeFn, minDataPoints = 0):
       self._ProcessTaggedDataPoints()
       if len(self.data) > minDataPoints:
+         if self.metricCache:
+            self.metricCache.AddLines(self.data)
          writeFn(self.data)
          self.dataPointsNum += len(self.data)
          self.data = []
@@ -608,7 +783,7 @@ class VSANPerfDumpParser:
 
 
    def PrintCacheSize(self):
-      print(len(self.timeStampCache))
+      print(len(self.sampleDecoder))
 
    def ParseText(self, path):
       # Nested function to parse
@@ -649,6 +824,136 @@ class VSANPerfDumpParser:
 
 #      self.PrintCacheSize()
 
+# Parser of the current worker process, see ParseVmodlDumpFilesInProcesses
+_segmentParser = None
+
+def _InitSegmentWorker(cmmdsIndex, newLayout, recordColumns, redisKey=None):
+   global _segmentParser
+   # The index is inherited from the parent when the worker is forked
+   _segmentParser = VSANPerfDumpParser(None, "SoapParser", redisKey=redisKey,
+                                       newLayout=newLayout,
+                                       cmmdsIndex=cmmdsIndex)
+   _segmentParser.dumpFiles = {}
+   # Whether the points of each dump file are sent back as columns too
+   _segmentParser.recordColumns = recordColumns
+
+def _ParseSegmentInWorker(task):
+   fileIndex, dumpPath, offset, lineIndex = task
+   parser = _segmentParser
+   fp = parser.dumpFiles.get(dumpPath)
+   if fp is None:
+      fp = parser.dumpFiles[dumpPath] = open(dumpPath, 'r')
+   fp.seek(offset)
+   parser.entityRefIds = set()
+   parser.metricCache = None
+   if parser.recordColumns[fileIndex]:
+      parser.metricCache = metricCache.ColumnCollector()
+   batches = []
+   try:
+      for dataList in parser.ParseSegment(fp):
+         batches.append(dataList)
+   except Exception as e:
+      logging.exception("Failed to parse line %d of %s: %s" % (lineIndex, dumpPath, e))
+   columns = parser.metricCache.batches if parser.metricCache else []
+   return fileIndex, lineIndex, batches, columns, parser.entityRefIds
+
+def _IterSegments(dumpPaths, segmentSlots):
+   beginMarker = "--------------SOAP stats dump--------------\n"
+   separationMarker = "--------------Stats Segment Separator--------------\n"
+   for fileIndex, dumpPath in enumerate(dumpPaths):
+      lineIndex = 0
+      with open(dumpPath, 'r') as fp:
+         while True:
+            offset = fp.tell()
+            line = fp.readline()
+            if not line:
+               break
+            lineIndex += 1
+            if line == beginMarker or line == separationMarker:
+               continue
+            segmentSlots.acquire()
+            yield fileIndex, dumpPath, offset, lineIndex
+
+def ParseVmodlDumpFilesInProcesses(dumpPaths, writeFn, hostDiskMapFile=None,
+                                   numProcesses=None, newLayout=False,
+                                   cmmdsIndex=None, metricCaches=None,
+                                   redisKey=None, numWriters=MAX_ITEMS):
+   """
+   Parse SOAP dump files with a pool of worker processes.
+
+   Every segment (line) of every file is parsed by a worker process into
+   finished line protocol batches, which numWriters threads of this
+   process hand to writeFn concurrently. The CMMDS index is loaded once, before the pool is forked, and
+   shared read-only with the workers. The points of each file are recorded
+   into its cache of metricCaches, if given. Returns one parser per dump
+   file with its entities resolved.
+   """
+   numProcesses = numProcesses or multiprocessing.cpu_count()
+   if cmmdsIndex is None:
+      cmmdsIndex = LoadCmmdsIndex(dumpPaths[0], hostDiskMapFile)
+   parsers = []
+   for i, dumpPath in enumerate(dumpPaths):
+      parser = VSANPerfDumpParser(dumpPath, "SoapParser", hostDiskMapFile,
+                                  redisKey, newLayout=newLayout,
+                                  cmmdsIndex=cmmdsIndex)
+      if metricCaches:
+         parser.metricCache = metricCaches[i]
+      parser.numSkipped = 0
+      parser.numValues = 0
+      parser.fileNumLines = parser.file_len(dumpPath)
+      parsers.append(parser)
+
+   # Segments handed to the pool but not yet written back hold a slot, so
+   # parsed batches cannot pile up when writing is slower than parsing.
+   segmentSlots = threading.Semaphore(numProcesses * PENDING_LINES_PER_WORKER)
+   # Only the write stage of the pipeline is used, the batches come parsed
+   writeStage = ParsePipeline(
+      lambda parser, dataList, index: parser.FlushBatchDataThreading(
+         writeFn, dataList, index),
+      numWriters)
+   startTime = time.time()
+   pool = multiprocessing.Pool(numProcesses, _InitSegmentWorker,
+                               (cmmdsIndex, newLayout,
+                                [parser.metricCache is not None
+                                 for parser in parsers], redisKey))
+   try:
+      for fileIndex, lineIndex, batches, columns, entityRefIds in pool.imap_unordered(
+            _ParseSegmentInWorker, _IterSegments(dumpPaths, segmentSlots)):
+         parser = parsers[fileIndex]
+         parser.linesParsed += 1
+         parser.entityRefIds.update(entityRefIds)
+         for batch in columns:
+            parser.metricCache.Add(batch)
+         for dataList in batches:
+            writeStage.Put((parser, dataList, lineIndex))
+         del batches # clean memory
+         segmentSlots.release()
+      pool.close()
+   except:
+      # Unblock the task feeder so that the pool can be torn down
+      segmentSlots.release()
+      pool.terminate()
+      raise
+   finally:
+      pool.join()
+      writeStage.Close()
+
+   for parser in parsers:
+      entityPoints = parser._ProcessEntities(parser.entityRefIds, {})
+      if parser.metricCache:
+         parser.metricCache.AddLines(entityPoints)
+      parser.FlushBatchDataThreading(writeFn, entityPoints, parser.fileNumLines)
+
+   elapsed = time.time() - startTime
+   linesParsed = sum(parser.linesParsed for parser in parsers)
+   dataPointsNum = sum(parser.dataPointsNum for parser in parsers)
+   logging.info("Parsed %d segments of %d files with %d processes, "
+                "%d points in %.3fs (%.1f lines/s, %.1f points/s)" % (
+      linesParsed, len(dumpPaths), numProcesses, dataPointsNum, elapsed,
+      linesParsed / elapsed if elapsed > 0 else 0.0,
+      dataPointsNum / elapsed if elapsed > 0 else 0.0))
+   return parsers
+
 def main():
    parser = VSANPerfDumpParser("testData/python_usrlibvmwarevsanperfsvcvsan-perfsvc-statuspyc-perf_stats_with_dump.txt", "SoapParser");
    batchData = parser.Parse(None)
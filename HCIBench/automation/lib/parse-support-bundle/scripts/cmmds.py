@@ -1,6 +1,14 @@
+import ast
 import json
 import os
 import logging
+import re
+import uuid as uuidlib
+
+INDEX_FILE_NAME = 'cmmds-index.json'
+INDEX_VERSION = 1
+DISK_TYPES = ('DISK', 'DISK_CAPACITY_TIER', 'DISK_PERF_TIER')
+NO_DISK = (None, None, None)
 
 def parseCmmdsFileByDir(dirname):
    filename = os.path.join(dirname, 'cmmds-tool_find--f-python.txt')
@@ -8,95 +16,295 @@ def parseCmmdsFileByDir(dirname):
       return None
    return parseCmmdsFile(filename)
 
+#Only these CMMDS entry types are needed to resolve the perf stats entities
+KEEP_TYPES = ('HOSTNAME', 'CMMDS_GARBAGE_COLLECTION_TTL')
+KEEP_TYPE_PREFIXES = ('DISK',)
+CHUNK_SIZE = 1 << 20
+
+# Everything up to the next brace, skipping whole string literals, so that
+# braces in strings are ignored. The match stops before an unterminated
+# string, when the rest of it has not been read yet.
+_SKIP_RE = re.compile(r'''(?:[^"'{}]+|"[^"\\]*(?:\\.[^"\\]*)*"|'[^'\\]*(?:\\.[^'\\]*)*')*''')
+_TYPE_RE = re.compile(r'''["']type["']\s*:\s*["']([^"']*)["']''')
+
+def isKeptEntryType(entryType):
+   return entryType in KEEP_TYPES or entryType.startswith(KEEP_TYPE_PREFIXES)
+
+def _encodeStr(value):
+   if isinstance(value, unicode):
+      return value.encode('utf-8')
+   if isinstance(value, list):
+      return [_encodeStr(item) for item in value]
+   return value
+
+def _encodeStrPairs(pairs):
+   # json returns unicode strings, where eval() of the dump returned str
+   return dict((_encodeStr(key), _encodeStr(value)) for key, value in pairs)
+
+def _parseEntry(text):
+   try:
+      return json.loads(text, object_pairs_hook=_encodeStrPairs)
+   except ValueError:
+      # Python literals (None, True, single quotes) are not valid JSON
+      return ast.literal_eval(text)
+
+#Parse the python literal output of `cmmds-tool find -f python` from the file
+#object `fp`, and yield its entries one at a time. Only entries for which
+#keep(type) is true are parsed, the others are skipped while scanning. The
+#counts of parsed, skipped and invalid entries are added to `stats`, and
+#stats['truncated'] is set if the file ends within an entry.
+def iterCmmdsEntries(fp, keep=isKeptEntryType, stats=None):
+   if stats is None:
+      stats = {}
+   for key in ('parsed', 'skipped', 'invalid'):
+      stats.setdefault(key, 0)
+   stats['truncated'] = False
+   buf = ''
+   pos = 0
+   start = None # start of the current entry in buf
+   depth = 0
+   eof = False
+   while True:
+      pos = _SKIP_RE.match(buf, pos).end()
+      if pos == len(buf) or buf[pos] in '"\'':
+         # Need more data, either to find the next brace or to complete a
+         # string literal
+         if eof:
+            if start is not None:
+               stats['truncated'] = True
+            return
+         # Keep the current entry, and rescan from the unterminated string
+         keepFrom = pos if start is None else start
+         buf = buf[keepFrom:]
+         pos -= keepFrom
+         if start is not None:
+            start = 0
+         chunk = fp.read(CHUNK_SIZE)
+         if not chunk:
+            eof = True
+         buf += chunk
+         continue
+
+      token = buf[pos]
+      pos += 1
+      if token == '{':
+         if depth == 0:
+            start = pos - 1
+         depth += 1
+      elif token == '}' and depth > 0:
+         depth -= 1
+         if depth == 0:
+            text = buf[start:pos]
+            start = None
+            entryTypes = _TYPE_RE.findall(text)
+            if entryTypes and not any(keep(t) for t in entryTypes):
+               stats['skipped'] += 1
+               continue
+            try:
+               entry = _parseEntry(text)
+               if 'uuid' not in entry or 'type' not in entry:
+                  raise ValueError("no uuid or type")
+               entryType = entry['type']
+            except Exception as e:
+               logging.warning("Skipping invalid CMMDS entry: %s" % e)
+               stats['invalid'] += 1
+               continue
+            if not keep(entryType):
+               stats['skipped'] += 1
+               continue
+            stats['parsed'] += 1
+            yield entry
+
 def parseCmmdsFile(filename):
    cmmdsByUuid = {}
-   esaDiskMap = {}
+   stats = {}
    try:
       with open(filename, 'r') as fp:
-         content = fp.read()
-         cmmds = None
-         try:
-            cmmds = eval(content)
-         except:
-            logging.exception("Parse original cmmds-tool_find--f-python.txt fail, try to parse the file as much as possible.")
-            if content.rfind("},\n]") < 0:
-               logging.info("File cmmds-tool_find--f-python is not complete")
-               index = content.rfind("},\n{")
-               if index > 0:
-                  content = content[0:index+2] + "]"
-            cmmds = eval(content)
-         if cmmds:
-            for e in cmmds:
-               cmmdsByUuid.setdefault(e['uuid'], {})
-               cmmdsByUuid[e['uuid']][e['type']] = e
+         for e in iterCmmdsEntries(fp, stats=stats):
+            cmmdsByUuid.setdefault(e['uuid'], {})
+            cmmdsByUuid[e['uuid']][e['type']] = e
    except:
       logging.exception("Parse cmmds-tool_find--f-python.txt failed.")
+   if stats.get('truncated'):
+      logging.info("File cmmds-tool_find--f-python is not complete, "
+                   "the last entry is ignored")
+   logging.info("Parsed %d entries of %s, skipped %d entries, %d invalid" % (
+      stats.get('parsed', 0), filename, stats.get('skipped', 0),
+      stats.get('invalid', 0)))
    logging.debug("cmmdsByUuid => %s", cmmdsByUuid)
    return cmmdsByUuid
 
-def isConvertedPerfUuidExisting(convertedPerfUuid, cmmdsByUuid):
-   # convertedPerfUuid should be in CMMDS and the type should be DISK_PERF_TIER,
-   # or it means this is not single tier, then directly return the original uuid 
-   entry = cmmdsByUuid.get(convertedPerfUuid)
-   return entry and 'DISK_PERF_TIER' in entry
-
-#Given a UUID, the intention of this method is to return a tuple t = (devName, host, parent)
-#where devName -> device name of the disk, host -> UUID of the host to which the disk
-#belongs. The argument cmmdsByUuid is expected to have this info about which disk
-#belongs to which host.
-def lookupDisk(uuid, cmmdsByUuid, cache):
-   if uuid in cache['disk']:
-      return cache['disk'][uuid]
-   # LSOM2 changes DISK entry to DISK_CAPACITY_TIER
-   entry = cmmdsByUuid.get(uuid, {}).get('DISK') or cmmdsByUuid.get(uuid, {}).get('DISK_CAPACITY_TIER') or cmmdsByUuid.get(uuid, {}).get('DISK_PERF_TIER')
-   if not entry:
-      return (None, None, None)
-   content = json.loads(entry['content'])
-   parent = None
-   if 'isSsd' in content and not content['isSsd'] and 'ssdUuid' in content:
-      parent = lookupDisk(content['ssdUuid'], cmmdsByUuid, cache)
-   host = lookupHostName(entry['owner'], cmmdsByUuid, cache)
-   if 'devName' in content:
-      out = ("%s-%s" % (content['devName'], uuid), host, parent)
-   else:
-      out = (uuid, host, parent)
-   cache['disk'][uuid] = out
-   return out
-
-#This method provides a readable, unique identifier for a host which is
-#identified by `uuid`. The argument cmmdsByUuid is expected to have this info
-#about what readable data can be returned. In case of support bundles, the
-#hosts hostname is returned, and for phonehome data, the host MOID is returned.
-def lookupHostName(uuid, cmmdsByUuid, cache):
-   if uuid in cache['host']:
-      return cache['host'][uuid]
-   entry = cmmdsByUuid.get(uuid, {}).get('HOSTNAME')
-   if entry:
-      content = json.loads(entry['content'])
-      out = content['hostname']
-      cache['host'][uuid] = out
-      return out
-   else:
-      entry = cmmdsByUuid.get(uuid, {}).get('CMMDS_GARBAGE_COLLECTION_TTL')
-      if not entry:
+
+#Build the entity resolution index of the bundle in `dirname`. The index is
+#saved next to the CMMDS dump, so that the dump is only parsed again when it
+#changes.
+def loadCmmdsIndexByDir(dirname):
+   filename = os.path.join(dirname, 'cmmds-tool_find--f-python.txt')
+   if not os.path.exists(filename):
+      return None
+   stat = os.stat(filename)
+   source = {'size': stat.st_size, 'mtime': stat.st_mtime}
+   indexFile = os.path.join(dirname, INDEX_FILE_NAME)
+   index = CmmdsIndex.load(indexFile, source)
+   if index is None:
+      index = CmmdsIndex.build(parseCmmdsFile(filename))
+      index.save(indexFile, source)
+   return index
+
+class CmmdsIndex(object):
+   """
+   Read-only index over the HOSTNAME and DISK* entries of CMMDS, to resolve
+   the entityRefIds of the perf stats.
+
+   Everything is resolved once when the index is built: host names, disk
+   names with their owner and cache-disk parent, and the perf-tier uuid of
+   each ESA capacity disk. Lookups are plain dict reads, and the index is
+   never modified afterwards, so one instance can be shared by all parse
+   threads and processes and by all the dump files of a bundle.
+   """
+
+   def __init__(self, hosts, disks, perfUuids):
+      # host uuid -> host name
+      self._hosts = hosts
+      # disk uuid -> (devName-uuid, host name, parent disk tuple or None)
+      self._disks = disks
+      # capacity disk uuid -> perf tier uuid, for single tier (ESA) disks
+      self._perfUuids = perfUuids
+
+   @classmethod
+   def build(cls, cmmdsByUuid):
+      cmmdsByUuid = cmmdsByUuid or {}
+      hosts = {}
+      for uuid, entries in cmmdsByUuid.items():
+         try:
+            if 'HOSTNAME' in entries:
+               content = json.loads(entries['HOSTNAME']['content'])
+               hosts[uuid] = content['hostname']
+            elif 'CMMDS_GARBAGE_COLLECTION_TTL' in entries:
+               hosts[uuid] = 'hostUuid_' + str(uuid)
+         except Exception as e:
+            logging.exception("Failed to index host name for UUID %s: %s" % (uuid, e))
+
+      # (devName-uuid, host name, ssdUuid) of every disk, the parents are
+      # resolved once all disks are known
+      diskInfo = {}
+      perfUuids = {}
+      for uuid, entries in cmmdsByUuid.items():
+         # LSOM2 changes DISK entry to DISK_CAPACITY_TIER
+         entry = None
+         for diskType in DISK_TYPES:
+            entry = entries.get(diskType)
+            if entry:
+               break
+         if not entry:
+            continue
+         try:
+            content = json.loads(entry['content'])
+            ssdUuid = None
+            if 'isSsd' in content and not content['isSsd'] and 'ssdUuid' in content:
+               ssdUuid = content['ssdUuid']
+            if 'devName' in content:
+               name = "%s-%s" % (content['devName'], uuid)
+            else:
+               name = uuid
+            diskInfo[uuid] = (name, hosts.get(entry['owner']), ssdUuid)
+         except Exception as e:
+            logging.exception("Failed to index disk for UUID %s: %s" % (uuid, e))
+            continue
+         if 'DISK_PERF_TIER' in entries:
+            # The perf tier uuid of a single tier disk is its capacity
+            # tier uuid plus one
+            try:
+               capacityUuid = str(uuidlib.UUID(int=uuidlib.UUID(uuid).int - 1))
+               perfUuids[capacityUuid] = uuid
+            except ValueError:
+               pass
+
+      disks = {}
+      def _resolve(uuid, visiting):
+         if uuid in disks:
+            return disks[uuid]
+         if uuid not in diskInfo or uuid in visiting:
+            return NO_DISK
+         visiting.add(uuid)
+         name, host, ssdUuid = diskInfo[uuid]
+         parent = _resolve(ssdUuid, visiting) if ssdUuid else None
+         disks[uuid] = (name, host, parent)
+         return disks[uuid]
+
+      for uuid in diskInfo:
+         _resolve(uuid, set())
+      logging.info("Indexed %d hosts and %d disks from CMMDS" % (len(hosts), len(disks)))
+      return cls(hosts, disks, perfUuids)
+
+   @classmethod
+   def load(cls, filename, source=None):
+      """
+      Load an index saved by save(), or return None if there is none or it
+      was built from another source than `source`.
+      """
+      if not os.path.exists(filename):
          return None
-      cache['host'][uuid] = 'hostUuid_' + str(uuid)
-      return cache['host'][uuid]
-
-# Example UUIDs:
-   # host-memory-heap:5890dccc-3598-ee3a-df0a-020026e21a4a|dom-Client-heap-0x431038f03000
-   # host-domclient:5890dccc-3598-ee3a-df0a-020026e21a4a
-   # host-domcompmgr:5890dccc-3598-ee3a-df0a-020026e21a4a
-# @Return: (entityType - cache-disk, capacity-disk, host-memory-heap, etc
-#           host       - host name (None if host name is not found)
-#           entityValue - the ID of entity (in case of disk, the uuid of disk)
-#          )
-
-def lookupEntityId(entityRefId, cmmdsByUuid, cache):
-   entityValue = ""
-   extraKey = None
-   logging.debug("query uuid to be processed: %s" % (entityRefId))
-   try:
+      try:
+         with open(filename, 'r') as fp:
+            data = json.load(fp, object_pairs_hook=_encodeStrPairs)
+         if data.get('version') != INDEX_VERSION or data.get('source') != source:
+            logging.info("CMMDS index %s is out of date" % filename)
+            return None
+
+         def _disk(value):
+            if value is None:
+               return None
+            name, host, parent = value
+            return (name, host, _disk(parent))
+
+         disks = dict((uuid, _disk(disk)) for uuid, disk in data['disks'].items())
+         return cls(data['hosts'], disks, data['perfUuids'])
+      except Exception as e:
+         logging.warning("Failed to load CMMDS index %s: %s" % (filename, e))
+         return None
+
+   def save(self, filename, source=None):
+      try:
+         with open(filename, 'w') as fp:
+            json.dump({
+               'version': INDEX_VERSION,
+               'source': source,
+               'hosts': self._hosts,
+               'disks': self._disks,
+               'perfUuids': self._perfUuids,
+            }, fp)
+      except (IOError, OSError) as e:
+         logging.warning("Failed to save CMMDS index %s: %s" % (filename, e))
+
+   #This method provides a readable, unique identifier for a host which is
+   #identified by `uuid`. In case of support bundles, the hosts hostname is
+   #returned, and for phonehome data, the host MOID is returned.
+   def lookupHostName(self, uuid):
+      return self._hosts.get(uuid)
+
+   #Given a UUID, return a tuple t = (devName, host, parent) where devName ->
+   #device name of the disk, host -> name of the host to which the disk
+   #belongs, parent -> the tuple of its cache disk.
+   def lookupDisk(self, uuid):
+      return self._disks.get(uuid, NO_DISK)
+
+   #Return the perf tier uuid of a capacity disk if the disk is single tier,
+   #or the original uuid.
+   def lookupPerfUuid(self, capacityUuid):
+      return self._perfUuids.get(capacityUuid, capacityUuid)
+
+   # Example UUIDs:
+      # host-memory-heap:5890dccc-3598-ee3a-df0a-020026e21a4a|dom-Client-heap-0x431038f03000
+      # host-domclient:5890dccc-3598-ee3a-df0a-020026e21a4a
+      # host-domcompmgr:5890dccc-3598-ee3a-df0a-020026e21a4a
+   # @Return: (entityType - cache-disk, capacity-disk, host-memory-heap, etc
+   #           host       - host name (None if host name is not found)
+   #           entityValue - the ID of entity (in case of disk, the uuid of disk)
+   #          )
+   def lookupEntityId(self, entityRefId):
+      entityValue = ""
+      extraKey = None
       entityType, nodeId = entityRefId.split(":", 1)
       nodeIdParts = nodeId.split("|")
       uuid = nodeIdParts[0]
@@ -108,21 +316,14 @@ def lookupEntityId(entityRefId, cmmdsByUuid, cache):
       #populate any cluster entities.
       if entityType.startswith('cluster-'):
          return [(entityType, "cluster-%s" % uuid, "", extraKey, uuid)]
-   except Exception as e:
-      logging.exception("Failed to split UUID: %s" % (uuid))
-   try:
-      host = lookupHostName(uuid, cmmdsByUuid, cache)
+
+      host = self._hosts.get(uuid)
       if host:
-         logging.debug("Found host only -- %s, %s, %s." % (entityType, host, entityValue))
          return [(entityType, host, entityValue, extraKey, uuid)]
-   except Exception as e:
-      logging.exception("Failed to lookup host name for UUID %s: %s" % (uuid, e))
 
-   try:
-      disk, host, parent = lookupDisk(uuid, cmmdsByUuid, cache)
-      entityDetails = []
+      disk, host, parent = self._disks.get(uuid, NO_DISK)
       if disk:
-         logging.debug("Found disk only -- %s, %s, %s." % (entityType, host, disk))
+         entityDetails = []
          if "splinterdb" in entityType:
             entityValue = "%s" % "-".join(nodeIdParts)
             entityDetails.append((entityType, host, entityValue, None, None))
@@ -131,12 +332,9 @@ def lookupEntityId(entityRefId, cmmdsByUuid, cache):
 
          entityDetails.append((entityType, host, disk, extraKey, uuid))
          return entityDetails
-   except Exception as e:
-      logging.exception("Failed to lookup disk name for UUID %s: %s" % (uuid, e))
-
-   logging.debug("Found no useful info: %s" % entityRefId)
-   # If the metrics not host or disk, it will direct show entity type and uuid.
-   # For world id info, we need combine show the worlds from one host together
-   if 'world' in entityType.lower():
-      return [(entityType, uuid, entityRefId, extraKey, None)]
-   return [(entityType, nodeId, entityRefId, extraKey, None)]
+
+      # If the metrics not host or disk, it will direct show entity type and uuid.
+      # For world id info, we need combine show the worlds from one host together
+      if 'world' in entityType.lower():
+         return [(entityType, uuid, entityRefId, extraKey, None)]
+      return [(entityType, nodeId, entityRefId, extraKey, None)]
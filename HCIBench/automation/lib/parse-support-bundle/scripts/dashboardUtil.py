@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 
-import copy
 import hashlib
 import json
 import logging
@@ -9,6 +8,107 @@ import traceback
 from dashTemplatePatch import getDashboardPatch
 
 
+def _compileCopier(obj, exclude=()):
+   """
+   Return a function building a deep copy of the JSON value obj, without
+   the keys in exclude if obj is a dict. The structure of obj is walked once
+   here rather than by copy.deepcopy for every copy.
+   """
+   if isinstance(obj, dict):
+      static = {}
+      builders = []
+      for key, value in obj.iteritems():
+         if key in exclude:
+            continue
+         if isinstance(value, (dict, list)):
+            builders.append((key, _compileCopier(value)))
+         else:
+            static[key] = value
+      if not builders:
+         return static.copy
+      def copyDict():
+         d = static.copy()
+         for key, build in builders:
+            d[key] = build()
+         return d
+      return copyDict
+   if isinstance(obj, list):
+      items = list(obj)
+      if not any(isinstance(value, (dict, list)) for value in items):
+         return lambda: list(items)
+      builders = [_compileCopier(value) for value in items]
+      return lambda: [build() for build in builders]
+   return lambda: obj
+
+
+class _DashboardTemplate(object):
+   """
+   Builders of new dashboards, rows, panels and targets, compiled from a
+   dashboard template whose first row holds the panel template
+   """
+
+   def __init__(self, db):
+      row = db['rows'][0]
+      panel = row['panels'][0]
+      self.numRows = len(db['rows'])
+      self.panelId = panel['id']
+      # The rows, panels and targets are always rebuilt
+      self.newDashboard = _compileCopier(db, exclude=('rows',))
+      self.newRow = _compileCopier(row, exclude=('panels',))
+      self.newFullRow = _compileCopier(row)
+      self.newPanel = _compileCopier(panel, exclude=('targets',))
+      self.newTarget = _compileCopier(panel['targets'][0])
+
+
+class _EntityIndex(object):
+   """
+   Entities by type, and the lookups of DashboardGenerator._getCurrentEntity
+   by type and obj or diskUuid
+   """
+
+   def __init__(self, entities):
+      self.entities = entities
+      # type -> distinct objs, in the order of entities
+      self.objsByType = {}
+      self.byTypeObj = {}
+      self.byTypeDiskUuid = {}
+      self.scans = {}
+      seen = set()
+      for e in entities:
+         key = (e['type'], e['obj'])
+         if key not in seen:
+            seen.add(key)
+            self.objsByType.setdefault(e['type'], []).append(e['obj'])
+         self.byTypeObj.setdefault(key, e)
+         if e.get('diskUuid'):
+            self.byTypeDiskUuid.setdefault((e['type'], e['diskUuid']), e)
+
+   def entitiesOfTypes(self, typeFilter):
+      """ Distinct (obj, type) of the entities whose type passes typeFilter """
+      return [(obj, entityType)
+              for entityType, objs in self.objsByType.iteritems()
+              if typeFilter(entityType) for obj in objs]
+
+   def find(self, entityType, entityObj='', entityDiskUuid=''):
+      """
+      Same as DashboardGenerator._getCurrentEntity, which does substring
+      matches, but an entity with exactly entityType and entityObj or
+      entityDiskUuid is looked up first
+      """
+      e = None
+      if entityObj and not entityDiskUuid:
+         e = self.byTypeObj.get((entityType, entityObj))
+      elif entityDiskUuid and not entityObj:
+         e = self.byTypeDiskUuid.get((entityType, entityDiskUuid))
+      if e is not None:
+         return e
+      key = (entityType, entityObj, entityDiskUuid)
+      if key not in self.scans:
+         self.scans[key] = DashboardGenerator._getCurrentEntity(
+            self.entities, entityType, entityObj, entityDiskUuid)
+      return self.scans[key]
+
+
 class DashboardGenerator:
    ENABLE_NEW_INFLUX_LAYOUT = False
    CURRENT_PATH = os.path.dirname(__file__)
@@ -110,10 +210,11 @@ class DashboardGenerator:
 
    def _createDasboardsWithoutRepeats(self, bundlePostfix, dashboards, origdb):
       dbs = []
+      template = _DashboardTemplate(origdb)
       for dbid, dbinfo in dashboards.iteritems():
          if dbinfo['repeat']:
             continue
-         db = copy.deepcopy(origdb)
+         db = template.newDashboard()
          # db['title'] = '%s %s' % (dbinfo['title'], postfix)
          db['title'] = '%s %s' % (dbinfo['title'], bundlePostfix)
          dbTag = dbinfo.get("tag")
@@ -126,11 +227,11 @@ class DashboardGenerator:
          db['timezone'] = 'utc'
          # Formats: µs, iops, short, Bps, KBps
          firstMetric = None
-         if len(db['rows']) != 1:
+         if template.numRows != 1:
             raise Exception("Template for non-repeating dashboards \
                              should have only one row. Currently: %d",
-                            len(db['rows']))
-         idx = db['rows'][0]['panels'][0]['id']
+                            template.numRows)
+         idx = template.panelId
          outputRows = [self._createTitleRow(dbinfo['title'], isNoRepeat=True)]
          for metricDetails in dbinfo['metrics']:
             if not isinstance(metricDetails, dict):
@@ -139,7 +240,7 @@ class DashboardGenerator:
                   'metrics': [metricDetails[0]],
                   'unit': metricDetails[1][0],
                }
-            row = copy.deepcopy(db['rows'][0])
+            row = template.newFullRow()
             row['title'] = metricDetails['title']
             panel = row['panels'][0]
             panel['id'] = idx
@@ -150,13 +251,14 @@ class DashboardGenerator:
                if tag['key'] == 'entityType':
                   tag['value'] = "/%s/" % (dbinfo['entityToShow'])
             if DashboardGenerator.ENABLE_NEW_INFLUX_LAYOUT:
-               # target.setdefault('alias', metricDetails['metrics'][0])
-               target['measurement'] = dbinfo['entityToShow']
+               # The entity type is the measurement, entityToShow is a
+               # pattern like the entityType tag match of the old layout
+               target['measurement'] = "/%s/" % (dbinfo['entityToShow'])
                target['select'][0][0]['params'][0] = metricDetails['metrics'][0]
                target['tags'] = [{
-                  'key': "object",
+                  'key': "host",
                   'operator': "=~",
-                  'value': "/^\"$host:%s-/" % (dbinfo['entityToShow'])
+                  'value': "/^$host$/"
                }]
             else:
                target['measurement'] = metricDetails['metrics'][0]
@@ -367,7 +469,8 @@ class DashboardGenerator:
              capDisks])
       return dbEntities
 
-   def _getCurrentEntity(self, entities, entityType, entityObj='', entityDiskUuid=''):
+   @staticmethod
+   def _getCurrentEntity(entities, entityType, entityObj='', entityDiskUuid=''):
       entitiesRequested = []
       for e in entities:
          if entityType in e['type']:
@@ -391,29 +494,27 @@ class DashboardGenerator:
 
    def _createDasboardsWithRepeats(self, bundle, bundlePostfix, dashboards, origdb, entities):
       dbs = []
+      template = _DashboardTemplate(origdb)
+      entityIndex = _EntityIndex(entities)
       for dbid, dbinfo in dashboards.iteritems():
          if not dbinfo['repeat']:
             continue
-         db = copy.deepcopy(origdb)
+         db = template.newDashboard()
 
          logging.info("entityToShow => %s" % dbinfo['entityToShow'])
-         if dbinfo['entityToShow'] == 'meta-disk-groups':
+         entityToShow = dbinfo['entityToShow']
+         if entityToShow == 'meta-disk-groups':
             dbEntities = self._diskGroupEntities(entities, dashboards)
-         elif dbinfo['entityToShow'] == 'upit':
-            dbEntities = [(e['obj'], e['type']) for e in entities
-                          if 'upit' in e['type'] and "cpu" not in e['type']]
-            dbEntities = [(e[0], e[1], dbinfo['metrics'], dbinfo['title'])
-                          for e in list(set(dbEntities))]
-         elif dbinfo['entityToShow'] == 'domclient':
-            dbEntities = [(e['obj'], e['type']) for e in entities
-                          if (dbinfo['entityToShow'] in ("%s-" % e['type']) and e['type']!='cluster-remotedomclient')]
-            dbEntities = [(e[0], e[1], dbinfo['metrics'], dbinfo['title'])
-                          for e in list(set(dbEntities))]
          else:
-            dbEntities = [(e['obj'], e['type']) for e in entities
-                          if dbinfo['entityToShow'] in ("%s-" % e['type'])]
+            if entityToShow == 'upit':
+               typeFilter = lambda t: 'upit' in t and "cpu" not in t
+            elif entityToShow == 'domclient':
+               typeFilter = lambda t: (entityToShow in ("%s-" % t) and
+                                       t != 'cluster-remotedomclient')
+            else:
+               typeFilter = lambda t: entityToShow in ("%s-" % t)
             dbEntities = [(e[0], e[1], dbinfo['metrics'], dbinfo['title'])
-                          for e in list(set(dbEntities))]
+                          for e in entityIndex.entitiesOfTypes(typeFilter)]
 
          # db['title'] = '%s %s' % (dbinfo['title'], postfix)
          db['title'] = '%s %s' % (dbinfo['title'], bundlePostfix)
@@ -427,7 +528,6 @@ class DashboardGenerator:
          db['timezone'] = 'utc'
          # Formats: µs, iops, short, Bps, KBps
          firstMetric = None
-         templateRow = db['rows'][0]
          db['rows'] = [
             self._createTitleRow(dbinfo['title'])
          ]
@@ -437,11 +537,11 @@ class DashboardGenerator:
          for entity, entityType, dbMetrics, dbTitle in dbEntities:
             if dbinfo['entityToShow'] != 'meta-disk-groups':
                dbinfo['entityType'] = entityType
-            row = copy.deepcopy(templateRow)
-            panelTemplate = row['panels'][0]
+            row = template.newRow()
             row['title'] = "Entity: %s" % entity
             row['panels'] = []
-            idx = panelTemplate['id']
+            idx = template.panelId
+            currentEntity = None
             for panelConf in dbMetrics:
                if not isinstance(panelConf, dict):
                   panelConf = {
@@ -451,16 +551,15 @@ class DashboardGenerator:
                   }
                if panelConf.get('detailOnly', False) == True:
                   continue
-               panel = copy.deepcopy(panelTemplate)
+               panel = template.newPanel()
                panel['id'] = idx
-               target = panel['targets'][0]
                panel['targets'] = []
                panel['seriesOverrides'] = []
                # metrics in the right Y-axis
                panelMetricsRY = panelConf.get('metrics_ry', [])
                for metric in panelConf['metrics'] + panelMetricsRY:
                   origMetric = metric
-                  newTarget = copy.deepcopy(target)
+                  newTarget = template.newTarget()
                   if type(metric) is tuple:
                      metricAlias = metric[1]
                      newTarget['alias'] = metricAlias
@@ -479,10 +578,10 @@ class DashboardGenerator:
                   panelEntityType = panelConf.get("entity")
                   requestedEntity = None
                   if panelEntityType:
-                     currentEntity = self._getCurrentEntity(entities, entityType, entity)
-                     currentEntityVal = currentEntity.get("val")
+                     if currentEntity is None:
+                        currentEntity = entityIndex.find(entityType, entity)
                      currentEntityDiskUuid = currentEntity.get("diskUuid")
-                     requestedEntity = self._getCurrentEntity(entities, panelEntityType, None, currentEntityDiskUuid)
+                     requestedEntity = entityIndex.find(panelEntityType, None, currentEntityDiskUuid)
 
                   panelGroup = panelConf.get("group", False)
                   if panelGroup:
@@ -497,13 +596,21 @@ class DashboardGenerator:
                      newTarget["alias"] = "$measurement : [[tag_objKey]]"
 
                   if DashboardGenerator.ENABLE_NEW_INFLUX_LAYOUT:
+                     panelEntity = entity
+                     panelEntityType = entityType
+                     if requestedEntity:
+                        panelEntity = requestedEntity.get("obj")
+                        panelEntityType = requestedEntity.get("type")
+                     if panelGroup:
+                        # $measurement is the entity type in this layout
+                        newTarget["alias"] = "%s : [[tag_objKey]]" % metric
                      newTarget.setdefault('alias', metric)
-                     newTarget['measurement'] = entityType
+                     newTarget['measurement'] = panelEntityType
                      newTarget['select'][0][0]['params'][0] = metric
                      newTarget['tags'][0] = {
                         'key': "object",
                         'operator': "=",
-                        'value': "\"%s\"" % entity
+                        'value': "\"%s\"" % panelEntity
                      }
                   else:
                      panelEntity = entity
@@ -686,14 +793,13 @@ class DashboardGenerator:
             continue
          if dbinfo['entityToShow'] == 'meta-disk-groups':
             continue
-         db = copy.deepcopy(origdb)
+         db = template.newDashboard()
          # db['title'] = '%s %s' % (dbinfo['title'], postfix)
          db['title'] = '%s Details %s' % (dbinfo['title'], bundlePostfix)
          db['timezone'] = 'utc'
          db['tags'] = []
          # Formats: µs, iops, short, Bps, KBps
-         rowTemplate = db['rows'][0]
-         idx = rowTemplate['panels'][0]['id']
+         idx = template.panelId
          db['rows'] = []
          db['rows'].append({
             "collapse": False,
@@ -717,12 +823,11 @@ class DashboardGenerator:
             "title": "New row"
          })
          for panelConf in dbinfo['metrics']:
-            panelTemplate = rowTemplate['panels'][0]
-            row = copy.deepcopy(rowTemplate)
+            row = template.newRow()
             row['panels'] = []
             row['title'] = ''
             row['repeat'] = None
-            panel = copy.deepcopy(panelTemplate)
+            panel = template.newPanel()
             panel['id'] = idx
             panel['points'] = True
             panel['pointradius'] = 2
@@ -735,7 +840,6 @@ class DashboardGenerator:
             panel['legend']['sideWidth'] = 500
             idx += 1
 
-            target = panel['targets'][0]
             if not isinstance(panelConf, dict):
                panelConf = {
                   'title': panelConf[0],
@@ -751,7 +855,7 @@ class DashboardGenerator:
 
             for metric in panelMetrics + panelMetricsRY:
                origMetric = metric
-               newTarget = copy.deepcopy(target)
+               newTarget = template.newTarget()
                if type(metric) is tuple:
                   metricAlias = metric[1]
                   newTarget['alias'] = metricAlias
@@ -778,8 +882,12 @@ class DashboardGenerator:
                      ]
                   newTarget["alias"] = "$measurement : [[tag_objKey]]"
                if DashboardGenerator.ENABLE_NEW_INFLUX_LAYOUT:
-                  newTarget['measurement'] = dbinfo.get('entityType',
-                                                        dbinfo['entityToShow'])
+                  # The selected object picks the series, any entity type
+                  # shown by the overview dashboard may be selected
+                  if panelGroup:
+                     newTarget["alias"] = "%s : [[tag_objKey]]" % metric
+                  newTarget.setdefault('alias', metric)
+                  newTarget['measurement'] = "/%s/" % (dbinfo['entityToShow'])
                   newTarget['select'][0][0]['params'][0] = metric
                   newTarget['tags'][0] = {
                      'key': "object",
@@ -1,17 +1,33 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import json
 import logging
+import Queue
+import threading
 import requests
 from dashboardUtil import DashboardGenerator
 
+# Dashboards imported concurrently by DashboardProvisioner
+NUM_PROVISION_THREADS = 8
+
 
 class GrafanaClient:
    CONTENT_TYPE_HEADER = {'content-type': 'application/json'}
+   # Tag recording the content hash of a dashboard, see DashboardProvisioner
+   CONTENT_HASH_TAG_PREFIX = 'content-'
 
    def __init__(self, host, port, user, password):
-      self.session = requests.Session()
       self.url = '%s:%u' % (host, port)
       self.authentication = (user, password)
+      # requests sessions are not thread-safe, keep one per thread
+      self.local = threading.local()
+
+   @property
+   def session(self):
+      session = getattr(self.local, 'session', None)
+      if session is None:
+         session = self.local.session = requests.Session()
+      return session
 
    def isNewGrafana(self):
       defaultVersion = '4.4.3'
@@ -48,17 +64,42 @@ class GrafanaClient:
          auth=self.authentication
       )
 
-   def _find_dashboard_uri(self, title):
+   def _find_dashboard(self, title):
       try:
-         response = self.session.get('%s/api/search?query=%s' % (self.url, title),
+         response = self.session.get('%s/api/search' % self.url,
+            params={'query': title},
             headers=GrafanaClient.CONTENT_TYPE_HEADER,
             auth=self.authentication
          )
 
          results = json.loads(response.content)
-         return results[0]['uri']
       except:
          return None
+      if not isinstance(results, list):
+         return None
+      # The search matches substrings of titles, prefer the exact title
+      for result in results:
+         if result.get('title') == title:
+            return result
+      return results[0] if results else None
+
+   def _find_dashboard_uri(self, title):
+      result = self._find_dashboard(title)
+      return result and result.get('uri')
+
+   def findDashboardContentHash(self, title):
+      """
+      Return (uri, contentHash) of the deployed dashboard named title, uri
+      is None if there is none. contentHash is None for dashboards not
+      created by provisionDashboard.
+      """
+      result = self._find_dashboard(title)
+      if not result or result.get('title') != title:
+         return None, None
+      for tag in result.get('tags') or []:
+         if tag.startswith(self.CONTENT_HASH_TAG_PREFIX):
+            return result.get('uri'), tag[len(self.CONTENT_HASH_TAG_PREFIX):]
+      return result.get('uri'), None
 
    def _delete_dashboard(self, uri):
       try:
@@ -80,7 +121,19 @@ class GrafanaClient:
 
    def createDashboard(self, dbDict):
       self._delete_dashboard_if_exists(dbDict['title'])
-      self._ImportDashboard(dbDict)
+      return self._ImportDashboard(dbDict)
+
+   def provisionDashboard(self, dbDict, contentHash, uri=None):
+      """
+      Replace the dashboard at uri, if any, by dbDict tagged with
+      contentHash, see findDashboardContentHash
+      """
+      if uri:
+         self._delete_dashboard(uri)
+      dbDict = dict(dbDict)
+      dbDict['tags'] = list(dbDict.get('tags') or []) + [
+         self.CONTENT_HASH_TAG_PREFIX + contentHash]
+      return self._ImportDashboard(dbDict)
 
    def _ImportDashboard(self, dbDict):
       body = {
@@ -103,5 +156,149 @@ class GrafanaClient:
 
       logging.info("Result of create dashboard %s: %d (%s)" % (dbDict['title'], resp.status_code, resp.text))
 
-      if resp.status_code / 100 != 2:
+      if resp.status_code // 100 != 2:
          logging.info("Failed to create dashboard %s: %d (%s)" % (dbDict['title'], resp.status_code, resp.text))
+         return False
+      return True
+
+
+def dashboardContentHash(dbDict):
+   """ Hash of the JSON content of a dashboard, independent of key order """
+   content = json.dumps(dbDict, sort_keys=True, separators=(',', ':'))
+   return hashlib.sha1(content.encode('utf-8')).hexdigest()[0:16]
+
+
+def dashboardDependencies(dbDict):
+   """ Titles of the dashboards the panels of a dashboard link to """
+   titles = set()
+   for row in dbDict.get('rows') or []:
+      for panel in row.get('panels') or []:
+         for link in panel.get('links') or []:
+            if link.get('type') == 'dashboard' and link.get('dashboard'):
+               titles.add(link['dashboard'])
+   return titles
+
+
+class DashboardProvisioner(object):
+   """
+   Imports a set of dashboards into Grafana.
+
+   Dashboards linking to other dashboards of the set are imported after
+   them, the others concurrently. A dashboard is tagged with the hash of its
+   content, and skipped when the deployed dashboard has the same hash.
+   """
+
+   def __init__(self, client, numThreads=NUM_PROVISION_THREADS):
+      if numThreads < 1:
+         raise ValueError("Invalid number of threads %s" % numThreads)
+      self.client = client
+      self.numThreads = numThreads
+
+   def _order(self, dbs):
+      """
+      Return {title: titles of the dashboards it depends on} and
+      {title: titles of the dashboards depending on it}
+      """
+      dependencies = {}
+      dependents = dict((db['title'], []) for db in dbs)
+      for db in dbs:
+         deps = dashboardDependencies(db) & set(dependents)
+         deps.discard(db['title'])
+         dependencies[db['title']] = deps
+         for dep in deps:
+            dependents[dep].append(db['title'])
+      return dependencies, dependents
+
+   def _findCycle(self, dependencies, blocked):
+      """
+      Return a title on a dependency cycle of the blocked titles, which all
+      depend on some other blocked title
+      """
+      title = min(blocked)
+      seen = set()
+      while title not in seen:
+         seen.add(title)
+         title = min(dep for dep in dependencies[title] if dep in blocked)
+      return title
+
+   def _provision(self, db):
+      contentHash = dashboardContentHash(db)
+      uri, deployedHash = self.client.findDashboardContentHash(db['title'])
+      if uri and deployedHash == contentHash:
+         return 'skipped'
+      if not self.client.provisionDashboard(db, contentHash, uri):
+         return 'failed'
+      return 'updated' if uri else 'created'
+
+   def provision(self, dbs):
+      """
+      Import dbs and return {'created'|'updated'|'skipped'|'failed': titles}
+      """
+      report = dict((result, []) for result in
+                    ('created', 'updated', 'skipped', 'failed'))
+      if not dbs:
+         return report
+      byTitle = dict((db['title'], db) for db in dbs)
+      dependencies, dependents = self._order(dbs)
+      pending = dict((title, len(deps))
+                     for title, deps in dependencies.items())
+      ready = Queue.Queue()
+      done = Queue.Queue()
+
+      def worker():
+         while True:
+            title = ready.get()
+            if title is None:
+               return
+            try:
+               result = self._provision(byTitle[title])
+            except Exception as e:
+               logging.error("Failed to create dashboard %s: %s" % (title, e))
+               result = 'failed'
+            done.put((title, result))
+
+      threads = []
+      for i in range(min(self.numThreads, len(byTitle))):
+         thread = threading.Thread(target=worker,
+                                   name="DashboardProvisioner-%d" % i)
+         thread.daemon = True
+         thread.start()
+         threads.append(thread)
+
+      queued = 0
+      for title in byTitle:
+         if pending[title] == 0:
+            ready.put(title)
+            queued += 1
+      finished = 0
+      while finished < len(byTitle):
+         if finished == queued:
+            # Dependency cycle, import one dashboard of the cycle first,
+            # the others still wait for the dashboards they link to
+            blocked = set(title for title in byTitle if pending[title] > 0)
+            title = self._findCycle(dependencies, blocked)
+            logging.warning("Dashboard links form a cycle, importing %s "
+                            "first" % title)
+            pending[title] = 0
+            ready.put(title)
+            queued += 1
+         title, result = done.get()
+         finished += 1
+         report[result].append(title)
+         # A failed dashboard is not retried, its dependents are imported
+         # with a dangling link as before
+         for dependent in dependents[title]:
+            pending[dependent] -= 1
+            if pending[dependent] == 0:
+               ready.put(dependent)
+               queued += 1
+
+      for thread in threads:
+         ready.put(None)
+      for thread in threads:
+         thread.join()
+      for result in sorted(report):
+         report[result].sort()
+         logging.info("Dashboards %s: %d %s" % (
+            result, len(report[result]), report[result]))
+      return report
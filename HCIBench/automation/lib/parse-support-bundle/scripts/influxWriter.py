@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2015-2022 VMware, Inc.  All rights reserved.
+-- VMware Confidential
+
+Concurrent InfluxDB line protocol writer.
+
+Points are cut into batches and posted gzip-encoded to the /write endpoint
+by a fixed set of sender threads, each keeping its own keep-alive session.
+The batch size follows the server latency, and batches rejected with 429
+or 503 (or lost to a connection error) are retried with jittered
+exponential backoff instead of being dropped.
+"""
+
+import logging
+import Queue
+import random
+import threading
+import time
+import zlib
+
+import requests
+
+BATCH_SIZE = 20000
+MIN_BATCH = 2000
+MAX_BATCH = 100000
+NUM_CONNECTIONS = 4
+TARGET_LATENCY = 1.0 # seconds per write request
+MAX_RETRIES = 8
+BACKOFF_BASE = 0.5 # seconds
+BACKOFF_MAX = 30 # seconds
+RETRY_STATUS_CODES = (429, 503)
+
+
+class InfluxWriter(object):
+   _STOP = object()
+
+   def __init__(self, url, database, numConnections=NUM_CONNECTIONS,
+                batchSize=BATCH_SIZE, minBatchSize=MIN_BATCH,
+                maxBatchSize=MAX_BATCH, targetLatency=TARGET_LATENCY,
+                maxRetries=MAX_RETRIES, backoffBase=BACKOFF_BASE,
+                backoffMax=BACKOFF_MAX, compress=True, timeout=60):
+      if numConnections < 1:
+         raise ValueError("Invalid number of connections %s" % numConnections)
+      self.writeUrl = "%s/write" % url
+      self.params = {'db': database, 'precision': 's'}
+      self.minBatchSize = minBatchSize
+      self.maxBatchSize = maxBatchSize
+      self.batchSize = max(minBatchSize, min(batchSize, maxBatchSize))
+      self.targetLatency = targetLatency
+      self.maxRetries = maxRetries
+      self.backoffBase = backoffBase
+      self.backoffMax = backoffMax
+      self.compress = compress
+      self.timeout = timeout
+
+      self.lock = threading.Lock()
+      self.startTime = time.time()
+      self.counters = {
+         'points': 0,
+         'batches': 0,
+         'requests': 0,
+         'bytesSent': 0,
+         'bytesRaw': 0,
+         'retries': 0,
+         'droppedPoints': 0,
+         'writeTime': 0.0,
+      }
+      # Each sender has at most one batch queued behind it, so callers of
+      # Write() block when InfluxDB falls behind.
+      self.queue = Queue.Queue(numConnections)
+      self.senders = []
+      for i in range(numConnections):
+         sender = threading.Thread(target=self._Send, name="InfluxWriter-%d" % i)
+         sender.daemon = True
+         sender.start()
+         self.senders.append(sender)
+
+   def Write(self, points):
+      """Queue points (line protocol strings) to be written."""
+      i = 0
+      while i < len(points):
+         batchSize = self.batchSize
+         self.queue.put(points[i:i + batchSize])
+         i += batchSize
+
+   def Flush(self):
+      """Block until every queued point has been written or dropped."""
+      self.queue.join()
+
+   def Close(self):
+      self.Flush()
+      for _ in self.senders:
+         self.queue.put(self._STOP)
+      for sender in self.senders:
+         sender.join()
+
+   def Stats(self):
+      with self.lock:
+         stats = dict(self.counters)
+      stats['elapsed'] = time.time() - self.startTime
+      stats['pointsPerSec'] = stats['points'] / stats['elapsed'] \
+                              if stats['elapsed'] > 0 else 0.0
+      stats['batchSize'] = self.batchSize
+      return stats
+
+   def LogStats(self):
+      stats = self.Stats()
+      logging.info("InfluxDB writer: %d points in %d batches (%.1f points/s), "
+                   "%d requests, %d retries, %d bytes sent (%d uncompressed), "
+                   "%d points dropped, batch size %d" % (
+         stats['points'], stats['batches'], stats['pointsPerSec'],
+         stats['requests'], stats['retries'], stats['bytesSent'],
+         stats['bytesRaw'], stats['droppedPoints'], stats['batchSize']))
+
+   def _Send(self):
+      session = requests.Session()
+      while True:
+         batch = self.queue.get()
+         try:
+            if batch is self._STOP:
+               return
+            self._WriteBatch(session, batch)
+         except Exception as e:
+            logging.exception("Failed to write batch data to influxDB: %s" % e)
+            self._Count(droppedPoints=len(batch))
+         finally:
+            self.queue.task_done()
+
+   def _Encode(self, batch):
+      body = "\n".join(batch)
+      if isinstance(body, unicode):
+         body = body.encode('utf-8')
+      rawSize = len(body)
+      headers = {'Content-Type': 'text/plain; charset=utf-8'}
+      if self.compress:
+         compressor = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+         body = compressor.compress(body) + compressor.flush()
+         headers['Content-Encoding'] = 'gzip'
+      return body, rawSize, headers
+
+   def _WriteBatch(self, session, batch):
+      body, rawSize, headers = self._Encode(batch)
+      attempt = 0
+      while True:
+         retryAfter = None
+         startTime = time.time()
+         try:
+            result = session.post(self.writeUrl, params=self.params, data=body,
+                                  headers=headers, timeout=self.timeout)
+            status = result.status_code
+         except requests.exceptions.RequestException as e:
+            result = None
+            status = None
+            logging.warning("Failed to write batch data to influxDB: %s" % e)
+         latency = time.time() - startTime
+         self._Count(requests=1, bytesSent=len(body), writeTime=latency)
+
+         if status is not None and status / 100 == 2: # Status code 2xx is success
+            self._Count(points=len(batch), batches=1, bytesRaw=rawSize)
+            self._AdaptBatchSize(latency)
+            return
+         if status is not None and status not in RETRY_STATUS_CODES:
+            # The data itself was rejected, sending it again will not help
+            logging.error("Failed to write batch data to influxDB : %d (%s)" % (status, result.text))
+            self._Count(droppedPoints=len(batch))
+            return
+         if attempt >= self.maxRetries:
+            logging.error("Giving up writing %d points to influxDB after %d retries" % (len(batch), attempt))
+            self._Count(droppedPoints=len(batch))
+            return
+
+         if status is not None:
+            self._ShrinkBatchSize()
+            retryAfter = result.headers.get('Retry-After')
+         attempt += 1
+         self._Count(retries=1)
+         delay = self._Backoff(attempt, retryAfter)
+         logging.info("InfluxDB write returned %s, retry %d in %.2fs" % (status, attempt, delay))
+         time.sleep(delay)
+
+   def _Backoff(self, attempt, retryAfter=None):
+      if retryAfter:
+         try:
+            return min(float(retryAfter), self.backoffMax)
+         except ValueError:
+            pass
+      # "Full jitter" exponential backoff
+      return random.uniform(0, min(self.backoffMax, self.backoffBase * 2 ** attempt))
+
+   def _AdaptBatchSize(self, latency):
+      with self.lock:
+         if latency < self.targetLatency / 2:
+            self.batchSize = min(self.maxBatchSize, int(self.batchSize * 1.5))
+         elif latency > self.targetLatency:
+            self.batchSize = max(self.minBatchSize, self.batchSize / 2)
+
+   def _ShrinkBatchSize(self):
+      with self.lock:
+         self.batchSize = max(self.minBatchSize, self.batchSize / 2)
+
+   def _Count(self, **counts):
+      with self.lock:
+         for name, count in counts.items():
+            self.counters[name] += count
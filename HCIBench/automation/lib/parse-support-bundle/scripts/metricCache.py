@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2015-2022 VMware, Inc.  All rights reserved.
+-- VMware Confidential
+
+Columnar cache of the data points parsed from a perf stats dump file.
+
+The points written to InfluxDB for a dump file are recorded as columns next
+to the dump: one row per point with its series (measurement and tags) and
+timestamp, and one row per field with its name and value. The columns are
+flat binary files, memory-mapped when the cache is loaded, and the series
+and field names are kept in text tables. The values are kept as the text
+they were parsed from, so that the points read back from the cache are
+exactly the ones written when parsing. Points that do not have the usual
+shape (the entities measurement) are kept verbatim.
+
+A cache is only used when the size, mtime and SHA-1 of the dump file, and
+the parse options, match the ones it was recorded with. NumPy is needed to
+record and load a cache, without it the dump is always parsed.
+"""
+
+import hashlib
+import itertools
+import json
+import logging
+import os
+import shutil
+import threading
+
+try:
+   import numpy
+except ImportError:
+   numpy = None
+
+CACHE_VERSION = 2
+CACHE_SUFFIX = '.metrics-cache'
+HASH_CHUNK_SIZE = 4 << 20
+# (column, dtype) of the per point and per field columns, the values of the
+# fields are in the text file VALUES_FILE
+POINT_COLUMNS = (('series', 'int32'), ('timestamp', 'int64'), ('numFields', 'int16'))
+FIELD_COLUMNS = (('field', 'int32'),)
+VALUES_FILE = 'values.txt'
+
+
+class ColumnBatch(object):
+   """
+   Points parsed from a segment of the dump file, to be recorded by
+   MetricCache.Add(). It can be pickled, to be recorded by another process
+   than the one that parsed the points.
+
+   The points come in runs of the same series. The timestamps are kept as
+   arrays of each run until Pack(), so that they are joined all at once.
+   """
+
+   def __init__(self):
+      # Per run: series prefix, field names, number of points, and the
+      # number of fields and field name indexes of every point (None when
+      # the points have a single field)
+      self.prefixes = []
+      self.fieldNames = []
+      self.numPoints = []
+      self.numFields = []
+      self.fieldIndexes = []
+      self.timestamps = []
+      self.values = []
+      self.packed = False
+
+   def AddSeries(self, prefix, field, epochs, indexes, values):
+      """
+      Points with the single field `field`, at epochs[indexes]. The values
+      are line protocol strings.
+      """
+      if len(indexes) == len(epochs):
+         timestamps = epochs
+      else:
+         timestamps = numpy.asarray(epochs)[indexes]
+      self._AddRun(prefix, (field,), timestamps, None, None, values)
+
+   def AddPoints(self, prefix, epochs, points):
+      """
+      Points with several fields, as (index, ['field=value', ...]) in
+      points, at epochs[index].
+      """
+      fields = {}
+      fieldIndexes = []
+      values = []
+      for _, pointFields in points:
+         for field in pointFields:
+            name, _, value = field.rpartition('=')
+            fieldIndexes.append(fields.setdefault(name, len(fields)))
+            values.append(value)
+      names = [None] * len(fields)
+      for name, i in fields.items():
+         names[i] = name
+      self._AddRun(prefix, names, numpy.asarray(epochs)[[i for i, _ in points]],
+                   [len(pointFields) for _, pointFields in points],
+                   fieldIndexes, values)
+
+   def _AddRun(self, prefix, fieldNames, timestamps, numFields, fieldIndexes, values):
+      self.prefixes.append(prefix)
+      self.fieldNames.append(fieldNames)
+      self.numPoints.append(len(timestamps))
+      self.numFields.append(numFields)
+      self.fieldIndexes.append(fieldIndexes)
+      self.timestamps.append(timestamps)
+      self.values.extend(values)
+
+   def Pack(self):
+      """Join the timestamps into one array."""
+      if self.packed:
+         return
+      self.packed = True
+      if self.timestamps:
+         self.timestamps = numpy.concatenate(self.timestamps).astype('int64')
+      else:
+         self.timestamps = numpy.zeros(0, dtype='int64')
+
+   def __getstate__(self):
+      self.Pack()
+      return self.__dict__
+
+
+class ColumnCollector(object):
+   """Keeps the column batches of a parse, to be added to a MetricCache
+   later."""
+
+   def __init__(self):
+      self.batches = []
+
+   def Add(self, batch):
+      self.batches.append(batch)
+
+
+def _Encode(text):
+   if isinstance(text, unicode):
+      return text.encode('utf-8')
+   return text
+
+
+class MetricCache(object):
+   def __init__(self, dumpPath, **options):
+      """
+      options are the parse options the points depend on, such as the
+      InfluxDB layout. A cache recorded with other options is not used.
+      """
+      self.dumpPath = dumpPath
+      self.cachePath = dumpPath + CACHE_SUFFIX
+      self.tmpPath = self.cachePath + '.tmp'
+      self.options = options
+      self.enabled = numpy is not None
+      self.entities = []
+      self.numPoints = 0
+      self.lock = threading.Lock()
+      self._key = None
+      self._meta = None
+      self._files = None
+
+   def Key(self):
+      if self._key is None:
+         stat = os.stat(self.dumpPath)
+         sha1 = hashlib.sha1()
+         with open(self.dumpPath, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(HASH_CHUNK_SIZE), b''):
+               sha1.update(chunk)
+         self._key = {
+            'version': CACHE_VERSION,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'sha1': sha1.hexdigest(),
+            'options': self.options,
+         }
+      return self._key
+
+   def Load(self):
+      """Return True if there is a valid cache for the dump file."""
+      if not self.enabled:
+         return False
+      metaFile = os.path.join(self.cachePath, 'meta.json')
+      if not os.path.exists(metaFile):
+         return False
+      try:
+         with open(metaFile) as fp:
+            meta = json.load(fp)
+         if meta['key'] != json.loads(json.dumps(self.Key())):
+            logging.info("Metric cache %s is out of date" % self.cachePath)
+            return False
+      except Exception as e:
+         logging.warning("Failed to load metric cache %s: %s" % (self.cachePath, e))
+         return False
+      self._meta = meta
+      self.entities = meta['entities']
+      self.numPoints = meta['numPoints']
+      return True
+
+   def IterBatches(self, batchSize):
+      """Yield the cached points as batches of line protocol strings."""
+      meta = self._meta
+      series = self._ReadTable('series.txt')
+      fields = self._ReadTable('fields.txt')
+      columns = {}
+      for name, dtype in POINT_COLUMNS + FIELD_COLUMNS:
+         columns[name] = self._MapColumn(name, dtype, meta['counts'][name])
+
+      extra = self._ReadTable('extra.txt')
+      for i in range(0, len(extra), batchSize):
+         yield extra[i:i + batchSize]
+
+      valuesFile = open(os.path.join(self.cachePath, VALUES_FILE))
+      try:
+         for batch in self._IterPointBatches(meta, series, fields, columns,
+                                             valuesFile, batchSize):
+            yield batch
+      finally:
+         valuesFile.close()
+
+   def _IterPointBatches(self, meta, series, fields, columns, valuesFile,
+                         batchSize):
+      if len(fields) == 1:
+         # One field for all points, as in the default layout
+         linePrefixes = [prefix + fields[0] + '=' for prefix in series]
+      fieldIndex = 0
+      for start in range(0, meta['counts']['series'], batchSize):
+         end = start + batchSize
+         pointSeries = columns['series'][start:end].tolist()
+         timestamps = columns['timestamp'][start:end].tolist()
+         numFields = columns['numFields'][start:end]
+         fieldEnd = fieldIndex + int(numFields.sum())
+         names = columns['field'][fieldIndex:fieldEnd].tolist()
+         values = [value[:-1] for value in itertools.islice(
+                      valuesFile, fieldEnd - fieldIndex)]
+         fieldIndex = fieldEnd
+         # There are few distinct timestamps
+         timestampText = dict((t, ' %d' % t) for t in set(timestamps))
+         timestamps = [timestampText[t] for t in timestamps]
+         if len(fields) == 1:
+            yield [linePrefixes[s] + v + t for s, v, t in itertools.izip(
+                      pointSeries, values, timestamps)]
+            continue
+         if meta['singleField']:
+            yield [series[s] + fields[f] + '=' + v + t
+                   for s, f, v, t in itertools.izip(
+                      pointSeries, names, values, timestamps)]
+            continue
+         batch = []
+         i = 0
+         for s, t, n in itertools.izip(pointSeries, timestamps,
+                                       numFields.tolist()):
+            batch.append(series[s] + ','.join(
+               [fields[f] + '=' + v for f, v in itertools.izip(
+                  names[i:i + n], values[i:i + n])]) + t)
+            i += n
+         yield batch
+
+   def Open(self):
+      """Start recording the points of the dump file. Return False if the
+      cache cannot be recorded."""
+      if not self.enabled:
+         return False
+      try:
+         if os.path.exists(self.tmpPath):
+            shutil.rmtree(self.tmpPath)
+         os.mkdir(self.tmpPath)
+         self._files = dict(
+            (name, open(os.path.join(self.tmpPath, name + '.bin'), 'wb'))
+            for name, _ in POINT_COLUMNS + FIELD_COLUMNS)
+         self._valuesFile = open(os.path.join(self.tmpPath, VALUES_FILE), 'w')
+         self._extraFile = open(os.path.join(self.tmpPath, 'extra.txt'), 'w')
+      except (IOError, OSError) as e:
+         logging.warning("Failed to create metric cache %s: %s" % (self.tmpPath, e))
+         self.enabled = False
+         return False
+      self.seriesIds = {}
+      self.fieldIds = {}
+      self.counts = dict((name, 0) for name, _ in POINT_COLUMNS + FIELD_COLUMNS)
+      self.numExtra = 0
+      self.singleField = True
+      return True
+
+   def Add(self, batch):
+      """Record the points of a ColumnBatch."""
+      if not self._files:
+         return
+      batch.Pack()
+      with self.lock:
+         if not self._files:
+            return
+         seriesIds = []
+         runFieldIds = []
+         for prefix, fieldNames in itertools.izip(batch.prefixes, batch.fieldNames):
+            seriesId = self.seriesIds.get(prefix)
+            if seriesId is None:
+               seriesId = self.seriesIds[prefix] = len(self.seriesIds)
+            seriesIds.append(seriesId)
+            fieldIds = []
+            for field in fieldNames:
+               fieldId = self.fieldIds.get(field)
+               if fieldId is None:
+                  fieldId = self.fieldIds[field] = len(self.fieldIds)
+               fieldIds.append(fieldId)
+            runFieldIds.append(fieldIds)
+
+         numPoints = numpy.array(batch.numPoints, dtype='int64')
+         columns = {
+            'series': numpy.repeat(numpy.array(seriesIds, dtype='int32'), numPoints),
+            'timestamp': batch.timestamps,
+         }
+         if all(numFields is None for numFields in batch.numFields):
+            columns['numFields'] = numpy.ones(len(batch.timestamps), dtype='int16')
+            columns['field'] = numpy.repeat(
+               numpy.array([fieldIds[0] for fieldIds in runFieldIds], dtype='int32'),
+               numPoints)
+         else:
+            self.singleField = False
+            numFields = []
+            fields = []
+            for fieldIds, runPoints, runNumFields, fieldIndexes in itertools.izip(
+                  runFieldIds, batch.numPoints, batch.numFields, batch.fieldIndexes):
+               if runNumFields is None:
+                  numFields.append(numpy.ones(runPoints, dtype='int16'))
+                  fields.append(numpy.repeat(numpy.int32(fieldIds[0]), runPoints))
+               else:
+                  numFields.append(numpy.array(runNumFields, dtype='int16'))
+                  fields.append(numpy.array(fieldIds, dtype='int32')[fieldIndexes])
+            columns['numFields'] = numpy.concatenate(numFields or [[]])
+            columns['field'] = numpy.concatenate(fields or [[]])
+         for name, dtype in POINT_COLUMNS + FIELD_COLUMNS:
+            column = columns[name].astype(dtype, copy=False)
+            column.tofile(self._files[name])
+            self.counts[name] += len(column)
+         if batch.values:
+            self._valuesFile.write(_Encode('\n'.join(batch.values)) + '\n')
+
+   def AddLines(self, lines):
+      """Record points that are kept as line protocol strings."""
+      if not self._files:
+         return
+      with self.lock:
+         if not self._files:
+            return
+         for line in lines:
+            self._extraFile.write(_Encode(line) + '\n')
+         self.numExtra += len(lines)
+
+   def Commit(self, entities):
+      """Finish recording, the cache is used from now on."""
+      if not self._files:
+         return
+      try:
+         self._Close()
+         self._WriteTable('series.txt', self.seriesIds)
+         self._WriteTable('fields.txt', self.fieldIds)
+         with open(os.path.join(self.tmpPath, 'meta.json'), 'w') as fp:
+            json.dump({
+               'key': self.Key(),
+               'counts': self.counts,
+               'singleField': self.singleField,
+               'numPoints': self.counts['series'] + self.numExtra,
+               'entities': entities,
+            }, fp)
+         if os.path.exists(self.cachePath):
+            shutil.rmtree(self.cachePath)
+         os.rename(self.tmpPath, self.cachePath)
+         logging.info("Saved %d points of %s to metric cache %s" % (
+            self.counts['series'] + self.numExtra, self.dumpPath, self.cachePath))
+      except (IOError, OSError) as e:
+         logging.warning("Failed to save metric cache %s: %s" % (self.cachePath, e))
+         self.Discard()
+
+   def Discard(self):
+      """Stop recording, e.g. because the dump could not be parsed."""
+      if self._files:
+         self._Close()
+      shutil.rmtree(self.tmpPath, ignore_errors=True)
+
+   def _Close(self):
+      with self.lock:
+         for fp in self._files.values():
+            fp.close()
+         self._valuesFile.close()
+         self._extraFile.close()
+         self._files = None
+
+   def _WriteTable(self, name, ids):
+      table = [None] * len(ids)
+      for value, i in ids.items():
+         table[i] = value
+      with open(os.path.join(self.tmpPath, name), 'w') as fp:
+         for value in table:
+            fp.write(_Encode(value) + '\n')
+
+   def _ReadTable(self, name):
+      with open(os.path.join(self.cachePath, name)) as fp:
+         return [line[:-1] for line in fp]
+
+   def _MapColumn(self, name, dtype, count):
+      if count == 0:
+         return numpy.zeros(0, dtype=dtype)
+      return numpy.memmap(os.path.join(self.cachePath, name + '.bin'),
+                          dtype=dtype, mode='r', shape=(count,))
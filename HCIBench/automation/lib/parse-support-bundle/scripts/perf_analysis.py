@@ -8,8 +8,10 @@ import sys
 import glob
 import time
 import traceback
-from PerfStatsParser import VSANPerfDumpParser, chunks, getValidParsers, INFLUX_BATCH
-from grafanaUtil import GrafanaClient
+from PerfStatsParser import VSANPerfDumpParser, ParseVmodlDumpFilesInProcesses, LoadCmmdsIndex, getValidParsers, INFLUX_BATCH, MAX_ITEMS
+from influxWriter import InfluxWriter, NUM_CONNECTIONS
+from metricCache import MetricCache
+from grafanaUtil import GrafanaClient, DashboardProvisioner
 from dashboardUtil import DashboardGenerator
 #from humbugRedis import HumbugRedisInstance as Redis
 import hashlib
@@ -44,19 +46,14 @@ def setupGrafana(bundle, entities, graphFilename):
    if grafana_client.isNewGrafana():
       return ""
 
-   # Do not attempt to parallelize, as that will lead to errors,
-   # presumably due to references between dashboards
    dbGenerator = DashboardGenerator(graphFilename)
 
 
    dashboardPostfix, dbs = dbGenerator.getDashboards(db_name, entities)
 
-   for db in dbs:
-      try:
-         grafana_client.createDashboard(db)
-      except Exception as e:
-         logging.error("Failed to create dashboard: %s" % str(e))
-         continue
+   # Dashboards are imported after the dashboards they link to, and
+   # unchanged ones are left alone
+   DashboardProvisioner(grafana_client).provision(dbs)
 
    # dashboard 6 characters hash
    return dashboardPostfix
@@ -74,25 +71,8 @@ def CreateInfluxDatabase(bundle):
    if result.status_code / 100 != 2:  # Status code 2xx is success
       logging.error("Failed to create influxDB database")
 
-def WriteInfluxPoints(session, batchData, bundle):
-   INFLUXDB_URL = config.HumbugConfig.config['INFLUXDB_URL']
-   dbWriteURL = "%s/write?db=%s&precision=s" % (INFLUXDB_URL, bundle)
-   logging.debug("Total amount of data points: %d" % len(batchData))
-   i = 0
-   batchSizeInflation = int(INFLUX_BATCH * 1.1)
-   for chunk in chunks(batchData, INFLUX_BATCH):
-      i += 1
-      logging.debug("Writing data chunk %d of length %d" % (i, len(chunk)))
-      body = "\n".join(chunk)
-      # Write Data
-      result = session.post(dbWriteURL, data = body)
-      if result.status_code / 100 != 2:  # Status code 2xx is success
-         logging.error("Failed to write batch data to influxDB : %d (%s)" % (result.status_code, result.text))
-         if result.status_code == 503:
-            break
-
 def GetDbTimerange(bundle):
-   def singleValueQuery(query):
+   def seriesValuesQuery(query):
       INFLUXDB_URL = config.HumbugConfig.config['INFLUXDB_URL']
       result = requests.get(
          '%s/query' % INFLUXDB_URL,
@@ -102,19 +82,25 @@ def GetDbTimerange(bundle):
          logging.exception("Failed to get limit for time range.")
          raise Exception("Failed to get lower limit for time range")
       result = json.loads(result.text)
-      return result.get('results')[0].get('series')[0].get('values')[0][0]
+      return [series.get('values')[0][0]
+              for series in result.get('results')[0].get('series')]
 
    # Get time range
-   smallestTS = "select first(value) from iops"
-   largestTS = "select last(value) from iops"
+   if DashboardGenerator.ENABLE_NEW_INFLUX_LAYOUT:
+      # iops is a field of every entity type measurement reporting it
+      smallestTS = "select first(iops) from /.*/"
+      largestTS = "select last(iops) from /.*/"
+   else:
+      smallestTS = "select first(value) from iops"
+      largestTS = "select last(value) from iops"
 
    lowTS = None
    highTS = None
    #Attempt to get the time ranges from the iops(more common) measurement, if not
    #return none and caller have to decide on range.
    try:
-      lowTS = singleValueQuery(smallestTS)
-      highTS = singleValueQuery(largestTS)
+      lowTS = min(seriesValuesQuery(smallestTS))
+      highTS = max(seriesValuesQuery(largestTS))
    except:
       pass
 
@@ -141,8 +127,19 @@ def GenerateDashboardURL(bundle, bundlePostfix):
 
    return url
 
+def GetAdditionalPerfFiles(fileName):
+   files =[]
+   for fileprefix in ["*perf_stats_with_dump*", "*selective_with_dump*", "*ioinsight_stats_with_dump*"]:
+      filetype = os.path.join(os.path.dirname(os.path.realpath(fileName)), fileprefix)
+      files.extend(glob.glob(filetype))
+   if files and fileName in files:
+      files.remove(fileName)
+   else:
+      files = [fileName]
+   return files
+
 def printUsage():
-   logging.error("python perf_analysis.py -f <fileName> -p <parserType> -n <supportBundleName> -i <internalHumbugIp> -e <externalHumbugIp> -d <hostDiskMapping>")
+   logging.error("python perf_analysis.py -f <fileName> -p <parserType> -n <supportBundleName> -i <internalHumbugIp> -e <externalHumbugIp> -d <hostDiskMapping> -t <parseThreads> -w <parseProcesses> -c <influxConnections> [--new-layout] [--no-cache]")
 
 def validateArgs(fileName, parserType, name, grafanaIntIp, grafanaExtIp, hostDiskMapFile):
    if not name:
@@ -173,8 +170,8 @@ def main(argv):
       Parser: SoapParser
    """
    try:
-      opts, args = getopt.getopt(argv,"hf:p:i:e:d:n:g:sz",["fileName=", "parser=", "int-ip=", "ext-ip=", "name=",
-                                                         "host-disk-map-file=", "port=", "skipgrafana", "skipinflux"])
+      opts, args = getopt.getopt(argv,"hf:p:i:e:d:n:g:t:w:c:lsz",["fileName=", "parser=", "int-ip=", "ext-ip=", "name=",
+                                                         "host-disk-map-file=", "port=", "threads=", "workers=", "connections=", "new-layout", "no-cache", "skipgrafana", "skipinflux"])
    except getopt.GetoptError:
       logging.error('perf_analysis.py -f <fileName> -p <parser>')
       sys.exit(2)
@@ -189,6 +186,11 @@ def main(argv):
    port = 3000
    skipGrafana = False
    skipInflux = False
+   numThreads = MAX_ITEMS
+   numWorkers = 1
+   numConnections = NUM_CONNECTIONS
+   newLayout = False
+   useCache = True
    for opt, arg in opts:
       if opt == '-h':
          printUsage()
@@ -208,6 +210,19 @@ def main(argv):
          hostDiskMapFile = arg
       if opt in ("-g", "--port"):
          port = int(arg)
+      if opt in ("-t", "--threads"):
+         numThreads = int(arg)
+      if opt in ("-w", "--workers"):
+         numWorkers = int(arg)
+      if opt in ("-c", "--connections"):
+         numConnections = int(arg)
+      if opt in ("-l", "--new-layout"):
+         # One measurement per entity type, with every metric as a field
+         newLayout = True
+         DashboardGenerator.ENABLE_NEW_INFLUX_LAYOUT = True
+      if opt == "--no-cache":
+         # Parse the dump files even if their points are cached
+         useCache = False
       if opt in ("-s", "--skipgrafana"):
          skipGrafana = True
       if opt in ("-x", "--skipinflux"):
@@ -267,9 +282,10 @@ def main(argv):
       logging.error(errorStr)
       RedisUpdateError(errorStr)
 
-   # Use a session so we keep reusing the same TCP connection
+   # The writer keeps numConnections keep-alive connections to influx DB
    stats = {'numDataPoints': 0}
-   requestsSession = requests.Session()
+   influxWriter = InfluxWriter(config.HumbugConfig.config['INFLUXDB_URL'],
+                               bundle, numConnections, INFLUX_BATCH)
    def FlushData(batchData, progressStr=None):
       if skipInflux:
          logging.info("Skipping writing %u data points to influx DB" % len(batchData))
@@ -279,7 +295,7 @@ def main(argv):
          logging.info(progressStr)
 
       stats['numDataPoints'] += len(batchData)
-      WriteInfluxPoints(requestsSession, batchData, bundle)
+      influxWriter.Write(batchData)
       logging.info("Writing %u data points to influx DB" % len(batchData))
 
    # 2) Parse the input, write out data to influx DB
@@ -288,49 +304,125 @@ def main(argv):
       bundlePostfix = setupGrafana(bundle, [], "")
    RedisUpdatePerfLink()
 
-   t1 = time.time()
-   entities = []
-   try:
-      parser = VSANPerfDumpParser(fileName, parserType, hostDiskMapFile, redisKey)
-      parser.Parse(FlushData)
-      entities.extend(parser.entities)
-   except Exception as e:
-      errorStr = "Failed to parse data: %s" % (e)
-      logging.info(traceback.format_exc())
-      logging.error(errorStr)
-      RedisUpdateError(errorStr)
-      return
-
-   # P1 & P2 data parsing and write out to influx DB
-   t2 = time.time()
    try:
-      files =[]
-      for fileprefix in ["*perf_stats_with_dump*", "*selective_with_dump*", "*ioinsight_stats_with_dump*"]:
-         filetype = os.path.join(os.path.dirname(os.path.realpath(fileName)), fileprefix)
-         files.extend(glob.glob(filetype))
-      if files and fileName in files:
-         files.remove(fileName)
-      else:
-         files = [fileName]
-      logging.info("Additional perf files %s" % str(files))
-      for perfFile in files:
-        try:
-            logging.info("Loading file %s" % perfFile)
-            parser = VSANPerfDumpParser(perfFile, parserType, hostDiskMapFile, redisKey)
+      t1 = time.time()
+      entities = []
+      # All dump files of the bundle resolve their entities with the same index
+      cmmdsIndex = None
+      if parserType == "SoapParser":
+         cmmdsIndex = LoadCmmdsIndex(fileName, hostDiskMapFile)
+      def OpenMetricCache(dumpFile):
+         """
+         Return (cache, loaded) for dumpFile. A loaded cache has written out
+         the points of dumpFile, which need not be parsed then. Otherwise the
+         points are to be recorded into the cache, if any, while dumpFile is
+         parsed.
+         """
+         if not useCache:
+            return None, False
+         cache = MetricCache(dumpFile, parser=parserType, newLayout=newLayout,
+                             hostDiskMapFile=hostDiskMapFile)
+         if cache.Load():
+            logging.info("Loading %d points of %s from %s" % (
+               cache.numPoints, dumpFile, cache.cachePath))
+            if not skipInflux:
+               for batch in cache.IterBatches(INFLUX_BATCH):
+                  FlushData(batch)
+            return cache, True
+         if not cache.Open():
+            return None, False
+         return cache, False
+
+      def ParseDumpFile(dumpFile):
+         """Parse dumpFile, or load it from its metric cache, and return its
+         entities."""
+         cache, loaded = OpenMetricCache(dumpFile)
+         if loaded:
+            return cache.entities
+         parser = VSANPerfDumpParser(dumpFile, parserType, hostDiskMapFile, redisKey,
+                                     numThreads, newLayout, cmmdsIndex)
+         parser.metricCache = cache
+         try:
             parser.Parse(FlushData)
-            entities.extend(parser.entities)
+         except:
+            if cache:
+               cache.Discard()
+            raise
+         if cache:
+            cache.Commit(parser.entities)
+         logging.debug("Done: numSkipped: %s, numValues: %s" % (
+               parser.numSkipped, parser.numValues))
+         return parser.entities
+
+      if numWorkers > 1 and parserType == "SoapParser":
+         # The primary and the additional dump files share one process pool
+         caches = []
+         try:
+            dumpFiles = [fileName] + [f for f in GetAdditionalPerfFiles(fileName)
+                                      if f != fileName]
+            parseFiles = []
+            for dumpFile in dumpFiles:
+               cache, loaded = OpenMetricCache(dumpFile)
+               if loaded:
+                  entities.extend(cache.entities)
+               else:
+                  parseFiles.append(dumpFile)
+                  caches.append(cache)
+            if parseFiles:
+               logging.info("Parsing perf files %s with %d processes" % (
+                  str(parseFiles), numWorkers))
+               parsers = ParseVmodlDumpFilesInProcesses(
+                  parseFiles, FlushData, hostDiskMapFile, numWorkers, newLayout,
+                  cmmdsIndex, caches, redisKey, numConnections)
+               for parser, cache in zip(parsers, caches):
+                  if cache:
+                     cache.Commit(parser.entities)
+                  entities.extend(parser.entities)
             entities = {frozenset(item.items()): item for item in entities}.values()
-            logging.debug("Done: numSkipped: %s, numValues: %s" % (
-                  parser.numSkipped, parser.numValues))
             RedisUpdatePerfLink()
-        except Exception as ex:
-            logging.error("Failed to file: %s:  %s" % (perfFile, traceback.format_exc()))
-   except Exception as e:
-      logging.error("Failed to parse data: %s" % (e))
+         except Exception as e:
+            for cache in caches:
+               if cache:
+                  cache.Discard()
+            errorStr = "Failed to parse data: %s" % (e)
+            logging.info(traceback.format_exc())
+            logging.error(errorStr)
+            RedisUpdateError(errorStr)
+            return
+         t2 = time.time()
+      else:
+         try:
+            entities.extend(ParseDumpFile(fileName))
+         except Exception as e:
+            errorStr = "Failed to parse data: %s" % (e)
+            logging.info(traceback.format_exc())
+            logging.error(errorStr)
+            RedisUpdateError(errorStr)
+            return
+
+         # P1 & P2 data parsing and write out to influx DB
+         t2 = time.time()
+         try:
+            files = GetAdditionalPerfFiles(fileName)
+            logging.info("Additional perf files %s" % str(files))
+            for perfFile in files:
+              try:
+                  logging.info("Loading file %s" % perfFile)
+                  entities.extend(ParseDumpFile(perfFile))
+                  entities = {frozenset(item.items()): item for item in entities}.values()
+                  RedisUpdatePerfLink()
+              except Exception as ex:
+                  logging.error("Failed to file: %s:  %s" % (perfFile, traceback.format_exc()))
+         except Exception as e:
+            logging.error("Failed to parse data: %s" % (e))
+   finally:
+      # Send the batches still queued, even when parsing failed
+      influxWriter.Close()
 
 
    #logging.info("entities = %s" % json.dumps(entities, indent=2))
 
+   influxWriter.LogStats()
    t3 = time.time()
 
    t4 = time.time()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2015-2022 VMware, Inc.  All rights reserved.
+-- VMware Confidential
+
+Decoding of the sampleInfo/values CSV strings of VsanPerfEntityMetricCSV.
+
+A sampleInfo string is decoded once into an int64 array of epoch seconds
+plus the matching line protocol timestamps, and kept in a bounded LRU cache
+since every entity of a query page shares the same sampleInfo. NumPy is
+used to parse the dates when available, falling back to strptime.
+
+A values string is decoded in one pass into the indexes of the valid
+samples and their line protocol values. The values are written out as
+text again, so they are kept as strings: going through a NumPy array
+measured slower than a plain list for every series length we see.
+"""
+
+import calendar
+import collections
+import datetime
+import threading
+import time
+
+try:
+   import numpy
+except ImportError:
+   numpy = None
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+SAMPLE_INFO_CACHE_SIZE = 1024
+MISSING_VALUES = ("None", "")
+
+
+def _ScaleValue(value, scale):
+   # Integers are scaled exactly, as str(int(value) * scale) always did
+   try:
+      return str(int(value) * scale)
+   except ValueError:
+      return '%.15g' % (float(value) * scale)
+
+
+class LRUCache(object):
+   def __init__(self, maxSize):
+      self.maxSize = maxSize
+      self.items = collections.OrderedDict()
+      self.lock = threading.Lock()
+
+   def get(self, key):
+      with self.lock:
+         value = self.items.pop(key, None)
+         if value is not None:
+            self.items[key] = value
+         return value
+
+   def put(self, key, value):
+      with self.lock:
+         self.items.pop(key, None)
+         self.items[key] = value
+         while len(self.items) > self.maxSize:
+            self.items.popitem(last=False)
+
+   def __len__(self):
+      return len(self.items)
+
+
+class SampleDecoder(object):
+   def __init__(self, dateFormat=DATE_FORMAT, cacheSize=SAMPLE_INFO_CACHE_SIZE):
+      self.dateFormat = dateFormat
+      self.sampleInfoCache = LRUCache(cacheSize)
+      # numpy parses ISO 8601 only
+      self.useNumpy = numpy is not None and dateFormat == DATE_FORMAT
+
+   def DecodeSampleInfo(self, sampleInfo):
+      """
+      Return (epochs, timestamps) for a sampleInfo string, the epoch seconds
+      (local time, as time.mktime) as an int64 array (a list without NumPy)
+      and as strings.
+      """
+      decoded = self.sampleInfoCache.get(sampleInfo)
+      if decoded is None:
+         dates = sampleInfo.split(',')
+         if self.useNumpy:
+            epochs = self._ToLocalEpochs(
+               numpy.array(dates, dtype='datetime64[s]').astype(numpy.int64),
+               dates)
+         else:
+            epochs = [int(time.mktime(datetime.datetime.strptime(
+                         dt, self.dateFormat).timetuple()))
+                      for dt in dates]
+         decoded = (epochs, ["%d" % epoch for epoch in epochs])
+         self.sampleInfoCache.put(sampleInfo, decoded)
+      return decoded
+
+   def _ToLocalEpochs(self, utcEpochs, dates):
+      def _offset(date):
+         tt = datetime.datetime.strptime(date, self.dateFormat).timetuple()
+         return int(time.mktime(tt)) - calendar.timegm(tt)
+
+      # The UTC offset only has to be looked up per sample when the
+      # range crosses a DST change
+      first = _offset(dates[0])
+      if first == _offset(dates[-1]):
+         return utcEpochs + first
+      return utcEpochs + numpy.array([_offset(dt) for dt in dates],
+                                     dtype=numpy.int64)
+
+   def DecodeValues(self, values, scale=None):
+      """
+      Return (indexes, values) for a values string: the positions of the
+      samples that are not missing, and their values as line protocol
+      strings, multiplied by scale if given. Both are empty when every
+      sample is missing.
+      """
+      items = values.split(',')
+      indexes = [i for i, val in enumerate(items) if val not in MISSING_VALUES]
+      if scale is not None:
+         return indexes, [_ScaleValue(items[i], scale) for i in indexes]
+      return indexes, [items[i] for i in indexes]
+
+   def __len__(self):
+      return len(self.sampleInfoCache)
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2015-2022 VMware, Inc.  All rights reserved.
+-- VMware Confidential
+
+Tests of grafanaUtil.DashboardProvisioner and GrafanaClient against a local
+stub of the Grafana search, delete and import API.
+
+Run with:
+   python -m unittest test_grafanaUtil
+"""
+
+import json
+import threading
+import time
+import unittest
+
+try:
+   import BaseHTTPServer
+   import SocketServer
+   import urlparse
+except ImportError:
+   # Like the parser, grafanaUtil runs on Python 2
+   raise unittest.SkipTest("Python 2 only")
+
+from grafanaUtil import DashboardProvisioner, GrafanaClient, dashboardDependencies
+
+
+class StubGrafanaHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+   protocol_version = 'HTTP/1.1'
+
+   def do_GET(self):
+      server = self.server
+      url = urlparse.urlparse(self.path)
+      if url.path == '/api/health':
+         self.reply(200, {'version': server.version})
+      elif url.path == '/api/search':
+         query = urlparse.parse_qs(url.query).get('query', [''])[0]
+         with server.lock:
+            server.numSearches += 1
+            results = [{'title': title, 'uri': db['uri'], 'tags': db['tags']}
+                       for title, db in server.dashboards.items()
+                       if query.lower() in title.lower()]
+         # Like Grafana, substring matches may come before the exact title
+         results.sort(key=lambda result: -len(result['title']))
+         self.reply(200, results)
+      else:
+         self.reply(404, {'message': 'Not found'})
+
+   def do_DELETE(self):
+      server = self.server
+      uri = self.path[len('/api/dashboards/'):]
+      with server.lock:
+         server.deletes.append(uri)
+         titles = [title for title, db in server.dashboards.items()
+                   if db['uri'] == uri]
+         for title in titles:
+            del server.dashboards[title]
+      if titles:
+         self.reply(200, {'title': titles[0]})
+      else:
+         self.reply(404, {'message': 'Dashboard not found'})
+
+   def do_POST(self):
+      server = self.server
+      body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+      if self.path == '/api/datasources':
+         self.reply(200, {'message': 'Datasource added'})
+         return
+      db = body['dashboard']
+      title = db['title']
+      with server.lock:
+         server.active += 1
+         server.maxActive = max(server.maxActive, server.active)
+         # Links to dashboards of the set which are not imported yet
+         server.danglingLinks.extend(
+            (title, link) for link in dashboardDependencies(db)
+            if link in server.titles and link != title and
+            link not in server.dashboards)
+      if server.delay:
+         time.sleep(server.delay)
+      with server.lock:
+         server.active -= 1
+         server.imports.append(title)
+         if title in server.failTitles:
+            status = 500
+         else:
+            status = 200
+            server.dashboards[title] = {
+               'uri': 'db/' + title.lower().replace(' ', '-'),
+               'tags': db.get('tags') or [],
+               'dashboard': db,
+            }
+      self.reply(status, {'title': title})
+
+   def reply(self, status, result):
+      body = json.dumps(result)
+      self.send_response(status)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+   def log_message(self, *args):
+      pass
+
+
+class StubGrafanaServer(SocketServer.ThreadingMixIn,
+                        BaseHTTPServer.HTTPServer):
+   daemon_threads = True
+
+   def __init__(self, delay=0, failTitles=()):
+      BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                         StubGrafanaHandler)
+      self.lock = threading.Lock()
+      self.version = '4.4.3'
+      self.delay = delay
+      self.failTitles = set(failTitles)
+      # Titles of the dashboards being provisioned
+      self.titles = set()
+      self.dashboards = {}
+      self.numSearches = 0
+      self.imports = []
+      self.deletes = []
+      self.danglingLinks = []
+      self.active = 0
+      self.maxActive = 0
+      self.thread = threading.Thread(target=self.serve_forever)
+      self.thread.daemon = True
+      self.thread.start()
+
+   def stop(self):
+      self.shutdown()
+      self.server_close()
+
+
+def MakeDashboard(title, links=(), value=0, tags=None):
+   db = {
+      'title': title,
+      'rows': [{
+         'panels': [{
+            'title': 'Panel of %s' % title,
+            'targets': [{'query': 'SELECT %d' % value}],
+            'links': [{'type': 'dashboard', 'dashboard': link}
+                      for link in links],
+         }],
+      }],
+   }
+   if tags is not None:
+      db['tags'] = tags
+   return db
+
+
+class DashboardProvisionerTest(unittest.TestCase):
+   def startServer(self, **kwargs):
+      server = StubGrafanaServer(**kwargs)
+      self.addCleanup(server.stop)
+      client = GrafanaClient('http://127.0.0.1', server.server_address[1],
+                             'admin', 'admin')
+      return server, client
+
+   def provision(self, server, client, dbs, **kwargs):
+      server.titles = set(db['title'] for db in dbs)
+      return DashboardProvisioner(client, **kwargs).provision(dbs)
+
+   def testCreateThenSkip(self):
+      server, client = self.startServer(delay=0.05)
+      dbs = [MakeDashboard('Dashboard %d' % i) for i in range(10)]
+      titles = sorted(db['title'] for db in dbs)
+      report = self.provision(server, client, dbs, numThreads=4)
+      self.assertEqual(report['created'], titles)
+      self.assertEqual(report['failed'], [])
+      self.assertEqual(sorted(server.dashboards), titles)
+      self.assertEqual(server.maxActive, 4)
+
+      numImports = len(server.imports)
+      report = self.provision(server, client, dbs)
+      self.assertEqual(report['skipped'], titles)
+      self.assertEqual(report['created'] + report['updated'], [])
+      self.assertEqual(len(server.imports), numImports)
+      self.assertEqual(server.deletes, [])
+
+   def testUpdate(self):
+      server, client = self.startServer()
+      dbs = [MakeDashboard('A', tags=['vsan']), MakeDashboard('B')]
+      self.provision(server, client, dbs)
+      uri = server.dashboards['A']['uri']
+      dbs[0] = MakeDashboard('A', value=1, tags=['vsan'])
+      report = self.provision(server, client, dbs)
+      self.assertEqual(report['updated'], ['A'])
+      self.assertEqual(report['skipped'], ['B'])
+      self.assertEqual(server.deletes, [uri])
+      deployed = server.dashboards['A']
+      self.assertEqual(deployed['dashboard']['rows'], dbs[0]['rows'])
+      self.assertEqual(deployed['tags'][0], 'vsan')
+      self.assertTrue(deployed['tags'][1].startswith(
+         GrafanaClient.CONTENT_HASH_TAG_PREFIX))
+      # The dashboards passed in are left alone
+      self.assertEqual(dbs[0]['tags'], ['vsan'])
+
+   def testReplaceUntagged(self):
+      server, client = self.startServer()
+      # e.g. imported by createDashboard
+      self.assertTrue(client.createDashboard(MakeDashboard('A')))
+      report = self.provision(server, client, [MakeDashboard('A')])
+      self.assertEqual(report['updated'], ['A'])
+      self.assertEqual(len(server.deletes), 1)
+
+   def testExactTitle(self):
+      server, client = self.startServer()
+      dbs = [MakeDashboard('Host'), MakeDashboard('Host Disks')]
+      self.provision(server, client, dbs)
+      uri = server.dashboards['Host']['uri']
+      report = self.provision(server, client, [MakeDashboard('Host', value=1)])
+      self.assertEqual(report['updated'], ['Host'])
+      self.assertEqual(server.deletes, [uri])
+      self.assertEqual(sorted(server.dashboards), ['Host', 'Host Disks'])
+
+   def testLinkOrder(self):
+      server, client = self.startServer(delay=0.02)
+      dbs = [MakeDashboard('A', links=['B', 'External']),
+             MakeDashboard('B', links=['C']),
+             MakeDashboard('C'),
+             MakeDashboard('D', links=['C', 'D']),
+             MakeDashboard('E')]
+      report = self.provision(server, client, dbs)
+      self.assertEqual(report['created'], ['A', 'B', 'C', 'D', 'E'])
+      self.assertEqual(server.danglingLinks, [])
+      self.assertEqual(sorted(server.imports[:2]), ['C', 'E'])
+      self.assertEqual(server.imports[-1], 'A')
+
+   def testCycle(self):
+      server, client = self.startServer()
+      dbs = [MakeDashboard('A', links=['B']),
+             MakeDashboard('B', links=['A']),
+             MakeDashboard('C', links=['A']),
+             MakeDashboard('D', links=['C'])]
+      report = self.provision(server, client, dbs)
+      self.assertEqual(report['created'], ['A', 'B', 'C', 'D'])
+      # Only the link closing the cycle is imported before its target
+      self.assertEqual(server.danglingLinks, [('A', 'B')])
+      self.assertEqual(server.imports[0], 'A')
+      self.assertEqual(server.imports[-1], 'D')
+
+   def testFailure(self):
+      server, client = self.startServer(failTitles=['B'])
+      dbs = [MakeDashboard('A', links=['B']), MakeDashboard('B'),
+             MakeDashboard('C')]
+      report = self.provision(server, client, dbs)
+      self.assertEqual(report['failed'], ['B'])
+      # Dependents of a failed dashboard are still imported
+      self.assertEqual(report['created'], ['A', 'C'])
+      self.assertEqual(server.imports.index('A'), 2)
+
+   def testUnreachable(self):
+      client = GrafanaClient('http://127.0.0.1', 1, 'admin', 'admin')
+      report = DashboardProvisioner(client).provision([MakeDashboard('A')])
+      self.assertEqual(report['failed'], ['A'])
+
+   def testInvalidThreads(self):
+      self.assertRaises(ValueError, DashboardProvisioner, None, numThreads=0)
+
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2015-2022 VMware, Inc.  All rights reserved.
+-- VMware Confidential
+
+Tests of influxWriter.InfluxWriter against a local stub of the InfluxDB
+/write endpoint.
+
+Run with:
+   python -m unittest test_influxWriter
+"""
+
+import gzip
+import threading
+import time
+import unittest
+
+try:
+   import BaseHTTPServer
+   import SocketServer
+   import StringIO
+   import urlparse
+except ImportError:
+   # Like the parser, the writer runs on Python 2
+   raise unittest.SkipTest("Python 2 only")
+
+from influxWriter import InfluxWriter
+
+
+class StubInfluxHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+   protocol_version = 'HTTP/1.1'
+
+   def do_POST(self):
+      server = self.server
+      body = self.rfile.read(int(self.headers['Content-Length']))
+      with server.lock:
+         server.numRequests += 1
+         status = server.statuses.pop(0) if server.statuses else 204
+      if server.delay:
+         time.sleep(server.delay)
+      if status == 204:
+         if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.GzipFile(fileobj=StringIO.StringIO(body)).read()
+         with server.lock:
+            server.encodings.append(self.headers.get('Content-Encoding'))
+            server.params.append(urlparse.parse_qs(
+               urlparse.urlparse(self.path).query))
+            server.batches.append(body.split("\n"))
+      self.send_response(status)
+      if status in (429, 503):
+         self.send_header('Retry-After', '0')
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+
+   def log_message(self, *args):
+      pass
+
+
+class StubInfluxServer(SocketServer.ThreadingMixIn,
+                       BaseHTTPServer.HTTPServer):
+   daemon_threads = True
+
+   def __init__(self, statuses=(), delay=0):
+      BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                         StubInfluxHandler)
+      self.lock = threading.Lock()
+      # Status codes of the next requests, then 204
+      self.statuses = list(statuses)
+      self.delay = delay
+      self.numRequests = 0
+      self.encodings = []
+      self.params = []
+      self.batches = []
+      self.thread = threading.Thread(target=self.serve_forever)
+      self.thread.daemon = True
+      self.thread.start()
+
+   @property
+   def url(self):
+      return 'http://127.0.0.1:%d' % self.server_address[1]
+
+   def stop(self):
+      self.shutdown()
+      self.server_close()
+
+   def points(self):
+      return sorted(point for batch in self.batches for point in batch)
+
+
+def MakePoints(count):
+   return ['m,t=x value=%d %d' % (i, 1500000000 + i) for i in range(count)]
+
+
+class InfluxWriterTest(unittest.TestCase):
+   def startServer(self, **kwargs):
+      server = StubInfluxServer(**kwargs)
+      self.addCleanup(server.stop)
+      return server
+
+   def testGzipBatches(self):
+      server = self.startServer()
+      writer = InfluxWriter(server.url, 'bundle', numConnections=2,
+                            batchSize=100, minBatchSize=100, maxBatchSize=100)
+      points = MakePoints(1050)
+      writer.Write(points)
+      writer.Close()
+      self.assertEqual(server.points(), sorted(points))
+      self.assertEqual(len(server.batches), 11)
+      self.assertEqual(set(server.encodings), set(['gzip']))
+      self.assertEqual(server.params[0], {'db': ['bundle'], 'precision': ['s']})
+      stats = writer.Stats()
+      self.assertEqual(stats['points'], 1050)
+      self.assertEqual(stats['droppedPoints'], 0)
+      self.assertTrue(stats['bytesSent'] < stats['bytesRaw'])
+
+   def testUncompressed(self):
+      server = self.startServer()
+      writer = InfluxWriter(server.url, 'bundle', numConnections=1,
+                            compress=False)
+      points = MakePoints(10)
+      writer.Write(points)
+      writer.Close()
+      self.assertEqual(server.points(), sorted(points))
+      self.assertEqual(server.encodings, [None])
+
+   def testRetryThrottled(self):
+      server = self.startServer(statuses=[429, 503, 503])
+      writer = InfluxWriter(server.url, 'bundle', numConnections=1,
+                            batchSize=100, minBatchSize=100,
+                            backoffBase=0.001)
+      points = MakePoints(100)
+      writer.Write(points)
+      writer.Close()
+      self.assertEqual(server.points(), sorted(points))
+      self.assertEqual(server.numRequests, 4)
+      stats = writer.Stats()
+      self.assertEqual(stats['retries'], 3)
+      self.assertEqual(stats['droppedPoints'], 0)
+
+   def testGiveUpAfterMaxRetries(self):
+      server = self.startServer(statuses=[503] * 3)
+      writer = InfluxWriter(server.url, 'bundle', numConnections=1,
+                            maxRetries=2, backoffBase=0.001)
+      writer.Write(MakePoints(10))
+      writer.Close()
+      self.assertEqual(server.numRequests, 3)
+      self.assertEqual(writer.Stats()['droppedPoints'], 10)
+
+   def testRejectedNotRetried(self):
+      server = self.startServer(statuses=[400])
+      writer = InfluxWriter(server.url, 'bundle', numConnections=1,
+                            backoffBase=0.001)
+      writer.Write(MakePoints(10))
+      writer.Close()
+      self.assertEqual(server.numRequests, 1)
+      stats = writer.Stats()
+      self.assertEqual(stats['retries'], 0)
+      self.assertEqual(stats['droppedPoints'], 10)
+
+   def testBatchGrowsWhenFast(self):
+      server = self.startServer()
+      writer = InfluxWriter(server.url, 'bundle', numConnections=1,
+                            batchSize=100, minBatchSize=100,
+                            maxBatchSize=1000, targetLatency=10)
+      for _ in range(10):
+         writer.Write(MakePoints(100))
+         writer.Flush()
+      writer.Close()
+      self.assertEqual(writer.Stats()['batchSize'], 1000)
+
+   def testBatchShrinksWhenSlow(self):
+      server = self.startServer(delay=0.05)
+      writer = InfluxWriter(server.url, 'bundle', numConnections=1,
+                            batchSize=800, minBatchSize=100,
+                            maxBatchSize=1000, targetLatency=0.01)
+      writer.Write(MakePoints(800))
+      writer.Flush()
+      self.assertEqual(writer.Stats()['batchSize'], 400)
+      # The next points are cut into batches of the new size
+      writer.Write(MakePoints(800))
+      writer.Close()
+      self.assertEqual([len(batch) for batch in server.batches],
+                       [800, 400, 400])
+      self.assertEqual(writer.Stats()['batchSize'], 100)
+
+   def testShrinkOnThrottle(self):
+      server = self.startServer(statuses=[429])
+      writer = InfluxWriter(server.url, 'bundle', numConnections=1,
+                            batchSize=800, minBatchSize=100,
+                            targetLatency=10, backoffBase=0.001)
+      writer.Write(MakePoints(800))
+      writer.Close()
+      # Halved by the 429, then grown by the fast retry
+      self.assertEqual(writer.Stats()['batchSize'], 600)
+
+
+if __name__ == '__main__':
+   unittest.main()
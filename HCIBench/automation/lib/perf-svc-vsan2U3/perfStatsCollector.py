@@ -0,0 +1,503 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2015-2024 Broadcom. All Rights Reserved.
+Broadcom Confidential. The term "Broadcom" refers to Broadcom Inc.
+and/or its subsidiaries.
+
+Queries of the vSAN performance service stats for vsan-perfsvc-status.py,
+which are run concurrently and in batches. This module is uploaded to the
+host next to the script.
+"""
+
+import collections
+import datetime
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import pyVmomi
+from pyVmomi import vim
+
+import soapStreamer
+
+
+# Sizes in minutes of the pages of AdaptiveQueryPager. Each size is a
+# multiple of the smaller ones, so pages of the same size start and end at
+# the same times for all the entity types.
+PAGING_SIZES = (10, 20, 60, 120, 360, 720)
+# How much larger a page can be than the previous one when no stats are
+# returned
+maxPageGrowth = 4
+
+class QueryPager(object):
+   """Generate the query specs of one entity type, one for every range.
+
+   With probe, the next pages wait for the result of the first one, e.g.
+   when the table may not exist.
+   """
+
+   def __init__(self, entityRefId, labels, ranges, probe=False):
+      self.entityRefId = entityRefId
+      self.labels = labels
+      self.ranges = iter(ranges)
+      self.probe = probe
+      # whether the next spec waits for the result of a page
+      self.waiting = False
+      self.firstSpec = None
+
+   def NextSpec(self):
+      """Return the spec of the next page, or None if all pages are made."""
+      segStartTime, segEndTime = next(self.ranges, (None, None))
+      if segEndTime is None:
+         return None
+      return self._MakeSpec(segStartTime, segEndTime)
+
+   def Update(self, querySpec, numSamples, numBytes):
+      """Take the result of the page of querySpec, numBytes is None if it failed."""
+      if querySpec is self.firstSpec:
+         self.waiting = False
+
+   def _MakeSpec(self, startTime, endTime):
+      querySpec = vim.cluster.VsanPerfQuerySpec(
+         entityRefId=self.entityRefId,
+         startTime=startTime,
+         endTime=endTime,
+         labels=self.labels
+      )
+      if self.probe and self.firstSpec is None:
+         self.firstSpec = querySpec
+         self.waiting = True
+      return querySpec
+
+class AdaptiveQueryPager(QueryPager):
+   """Generate the query specs of one entity type from endTime backwards,
+   with pages sized so that each one returns about targetPageBytes of stats.
+
+   The first page is of pagingSize and the next ones wait for its result.
+   From then on the pages don't wait: every result sizes the pages which are
+   not made yet from the bytes returned per minute, or makes them
+   maxPageGrowth times larger if no stats are returned. The sizes are
+   PAGING_SIZES up to maxPagingSize, and a page ends where a page of its
+   size starts, counting from endTime, so the pages of entity types with the
+   same size have the same time window.
+   """
+
+   def __init__(self, entityRefId, labels, endTime, minutes2Dump, pagingSize,
+                collectInterval, targetPageBytes, maxPagingSize=PAGING_SIZES[-1]):
+      self.entityRefId = entityRefId
+      self.labels = labels
+      self.endTime = endTime
+      self.collectInterval = collectInterval
+      self.targetPageBytes = targetPageBytes
+      self.maxPagingSize = maxPagingSize
+      # start at the same sample as buildRanges
+      self.startTime = endTime - datetime.timedelta(minutes=minutes2Dump)
+      if minutes2Dump >= pagingSize:
+         self.startTime += datetime.timedelta(seconds=collectInterval)
+      self.pagingSize = self._PagingSize(pagingSize)
+      # minutes from endTime to the end of the next page
+      self.offset = 0
+      self.probe = True
+      self.waiting = False
+      self.firstSpec = None
+
+   def NextSpec(self):
+      segEndTime = self.endTime - datetime.timedelta(minutes=self.offset)
+      if segEndTime < self.startTime:
+         return None
+      # end the page where a page of its size starts
+      minutes = self.pagingSize - self.offset % self.pagingSize
+      self.offset += minutes
+      segStartTime = segEndTime - datetime.timedelta(minutes=minutes) \
+                     + datetime.timedelta(seconds=self.collectInterval)
+      return self._MakeSpec(max(segStartTime, self.startTime), segEndTime)
+
+   def Update(self, querySpec, numSamples, numBytes):
+      QueryPager.Update(self, querySpec, numSamples, numBytes)
+      if numBytes is None:
+         return
+      minutes = (querySpec.endTime - querySpec.startTime).total_seconds() / 60.0 \
+                + self.collectInterval / 60.0
+      if numSamples and numBytes:
+         pagingSize = minutes * self.targetPageBytes / numBytes
+      else:
+         # nothing to size the pages from, grow them
+         pagingSize = self.pagingSize * maxPageGrowth
+      self.pagingSize = self._PagingSize(pagingSize)
+
+   def _PagingSize(self, minutes):
+      """Return the largest of PAGING_SIZES up to minutes and maxPagingSize."""
+      pagingSize = PAGING_SIZES[0]
+      for size in PAGING_SIZES:
+         if size <= minutes and size <= self.maxPagingSize:
+            pagingSize = size
+      return pagingSize
+
+class StatsPrinter(object):
+   """Print the pages of stats of a dump, each as a serialized
+   VsanPerfEntityMetricCSV array, with a separator between them.
+
+   A page whose first entity has no samples is not printed. With withHeader,
+   the first page printed follows a header, so it has no separator.
+   """
+
+   def __init__(self, separator, withHeader=True):
+      self.separator = separator
+      self.printSeparator = not withHeader
+      emptyArray = pyVmomi.SoapAdapter.Serialize(
+         vim.cluster.VsanPerfEntityMetricCSV.Array()).decode('utf-8')
+      head, sep, tail = emptyArray.rpartition('</')
+      self.head = head
+      self.tail = sep + tail + '\n'
+
+   def Print(self, statsArray):
+      """Print a page of stats deserialized by pyVmomi."""
+      if statsArray and self._Separate(statsArray[0].sampleInfo):
+         sys.stdout.write(pyVmomi.SoapAdapter.Serialize(statsArray).decode('utf-8') + '\n')
+
+   def Start(self, sampleInfo):
+      """Start printing a page, return False if it is not printed."""
+      if not self._Separate(sampleInfo):
+         return False
+      sys.stdout.write(self.head)
+      return True
+
+   def Write(self, xml):
+      sys.stdout.write(xml)
+
+   def End(self):
+      sys.stdout.write(self.tail)
+
+   def _Separate(self, sampleInfo):
+      if not sampleInfo:
+         return False
+      if self.printSeparator:
+         sys.stdout.write(self.separator + '\n')
+      self.printSeparator = True
+      return True
+
+class StatsPage(object):
+   """The stats returned for one query spec, as serialized XML.
+
+   The entities are added by soapStreamer.InvokeMethodStreaming as they are
+   parsed, without building data objects. They are kept until Stream() is
+   called, when the page is the next one to be printed, and from then on
+   they are printed by printer as they are added.
+   """
+
+   def __init__(self, printer):
+      self.printer = printer
+      self.lock = threading.Lock()
+      self.records = []
+      # sampleInfo of the first entity
+      self.sampleInfo = None
+      self.numSamples = 0
+      self.numBytes = 0
+      self.streaming = False
+      # whether printing the page is started, and whether it is printed
+      self.started = False
+      self.printing = False
+
+   def Add(self, xml, fields):
+      sampleInfo = (fields.get('sampleInfo') or [''])[0]
+      with self.lock:
+         if self.sampleInfo is None:
+            self.sampleInfo = sampleInfo
+         if sampleInfo:
+            self.numSamples += sampleInfo.count(',') + 1
+         self.numBytes += len(sampleInfo) + \
+                          sum(len(values) for values in fields.get('values', []))
+         if self.streaming:
+            self._Write(xml)
+         else:
+            self.records.append(xml)
+
+   def Reset(self):
+      """Drop the entities added, return False if some are printed."""
+      with self.lock:
+         if self.started:
+            return False
+         self.records = []
+         self.sampleInfo = None
+         self.numSamples = 0
+         self.numBytes = 0
+         return True
+
+   def Stream(self):
+      """Print the entities added so far, and the next ones as they are added."""
+      with self.lock:
+         if self.streaming:
+            return
+         self.streaming = True
+         for xml in self.records:
+            self._Write(xml)
+         self.records = []
+
+   def Print(self):
+      """Print the rest of the page."""
+      self.Stream()
+      with self.lock:
+         if self.printing:
+            self.printer.End()
+            self.printing = False
+
+   def _Write(self, xml):
+      if not self.started:
+         self.started = True
+         self.printing = self.printer.Start(self.sampleInfo)
+      if self.printing:
+         self.printer.Write(xml)
+
+def measureStats(stats):
+   """Return the number of samples and the size in bytes of the CSV stats of
+   query results."""
+   if isinstance(stats, StatsPage):
+      return stats.numSamples, stats.numBytes
+   numSamples = 0
+   numBytes = 0
+   for entityStats in stats:
+      sampleInfo = entityStats.sampleInfo or ''
+      if sampleInfo:
+         numSamples += sampleInfo.count(',') + 1
+      numBytes += len(sampleInfo)
+      for series in entityStats.value or []:
+         numBytes += len(series.values or '')
+   return numSamples, numBytes
+
+def getSpecEntityType(entityRefId):
+   return entityRefId.split(':', 1)[0]
+
+class PerfStatsCollector(object):
+   """Query perf stats for a list of query pagers with bounded concurrency.
+
+   Up to `concurrency` QueryVsanPerf calls run in parallel. Pages of the
+   same time window but of different entity types are sent together, up to
+   `batchSize` specs per call, and the returned entities are split back by
+   entity type. Several pages of a pager are queried at once, unless the
+   pager waits for a result to size its next page, or one of its pages
+   failed and the error is not yielded yet. Results are yielded in a fixed
+   order whatever the latencies: the first page of every pager in the order
+   of the pagers, then their second pages, and so on. Pages are sent in that
+   order but for the pagers which wait, and at most `maxBufferedPages` pages
+   are queried or wait to be yielded, which bounds the results kept in
+   memory, but for a batch sent with the next page to yield. Specs of an
+   entityRefId which failed once are sent alone, so they don't fail the
+   batches of others.
+
+   With a StatsPrinter, the results are streamed with soapStreamer into
+   StatsPages instead of being deserialized, and the page which is yielded
+   next is printed as it is received.
+   """
+
+   def __init__(self, vpm, queryPagers, concurrency=1, batchSize=1,
+                maxBufferedPages=None, printer=None):
+      self.vpm = vpm
+      self.printer = printer
+      self.streamResults = printer is not None
+      self.queryPagers = list(queryPagers)
+      self.concurrency = max(1, concurrency)
+      self.batchSize = max(1, batchSize)
+      self.maxBufferedPages = max(1, maxBufferedPages or
+                                  2 * self.concurrency * self.batchSize)
+      self.skippedRefIds = set()
+      self.failedRefIds = set()
+
+   def Skip(self, entityRefId):
+      """Don't query the pages of entityRefId which are not sent yet."""
+      self.skippedRefIds.add(entityRefId)
+
+   def Collect(self):
+      """Yield (querySpec, statsArray, exception) for every page queried."""
+      queryPagers = self.queryPagers
+      numPagers = len(queryPagers)
+      # [querySpec, (statsArray, exception) once queried, StatsPage if
+      # streamed] of the pages of every pager sent and not yielded yet
+      pages = [collections.deque() for _ in range(numPagers)]
+      numPages = 0
+      # number of pages of every pager sent, and yielded
+      numSent = [0] * numPagers
+      numYielded = [0] * numPagers
+      # spec of the next page of every pager, if it is not sent yet
+      nextSpecs = [None] * numPagers
+      # whether all the pages of a pager are made
+      done = [False] * numPagers
+      # failed pages of every pager which are not yielded yet, the next
+      # pages wait for the caller to see the errors, e.g. to skip them
+      failed = [0] * numPagers
+      # future -> (pager index, page) of its specs
+      futures = {}
+      with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+         while True:
+            while len(futures) < self.concurrency:
+               head = self._NextToYield(pages, numYielded, done)
+               if head is None:
+                  break
+               headSent = bool(pages[head])
+               room = self.maxBufferedPages - numPages
+               if headSent:
+                  if room < min(self.batchSize, self.maxBufferedPages):
+                     # wait for room for a full batch
+                     break
+               else:
+                  # the next page to yield is always sent
+                  room = self.batchSize
+               batch = self._NextBatch(numSent, nextSpecs, done, failed, max(1, room))
+               if not batch:
+                  if not headSent and done[head]:
+                     # the pager has no more pages
+                     continue
+                  break
+               statsPages = [StatsPage(self.printer) if self.streamResults else None
+                             for _ in batch]
+               future = executor.submit(self._Query, [querySpec for i, querySpec in batch],
+                                        statsPages)
+               futures[future] = []
+               for (i, querySpec), statsPage in zip(batch, statsPages):
+                  page = [querySpec, None, statsPage]
+                  pages[i].append(page)
+                  futures[future].append((i, page))
+                  numPages += 1
+                  numSent[i] += 1
+                  nextSpecs[i] = None
+            head = self._NextToYield(pages, numYielded, done)
+            if head is None:
+               break
+            if pages[head] and pages[head][0][1] is not None:
+               querySpec, (statsArray, ex), statsPage = pages[head].popleft()
+               numPages -= 1
+               numYielded[head] += 1
+               if ex is not None:
+                  failed[head] -= 1
+               yield querySpec, statsArray, ex
+               continue
+            if pages[head] and pages[head][0][2] is not None:
+               # print the next page to yield as it is received
+               pages[head][0][2].Stream()
+            finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+               results = future.result()
+               for i, page in futures.pop(future):
+                  querySpec = page[0]
+                  statsArray, ex = results[querySpec.entityRefId]
+                  numSamples = numBytes = None
+                  if ex is None:
+                     numSamples, numBytes = measureStats(statsArray)
+                  else:
+                     failed[i] += 1
+                  queryPagers[i].Update(querySpec, numSamples, numBytes)
+                  page[1] = (statsArray, ex)
+
+   @staticmethod
+   def _NextToYield(pages, numYielded, done):
+      """Return the index of the pager of the next page to yield, or None if
+      all the pages are yielded. It may not be sent yet, or even be made."""
+      head = None
+      for i in range(len(pages)):
+         if done[i] and not pages[i]:
+            continue
+         if head is None or numYielded[i] < numYielded[head]:
+            head = i
+      return head
+
+   def _NextBatch(self, numSent, nextSpecs, done, failed, maxSpecs):
+      """Pick up to maxSpecs ready pages to send in the next call, in the
+      order they are yielded."""
+      batch = []
+      entityTypes = set()
+      maxSpecs = min(self.batchSize, maxSpecs)
+      if maxSpecs <= 0:
+         return batch
+      order = sorted((numSent[i], i) for i in range(len(self.queryPagers))
+                     if not done[i])
+      for _, i in order:
+         if failed[i]:
+            continue
+         queryPager = self.queryPagers[i]
+         if queryPager.entityRefId in self.skippedRefIds:
+            # drop the spec made before the pager was skipped
+            nextSpecs[i] = None
+            done[i] = True
+            continue
+         if nextSpecs[i] is None:
+            if queryPager.waiting:
+               continue
+            nextSpecs[i] = queryPager.NextSpec()
+            if nextSpecs[i] is None:
+               done[i] = True
+               continue
+         querySpec = nextSpecs[i]
+         entityType = getSpecEntityType(querySpec.entityRefId)
+         if querySpec.entityRefId in self.failedRefIds:
+            if batch:
+               continue
+            return [(i, querySpec)]
+         if batch:
+            firstSpec = batch[0][1]
+            if entityType in entityTypes or \
+                  querySpec.startTime != firstSpec.startTime or \
+                  querySpec.endTime != firstSpec.endTime:
+               continue
+         batch.append((i, querySpec))
+         entityTypes.add(entityType)
+         if len(batch) >= maxSpecs:
+            break
+      return batch
+
+   def _Query(self, querySpecs, statsPages):
+      """Return entityRefId of spec -> (stats, exception)."""
+      results = {}
+      if len(querySpecs) > 1:
+         try:
+            statsList = self._QueryVsanPerf(querySpecs, statsPages)
+         except Exception as ex:
+            # Can't tell which spec failed, query them one by one, except
+            # those partly printed already
+            for querySpec, statsPage in zip(querySpecs, statsPages):
+               if statsPage is not None and not statsPage.Reset():
+                  statsPage.Print()
+                  results[querySpec.entityRefId] = (None, ex)
+         else:
+            return dict((querySpec.entityRefId, (stats, None))
+                        for querySpec, stats in zip(querySpecs, statsList))
+      for querySpec, statsPage in zip(querySpecs, statsPages):
+         if querySpec.entityRefId in results:
+            continue
+         try:
+            results[querySpec.entityRefId] = \
+               (self._QueryVsanPerf([querySpec], [statsPage])[0], None)
+         except Exception as ex:
+            if statsPage is not None:
+               # end the part of the page printed already
+               statsPage.Print()
+            self.failedRefIds.add(querySpec.entityRefId)
+            results[querySpec.entityRefId] = (None, ex)
+      return results
+
+   def _QueryVsanPerf(self, querySpecs, statsPages):
+      """Return the stats of every spec, split by entity type."""
+      entityTypes = [getSpecEntityType(querySpec.entityRefId) for querySpec in querySpecs]
+      if self.streamResults:
+         pageOfType = dict(zip(entityTypes, statsPages))
+         def addRecord(xml, fields):
+            statsPage = statsPages[0]
+            if len(statsPages) > 1:
+               entityRefId = (fields.get('entityRefId') or [''])[0]
+               statsPage = pageOfType.get(getSpecEntityType(entityRefId))
+            if statsPage is not None:
+               statsPage.Add(xml, fields)
+         statsArray = soapStreamer.InvokeMethodStreaming(self.vpm, 'QueryVsanPerf', addRecord,
+                                                         querySpecs=querySpecs)
+         if statsArray is None:
+            return statsPages
+         # The stub deserialized the stats, don't stream the next queries
+         self.streamResults = False
+      else:
+         statsArray = self.vpm.QueryVsanPerf(querySpecs=querySpecs)
+      if len(querySpecs) == 1:
+         return [statsArray]
+      entities = collections.defaultdict(list)
+      for stats in statsArray:
+         entities[getSpecEntityType(stats.entityRefId)].append(stats)
+      arrayType = type(statsArray)
+      return [arrayType(entities[entityType]) for entityType in entityTypes]
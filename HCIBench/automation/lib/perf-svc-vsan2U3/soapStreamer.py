@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2015-2024 Broadcom. All Rights Reserved.
+Broadcom Confidential. The term "Broadcom" refers to Broadcom Inc.
+and/or its subsidiaries.
+
+Streaming of the array results of SOAP calls for vsan-perfsvc-status.py.
+This module is uploaded to the host next to the script.
+
+The pyVmomi of ESXi can only deserialize the results into data objects, so
+this module wraps its SoapAdapter: Install() replaces the
+SoapResponseDeserializer which SoapStubAdapter.InvokeMethod creates for
+every response with SoapResponseStreamer. The responses of the calls made
+by InvokeMethodStreaming() are streamed to its handler, all the others are
+deserialized as before.
+"""
+
+import threading
+
+from pyVmomi import SoapAdapter
+
+
+# Names of the SoapAdapter of pyVmomi which the streaming is built on
+REQUIRED_NAMES = ('ExpatDeserializerNSHandlers', 'SoapResponseDeserializer',
+                  'SoapStubAdapter', 'GetHandlers', 'SetHandlers', 'GetWsdlName',
+                  'XmlEscape', 'NS_SEP')
+
+_ExpatDeserializerNSHandlers = getattr(SoapAdapter, 'ExpatDeserializerNSHandlers', object)
+_SoapResponseDeserializer = getattr(SoapAdapter, 'SoapResponseDeserializer', object)
+
+# handler of the InvokeMethodStreaming call of each thread, and whether its
+# result was streamed
+_local = threading.local()
+
+def CanStream():
+   """Return whether the SoapAdapter of pyVmomi can be wrapped."""
+   return all(hasattr(SoapAdapter, name) for name in REQUIRED_NAMES)
+
+def Install():
+   """Make the SOAP stubs stream the results of InvokeMethodStreaming().
+
+   Return False if the SoapAdapter of pyVmomi can't be wrapped.
+   """
+   if not CanStream():
+      return False
+   if SoapAdapter.SoapResponseDeserializer is _SoapResponseDeserializer:
+      SoapAdapter.SoapResponseDeserializer = SoapResponseStreamer
+   return SoapAdapter.SoapResponseDeserializer is SoapResponseStreamer
+
+def InvokeMethodStreaming(mo, methodName, handler, **kwargs):
+   """Call mo.<methodName>(**kwargs), and pass every element of its array
+   result to handler(xml, fields) as it is parsed (see SoapArrayStreamer).
+
+   Return None if the result is streamed, or the result if it is
+   deserialized instead, e.g. when the stub of mo doesn't parse its
+   responses with SoapAdapter.SoapResponseDeserializer.
+   """
+   _local.handler = handler
+   _local.streamed = False
+   try:
+      result = getattr(mo, methodName)(**kwargs)
+   finally:
+      _local.handler = None
+   if _local.streamed:
+      return None
+   return result
+
+class SoapArrayStreamer(_ExpatDeserializerNSHandlers):
+   """Pass every element of an array result to a handler as soon as it ends,
+   instead of building a data object for it.
+
+   The handler is called as handler(xml, fields). xml is the element as text,
+   with itemTag as its tag and without namespaces and attributes, the way
+   SoapAdapter.Serialize writes the items of an array. fields maps the tag
+   of every element without children to the list of their texts.
+   """
+
+   def __init__(self, handler, itemTag):
+      _ExpatDeserializerNSHandlers.__init__(self)
+      self.handler = handler
+      self.itemTag = itemTag
+      self.count = 0
+
+   def Stream(self, parser, nsMap=None):
+      """Take over the parser handlers for the content of the current element."""
+      self.parser = parser
+      self.origHandlers = SoapAdapter.GetHandlers(parser)
+      SoapAdapter.SetHandlers(parser, SoapAdapter.GetHandlers(self))
+      self.depth = 0
+      self.pieces = []
+      self.fields = {}
+      # text of the current element, while it has no children
+      self.data = None
+      if not nsMap:
+         nsMap = {}
+      self.nsMap = nsMap
+
+   def StartElementHandler(self, tag, attr):
+      self.depth += 1
+      if self.depth == 1:
+         self.pieces = ["<%s>" % self.itemTag]
+         self.fields = {}
+         self.data = None
+         return
+      self.pieces.append("<%s>" % tag.rpartition(SoapAdapter.NS_SEP)[2])
+      self.data = []
+
+   def CharacterDataHandler(self, data):
+      if self.depth > 1:
+         self.pieces.append(SoapAdapter.XmlEscape(data))
+         if self.data is not None:
+            self.data.append(data)
+
+   def EndElementHandler(self, tag):
+      if self.depth == 0:
+         # end of the response element
+         SoapAdapter.SetHandlers(self.parser, self.origHandlers)
+         handler = self.parser.EndElementHandler
+         del self.parser, self.origHandlers, self.pieces, self.fields, self.data
+         if handler:
+            return handler(tag)
+         return
+      self.depth -= 1
+      if self.depth == 0:
+         self.pieces.append("</%s>" % self.itemTag)
+         xml = "".join(self.pieces)
+         self.pieces = []
+         self.count += 1
+         self.handler(xml, self.fields)
+         return
+      name = tag.rpartition(SoapAdapter.NS_SEP)[2]
+      self.pieces.append("</%s>" % name)
+      if self.data is not None:
+         self.fields.setdefault(name, []).append("".join(self.data))
+         self.data = None
+
+class SoapResponseStreamer(_SoapResponseDeserializer):
+   """SoapResponseDeserializer which streams the array result of the
+   InvokeMethodStreaming call of its thread with SoapArrayStreamer.
+
+   Faults and the other results are deserialized.
+   """
+   streamer = None
+
+   def Deserialize(self, response, resultType, nsMap=None):
+      handler = getattr(_local, 'handler', None)
+      if handler is None or not issubclass(resultType, list):
+         return _SoapResponseDeserializer.Deserialize(self, response, resultType, nsMap)
+      # only the response of this call
+      _local.handler = None
+      self.streamer = SoapArrayStreamer(handler, SoapAdapter.GetWsdlName(resultType.Item))
+      result = _SoapResponseDeserializer.Deserialize(self, response, resultType, nsMap)
+      if self.isFault:
+         return result
+      _local.streamed = True
+      return self.streamer.count
+
+   def StartElementHandler(self, tag, attr):
+      if self.streamer is not None and not self.isFault and \
+            tag != self.soapFaultTag and tag.endswith("Response"):
+         self.data = ""
+         self.streamer.Stream(self.parser, self.nsMap)
+      else:
+         _SoapResponseDeserializer.StartElementHandler(self, tag, attr)
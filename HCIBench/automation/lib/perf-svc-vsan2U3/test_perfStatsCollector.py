@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2015-2024 Broadcom. All Rights Reserved.
+Broadcom Confidential. The term "Broadcom" refers to Broadcom Inc.
+and/or its subsidiaries.
+
+Tests of perfStatsCollector.PerfStatsCollector against a mock of the vSAN
+performance manager, which answers QueryVsanPerf after a fixed latency.
+
+Off ESXi, pyVmomi and the vSAN types are taken from parse-support-bundle.
+Run with:
+   python -m unittest test_perfStatsCollector
+"""
+
+import datetime
+import os
+import sys
+import threading
+import time
+import unittest
+
+try:
+   import pyVmomi
+except ImportError:
+   libDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                         'parse-support-bundle')
+   sys.path.append(os.path.join(libDir, 'pyVpx'))
+   sys.path.append(os.path.join(libDir, 'scripts'))
+   import pyVmomi
+from pyVmomi import vim, vmodl
+os.environ['VSAN_PYMO_SKIP_VC_CONN'] = '1'
+import vsanmgmtObjects
+
+from perfStatsCollector import AdaptiveQueryPager, PerfStatsCollector, QueryPager
+
+END_TIME = datetime.datetime(2024, 1, 3)
+
+
+class MockPerformanceManager(object):
+   """Answers QueryVsanPerf after `latency` secs, with the samples every 5
+   minutes of the window of every spec, for `numEntities` entities.
+
+   The tables of `missingTypes` don't exist, so the specs of these entity
+   types fail with InvalidArgument, even in a batch. `latencies` overrides
+   the latency of some entity types.
+   """
+
+   def __init__(self, latency=0.01, numEntities=1, missingTypes=(), latencies=None):
+      self.latency = latency
+      self.latencies = latencies or {}
+      self.numEntities = numEntities
+      self.missingTypes = set(missingTypes)
+      self.lock = threading.Lock()
+      self.batches = []
+      self.inflight = 0
+      self.maxInflight = 0
+
+   def QueryVsanPerf(self, querySpecs):
+      with self.lock:
+         self.batches.append([querySpec.entityRefId for querySpec in querySpecs])
+         self.inflight += 1
+         self.maxInflight = max(self.maxInflight, self.inflight)
+      try:
+         time.sleep(max(self.latencies.get(querySpec.entityRefId.split(':')[0],
+                                           self.latency)
+                        for querySpec in querySpecs))
+         result = vim.cluster.VsanPerfEntityMetricCSV.Array()
+         for querySpec in querySpecs:
+            entityType = querySpec.entityRefId.split(':')[0]
+            if entityType in self.missingTypes:
+               raise vmodl.fault.InvalidArgument(invalidProperty='entityRefId')
+            timestamps = []
+            timestamp = querySpec.startTime
+            while timestamp <= querySpec.endTime:
+               timestamps.append(timestamp.strftime('%Y-%m-%d %H:%M:%S'))
+               timestamp += datetime.timedelta(minutes=5)
+            for i in range(self.numEntities):
+               result.append(vim.cluster.VsanPerfEntityMetricCSV(
+                  entityRefId='%s:%d' % (entityType, i),
+                  sampleInfo=','.join(timestamps),
+                  value=[vim.cluster.VsanPerfMetricSeriesCSV(
+                     metricId=vim.cluster.VsanPerfMetricId(label='iops'),
+                     values=','.join(['100'] * len(timestamps)))]))
+         return result
+      finally:
+         with self.lock:
+            self.inflight -= 1
+
+
+def MakePagers(numPagers, numPages, probe=False, shift=0):
+   """Pagers of numPages one hour pages from `shift` minutes before END_TIME
+   backwards."""
+   queryPagers = []
+   endTime = END_TIME - datetime.timedelta(minutes=shift)
+   for i in range(numPagers):
+      ranges = [(endTime - datetime.timedelta(minutes=60 * page + 55),
+                 endTime - datetime.timedelta(hours=page))
+                for page in range(numPages)]
+      queryPager = QueryPager('table%d:*' % i, None, ranges, probe=probe)
+      queryPager.numPages = numPages
+      queryPagers.append(queryPager)
+   return queryPagers
+
+
+def MakeAdaptivePagers(numPagers, hours, targetPageBytes):
+   return [AdaptiveQueryPager('table%d:*' % i, None, END_TIME, hours * 60, 60,
+                              300, targetPageBytes)
+           for i in range(numPagers)]
+
+
+class PerfStatsCollectorTest(unittest.TestCase):
+   def collect(self, vpm, queryPagers, **kwargs):
+      collector = PerfStatsCollector(vpm, queryPagers, **kwargs)
+      return list(collector.Collect())
+
+   def assertAllPages(self, results, queryPagers):
+      """Assert that all the pages are yielded, those of a pager in order."""
+      expected = dict((queryPager.entityRefId, list(range(queryPager.numPages)))
+                      for queryPager in queryPagers)
+      got = dict((queryPager.entityRefId, []) for queryPager in queryPagers)
+      for querySpec, statsArray, ex in results:
+         self.assertIsNone(ex)
+         self.assertEqual(statsArray[0].entityRefId.split(':')[0],
+                          querySpec.entityRefId.split(':')[0])
+         page = int((END_TIME - querySpec.endTime).total_seconds()) // 3600
+         got[querySpec.entityRefId].append(page)
+      self.assertEqual(got, expected)
+
+   def assertContiguous(self, results, hours):
+      """Assert that the pages of every pager cover the hours before END_TIME."""
+      endTimes = {}
+      for querySpec, statsArray, ex in results:
+         self.assertIsNone(ex)
+         endTime = endTimes.get(querySpec.entityRefId, END_TIME)
+         self.assertEqual(querySpec.endTime, endTime)
+         self.assertLess(querySpec.startTime, querySpec.endTime)
+         endTimes[querySpec.entityRefId] = \
+            querySpec.startTime - datetime.timedelta(minutes=5)
+      for endTime in endTimes.values():
+         self.assertEqual(endTime, END_TIME - datetime.timedelta(hours=hours))
+
+   def testSequential(self):
+      vpm = MockPerformanceManager(latency=0)
+      queryPagers = MakePagers(3, 4)
+      results = self.collect(vpm, queryPagers)
+      self.assertAllPages(results, queryPagers)
+      # the first page of every pager, then the second ones, and so on
+      self.assertEqual([querySpec.entityRefId for querySpec, statsArray, ex in results],
+                       ['table0:*', 'table1:*', 'table2:*'] * 4)
+      self.assertEqual(len(vpm.batches), 12)
+      self.assertEqual(vpm.maxInflight, 1)
+
+   def testConcurrent(self):
+      vpm = MockPerformanceManager(latency=0.02)
+      queryPagers = MakePagers(8, 4)
+      start = time.time()
+      results = self.collect(vpm, queryPagers, concurrency=4)
+      elapsed = time.time() - start
+      self.assertAllPages(results, queryPagers)
+      self.assertEqual(vpm.maxInflight, 4)
+      # 32 calls of 20ms, 4 at a time
+      self.assertLess(elapsed, 32 * 0.02 / 2)
+
+   def testConcurrentPagesOfOnePager(self):
+      vpm = MockPerformanceManager(latency=0.01)
+      queryPagers = MakePagers(1, 8)
+      results = self.collect(vpm, queryPagers, concurrency=4)
+      self.assertAllPages(results, queryPagers)
+      self.assertEqual(vpm.maxInflight, 4)
+
+   def testBatches(self):
+      vpm = MockPerformanceManager(latency=0.005)
+      queryPagers = MakePagers(8, 3)
+      results = self.collect(vpm, queryPagers, concurrency=2, batchSize=4)
+      self.assertAllPages(results, queryPagers)
+      self.assertEqual(len(vpm.batches), 6)
+      for batch in vpm.batches:
+         self.assertEqual(len(batch), 4)
+         # one spec of an entity type per call
+         self.assertEqual(len(set(batch)), len(batch))
+
+   def testMaxBufferedPages(self):
+      vpm = MockPerformanceManager(latency=0.005)
+      queryPagers = MakePagers(4, 6)
+      collector = PerfStatsCollector(vpm, queryPagers, concurrency=4,
+                                     maxBufferedPages=3)
+      results = []
+      for result in collector.Collect():
+         # 3 pages, including the yielded one
+         self.assertLessEqual(sum(len(batch) for batch in vpm.batches),
+                              len(results) + 3)
+         results.append(result)
+      self.assertAllPages(results, queryPagers)
+      self.assertLessEqual(vpm.maxInflight, 3)
+
+   def testFailedSpecSentAlone(self):
+      vpm = MockPerformanceManager(latency=0, missingTypes=['table1'])
+      queryPagers = MakePagers(3, 3)
+      results = self.collect(vpm, queryPagers, concurrency=1, batchSize=3)
+      failed = [querySpec.entityRefId for querySpec, statsArray, ex in results
+                if ex is not None]
+      self.assertEqual(failed, ['table1:*'] * 3)
+      for querySpec, statsArray, ex in results:
+         if ex is not None:
+            self.assertIsInstance(ex, vmodl.fault.InvalidArgument)
+      # the first batch failed and was retried spec by spec, then the
+      # specs of table1 are not batched any more
+      self.assertEqual(vpm.batches[:4], [['table0:*', 'table1:*', 'table2:*'],
+                                         ['table0:*'], ['table1:*'], ['table2:*']])
+      for batch in vpm.batches[4:]:
+         self.assertTrue(batch == ['table1:*'] or 'table1:*' not in batch)
+
+   def testSkip(self):
+      vpm = MockPerformanceManager(latency=0.005, missingTypes=['table0'])
+      queryPagers = MakePagers(2, 5)
+      collector = PerfStatsCollector(vpm, queryPagers)
+      results = []
+      for querySpec, statsArray, ex in collector.Collect():
+         if ex is not None:
+            collector.Skip(querySpec.entityRefId)
+         results.append((querySpec.entityRefId, ex is None))
+      self.assertEqual(results, [('table0:*', False)] + [('table1:*', True)] * 5)
+      # no page of table0 is sent after the failed one
+      self.assertEqual([batch for batch in vpm.batches if batch == ['table0:*']],
+                       [['table0:*']])
+
+   def testProbe(self):
+      vpm = MockPerformanceManager(latency=0.005, missingTypes=['table0'])
+      queryPagers = MakePagers(2, 5, probe=True)
+      collector = PerfStatsCollector(vpm, queryPagers, concurrency=4)
+      results = []
+      for querySpec, statsArray, ex in collector.Collect():
+         if ex is not None:
+            collector.Skip(querySpec.entityRefId)
+         results.append((querySpec.entityRefId, ex is None))
+      # the table which may be missing is queried once, then its next pages
+      # wait for the caller to see the error
+      self.assertEqual([batch for batch in vpm.batches if batch == ['table0:*']],
+                       [['table0:*']])
+      self.assertEqual(results[0], ('table0:*', False))
+      self.assertEqual(len(results), 6)
+      # and the pages of a table which exists don't wait after the first one
+      vpm = MockPerformanceManager(latency=0.01)
+      queryPagers = MakePagers(1, 8, probe=True)
+      results = self.collect(vpm, queryPagers, concurrency=4)
+      self.assertAllPages(results, queryPagers)
+      self.assertEqual(vpm.batches[0], ['table0:*'])
+      self.assertEqual(vpm.maxInflight, 4)
+
+   def testSkipMadeSpec(self):
+      # The pages of table1 don't have the window of those of table0, so the
+      # first spec of table1 is made while the batch of table0 is picked, and
+      # kept until there is room to send it.
+      vpm = MockPerformanceManager(latency=0.002)
+      queryPagers = MakePagers(1, 5, probe=True) + MakePagers(2, 5, shift=30)[1:]
+      collector = PerfStatsCollector(vpm, queryPagers, batchSize=2,
+                                     maxBufferedPages=1)
+      results = []
+      for querySpec, statsArray, ex in collector.Collect():
+         if not results:
+            collector.Skip('table1:*')
+         results.append(querySpec.entityRefId)
+      self.assertEqual(results, ['table0:*'] * 5)
+      # the spec made before table1 was skipped is not sent
+      self.assertEqual(vpm.batches, [['table0:*']] * 5)
+
+   def testOrderIndependentOfLatency(self):
+      orders = []
+      for latencies in ({'table0': 0.03}, {'table1': 0.01, 'table2': 0.03}):
+         vpm = MockPerformanceManager(latency=0.002, latencies=latencies)
+         # table0 and table1 wait for their first page, table2 and table3
+         # have other windows
+         queryPagers = MakePagers(2, 4, probe=True) + \
+                       MakePagers(4, 4, shift=30)[2:]
+         results = self.collect(vpm, queryPagers, concurrency=4, batchSize=2)
+         self.assertAllPages(results, queryPagers)
+         orders.append([(querySpec.entityRefId, querySpec.startTime, querySpec.endTime)
+                        for querySpec, statsArray, ex in results])
+      self.assertEqual(orders[0], orders[1])
+      self.assertEqual([entityRefId for entityRefId, startTime, endTime in orders[0]],
+                       ['table0:*', 'table1:*', 'table2:*', 'table3:*'] * 4)
+
+   def testAdaptivePaging(self):
+      vpm = MockPerformanceManager(latency=0.005, numEntities=20)
+      queryPagers = MakeAdaptivePagers(1, 48, 64 * 1024)
+      results = self.collect(vpm, queryPagers, concurrency=4)
+      self.assertContiguous(results, 48)
+      # the first page waits for nothing, and the second one for the first
+      self.assertEqual(vpm.batches[0], ['table0:*'])
+      self.assertEqual(vpm.maxInflight, 4)
+      sizes = [int((querySpec.endTime - querySpec.startTime).total_seconds()) // 60 + 5
+               for querySpec, statsArray, ex in results]
+      # 20 entities return about 95 bytes a minute, so the next pages are
+      # of 360 minutes, the first one ending where a page of 360 starts
+      self.assertEqual(sizes[:3], [60, 300, 360])
+      self.assertEqual(set(sizes[2:]), set([360]))
+
+   def testAdaptivePagesBatched(self):
+      orders = []
+      for latencies in ({}, {'table1': 0.02}, {'table0': 0.02, 'table3': 0.01}):
+         vpm = MockPerformanceManager(latency=0.005, numEntities=20,
+                                      latencies=latencies)
+         queryPagers = MakeAdaptivePagers(4, 48, 64 * 1024)
+         results = self.collect(vpm, queryPagers, concurrency=2, batchSize=4)
+         self.assertContiguous(results, 48)
+         self.assertEqual(len(results), 4 * 9)
+         self.assertEqual(len(vpm.batches), 9)
+         self.assertEqual(set(len(batch) for batch in vpm.batches), set([4]))
+         orders.append([(querySpec.entityRefId, querySpec.startTime, querySpec.endTime)
+                        for querySpec, statsArray, ex in results])
+      # the slow tables do not change the order of the pages
+      self.assertEqual(orders[1], orders[0])
+      self.assertEqual(orders[2], orders[0])
+
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2015-2024 Broadcom. All Rights Reserved.
+Broadcom Confidential. The term "Broadcom" refers to Broadcom Inc.
+and/or its subsidiaries.
+
+Tests of soapStreamer, and of PerfStatsCollector streaming the stats, with
+the SoapStubAdapter of pyVmomi against a local stub of the vSAN performance
+manager.
+
+Off ESXi, pyVmomi and the vSAN types are taken from parse-support-bundle.
+Run with:
+   python -m unittest test_soapStreamer
+"""
+
+import contextlib
+import datetime
+import io
+import os
+import re
+import sys
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+try:
+   import pyVmomi
+except ImportError:
+   libDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                         'parse-support-bundle')
+   sys.path.append(os.path.join(libDir, 'pyVpx'))
+   sys.path.append(os.path.join(libDir, 'scripts'))
+   import pyVmomi
+from pyVmomi import SoapAdapter, vim, vmodl
+from pyVmomi.VmomiSupport import Object
+os.environ['VSAN_PYMO_SKIP_VC_CONN'] = '1'
+import vsanmgmtObjects
+
+import soapStreamer
+from perfStatsCollector import PerfStatsCollector, QueryPager, StatsPrinter, measureStats
+
+END_TIME = datetime.datetime(2024, 1, 3)
+SEPARATOR = '--------------Stats Segment Separator--------------'
+QUERY_INFO = vim.cluster.VsanPerformanceManager._GetMethodInfo('QueryVsanPerf')
+
+FAULT = '''<soapenv:Fault><faultcode>ServerFaultCode</faultcode>
+<faultstring>no such column: q</faultstring><detail>
+<SystemErrorFault xmlns="urn:vim25" xsi:type="SystemError"><reason>no such column: q</reason>
+</SystemErrorFault></detail></soapenv:Fault>'''
+
+
+def MakeStats(entityRefId, startTime, endTime, numEntities):
+   """Stats every 5 minutes of the window, with text to escape in a label."""
+   entityType = entityRefId.split(':')[0]
+   timestamps = []
+   timestamp = startTime
+   while timestamp <= endTime:
+      timestamps.append(timestamp.strftime('%Y-%m-%d %H:%M:%S'))
+      timestamp += datetime.timedelta(minutes=5)
+   statsArray = vim.cluster.VsanPerfEntityMetricCSV.Array()
+   for i in range(numEntities):
+      statsArray.append(vim.cluster.VsanPerfEntityMetricCSV(
+         entityRefId='%s:%d' % (entityType, i),
+         sampleInfo=','.join(timestamps),
+         value=[vim.cluster.VsanPerfMetricSeriesCSV(
+                   metricId=vim.cluster.VsanPerfMetricId(label=label),
+                   values=','.join(str(i * j) for j in range(len(timestamps))))
+                for label in ('iops', 'latency<us>&')]))
+   return statsArray
+
+
+class StubVsanHandler(BaseHTTPRequestHandler):
+   def do_POST(self):
+      request = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')
+      with self.server.lock:
+         self.server.numRequests += 1
+      if self.server.fault:
+         status, body = 500, FAULT
+      else:
+         status = 200
+         statsArray = vim.cluster.VsanPerfEntityMetricCSV.Array()
+         for spec in re.findall(r'<querySpecs[^>]*>(.*?)</querySpecs>', request, re.S):
+            entityRefId = re.search(r'<entityRefId>(.*?)</entityRefId>', spec).group(1)
+            startTime, endTime = [
+               datetime.datetime.strptime(
+                  re.search(r'<%s>(.{19})' % tag, spec).group(1), '%Y-%m-%dT%H:%M:%S')
+               for tag in ('startTime', 'endTime')]
+            statsArray.extend(MakeStats(entityRefId, startTime, endTime,
+                                        self.server.numEntities))
+         body = '<%sResponse xmlns="urn:vsan">%s</%sResponse>' % (
+            QUERY_INFO.wsdlName,
+            SoapAdapter.SerializeToStr(
+               statsArray, Object(name='returnval', type=QUERY_INFO.result,
+                                  version=QUERY_INFO.version, flags=SoapAdapter.F_OPTIONAL),
+               QUERY_INFO.version, {'urn:vsan': ''}),
+            QUERY_INFO.wsdlName)
+      response = (SoapAdapter.SOAP_START + body + SoapAdapter.SOAP_END).encode('utf-8')
+      self.send_response(status)
+      self.send_header('Content-Type', 'text/xml')
+      self.send_header('Content-Length', str(len(response)))
+      self.end_headers()
+      self.wfile.write(response)
+
+   def log_message(self, *args):
+      pass
+
+
+class StubVsanServer(ThreadingMixIn, HTTPServer):
+   daemon_threads = True
+
+   def __init__(self, numEntities=2):
+      HTTPServer.__init__(self, ('127.0.0.1', 0), StubVsanHandler)
+      self.lock = threading.Lock()
+      self.numEntities = numEntities
+      self.fault = False
+      self.numRequests = 0
+      self.thread = threading.Thread(target=self.serve_forever)
+      self.thread.daemon = True
+      self.thread.start()
+
+   def stop(self):
+      self.shutdown()
+      self.server_close()
+
+
+def MakePagers(numPagers, numPages):
+   queryPagers = []
+   for i in range(numPagers):
+      ranges = [(END_TIME - datetime.timedelta(minutes=60 * page + 55),
+                 END_TIME - datetime.timedelta(hours=page))
+                for page in range(numPages)]
+      queryPagers.append(QueryPager('table%d:*' % i, None, ranges))
+   return queryPagers
+
+
+class SoapStreamerTest(unittest.TestCase):
+   def setUp(self):
+      self.assertTrue(soapStreamer.Install())
+      self.server = StubVsanServer()
+      self.addCleanup(self.server.stop)
+      stub = SoapAdapter.SoapStubAdapter('127.0.0.1', port=-self.server.server_address[1],
+                                         version='vim.version.version10', path='/vsan')
+      self.vpm = vim.cluster.VsanPerformanceManager('vsan-performance-manager', stub)
+      self.querySpecs = [vim.cluster.VsanPerfQuerySpec(
+         entityRefId='table0:*', startTime=END_TIME - datetime.timedelta(minutes=55),
+         endTime=END_TIME)]
+
+   def testSameAsSerialized(self):
+      statsArray = self.vpm.QueryVsanPerf(querySpecs=self.querySpecs)
+      self.assertEqual(len(statsArray), 2)
+      records = []
+      result = soapStreamer.InvokeMethodStreaming(
+         self.vpm, 'QueryVsanPerf', lambda xml, fields: records.append((xml, fields)),
+         querySpecs=self.querySpecs)
+      self.assertIsNone(result)
+      serialized = SoapAdapter.Serialize(statsArray).decode('utf-8')
+      head, sep, tail = SoapAdapter.Serialize(type(statsArray)()).decode('utf-8').rpartition('</')
+      self.assertEqual(head + ''.join(xml for xml, fields in records) + sep + tail, serialized)
+      fields = records[1][1]
+      self.assertEqual(fields['entityRefId'], ['table0:1'])
+      self.assertEqual(fields['sampleInfo'], [statsArray[1].sampleInfo])
+      self.assertEqual(fields['values'], [series.values for series in statsArray[1].value])
+      self.assertEqual(fields['label'], ['iops', 'latency<us>&'])
+
+   def testFault(self):
+      self.server.fault = True
+      with self.assertRaises(vmodl.fault.SystemError):
+         soapStreamer.InvokeMethodStreaming(self.vpm, 'QueryVsanPerf', None,
+                                            querySpecs=self.querySpecs)
+      # the handler is only for the call of InvokeMethodStreaming
+      self.server.fault = False
+      self.assertEqual(len(self.vpm.QueryVsanPerf(querySpecs=self.querySpecs)), 2)
+
+   def testNotStreamed(self):
+      # e.g. a stub which doesn't parse its responses with SoapAdapter
+      SoapAdapter.SoapResponseDeserializer = soapStreamer._SoapResponseDeserializer
+      self.addCleanup(soapStreamer.Install)
+      records = []
+      result = soapStreamer.InvokeMethodStreaming(
+         self.vpm, 'QueryVsanPerf', lambda xml, fields: records.append(xml),
+         querySpecs=self.querySpecs)
+      self.assertEqual(len(result), 2)
+      self.assertEqual(records, [])
+
+   def collect(self, **kwargs):
+      """Return the output of a dump of 3 entity types, and the sizes of
+      their pages."""
+      printer = StatsPrinter(SEPARATOR)
+      collector = PerfStatsCollector(self.vpm, MakePagers(3, 4),
+                                     printer=printer if kwargs.pop('stream') else None,
+                                     **kwargs)
+      sizes = []
+      out = io.StringIO()
+      with contextlib.redirect_stdout(out):
+         for querySpec, statsArray, ex in collector.Collect():
+            self.assertIsNone(ex)
+            sizes.append(measureStats(statsArray))
+            if isinstance(statsArray, list):
+               printer.Print(statsArray)
+            else:
+               statsArray.Print()
+      return out.getvalue(), sizes
+
+   def testCollectStreaming(self):
+      for kwargs in ({}, {'concurrency': 4}, {'concurrency': 2, 'batchSize': 3}):
+         expected, expectedSizes = self.collect(stream=False, **kwargs)
+         self.assertEqual(expected.count(SEPARATOR), 11)
+         output, sizes = self.collect(stream=True, **kwargs)
+         self.assertEqual(output, expected)
+         # the same stats are measured when they are streamed
+         self.assertEqual(sizes, expectedSizes)
+
+   def testPrintHeadPage(self):
+      printer = StatsPrinter(SEPARATOR)
+      collector = PerfStatsCollector(self.vpm, MakePagers(1, 3), printer=printer)
+      out = io.StringIO()
+      with contextlib.redirect_stdout(out):
+         results = collector.Collect()
+         querySpec, statsPage, ex = next(results)
+         # the first page is printed as it is received, but not ended
+         self.assertTrue(out.getvalue().startswith(printer.head))
+         self.assertEqual(out.getvalue().count('<VsanPerfEntityMetricCSV>'), 2)
+         self.assertFalse(out.getvalue().endswith(printer.tail))
+         statsPage.Print()
+         self.assertTrue(out.getvalue().endswith(printer.tail))
+
+
+if __name__ == '__main__':
+   unittest.main()
@@ -26,9 +26,14 @@ if not onEsx:
 import pyVmomi
 from pyVmomi import vim, vmodl
 import datetime
+import json
 import time
 import subprocess
 
+from perfStatsCollector import QueryPager, AdaptiveQueryPager, PerfStatsCollector, StatsPrinter, \
+                               getSpecEntityType
+import soapStreamer
+
 if onEsx:
    import vsanPerfPyMo
    import cliutils
@@ -219,6 +224,16 @@ parser.add_argument("-et", "--endtime", help="end timestamp of query", type=int,
 parser.add_argument("-host", "--hostname", help="ESXi host to connect", dest="hostname")
 parser.add_argument("-n", "--username", help="ESXi host username", dest="username")
 parser.add_argument("-p", "--password", nargs='*', help="ESXi host password", dest="password")
+parser.add_argument("-c", "--concurrency", help="max number of perf queries in flight, default value is 4",
+                  type=int, dest="concurrency", default=4)
+parser.add_argument("-b", "--batchsize", help="max number of query specs sent in one perf query, default value is 4",
+                  type=int, dest="batchSize", default=4)
+parser.add_argument("-pb", "--pagebytes", help="target size in bytes of the stats returned by one query page,\n"
+                  "0 to use the fixed paging size, default value is 2097152",
+                  type=int, dest="pageBytes", default=2 * 1024 * 1024)
+parser.add_argument("-sc", "--schemacache", help="file to save the stats tables and columns missing on each ESXi build,\n"
+                  "empty to disable, default value is /tmp/vsan-perfsvc-schema.json",
+                  dest="schemaCache", default="/tmp/vsan-perfsvc-schema.json")
 
 args = parser.parse_args()
 
@@ -239,6 +254,10 @@ checkStartTimeAndEndTime(startTime, endTime)
 hostname = args.hostname
 username = args.username
 passwords = args.password
+queryConcurrency = max(1, args.concurrency)
+queryBatchSize = max(1, args.batchSize)
+pageTargetBytes = max(0, args.pageBytes)
+schemaCacheFile = args.schemaCache
 
 if unit == "day":
    hours2Dump = time2Dump * 24
@@ -311,6 +330,10 @@ vpm = vim.cluster.VsanPerformanceManager(
                       "vsan-performance-manager",
                        vsanStub)
 
+# Print the stats as they are received, instead of deserializing and
+# serializing them again, if the SOAP adapter of pyVmomi can be wrapped.
+canStreamResults = soapStreamer.Install()
+
 # dump perfsvc info
 # gather perf service node info and stats object info if it is a stats master
 nodeInfos = vpm.QueryNodeInformation()
@@ -920,6 +943,7 @@ def buildRanges(minutes2Dump, endTime, priority, entityType, pagingSize=None, co
       yield (segStartTime, segEndTime)
 
 def buildQuerySpec(priority="P0", endTime=None, startTime=None, pagingSize=None, collectInterval=None):
+   """Return a QueryPager for every entity type of the priority."""
    if endTime is None:
       endTime = datetime.datetime.utcnow()
       minutes2Dump = hours2Dump * 60
@@ -928,48 +952,157 @@ def buildQuerySpec(priority="P0", endTime=None, startTime=None, pagingSize=None,
       startTime = datetime.datetime.utcfromtimestamp(startTime)
       minutes2Dump = int((endTime - startTime).total_seconds() // 60)
 
-   querySpecs = []
+   queryPagers = []
    metrics = supportBundlePriorityMetrics.get(priority)
    if not metrics:
       return []
 
    for entityType, fields in metrics.items():
-      ranges = buildRanges(minutes2Dump, endTime, priority, entityType, pagingSize=pagingSize, collectInterval=collectInterval)
-      for segStartTime, segEndTime in ranges:
-         if fields == allFields:
-            fields = None
-         if entityType == "computeCluster-remotedomclient":
-            hSpec = vim.cluster.VsanPerfQuerySpec(
-            entityRefId='%s:*|*' % entityType,
-            startTime=segStartTime,
-            endTime=segEndTime,
-            labels = fields
-         )
-         else:
-            hSpec = vim.cluster.VsanPerfQuerySpec(
-               entityRefId='%s:*' % entityType,
-               startTime=segStartTime,
-               endTime=segEndTime,
-               labels = fields
-            )
-         querySpecs.append(hSpec)
-   return querySpecs
-
-# Refine the querSpecs according to the first round result.
+      # Don't query the tables and columns known to be missing on this build,
+      # the tables cached by an earlier run are probed with one page first
+      if schemaCache.IsMissingEntityType(entityType):
+         continue
+      probe = schemaCache.IsCachedMissingEntityType(entityType)
+      if fields == allFields:
+         fields = None
+      else:
+         fields = schemaCache.GetValidLabels(entityType, fields)
+      if entityType == "computeCluster-remotedomclient":
+         entityRefId = '%s:*|*' % entityType
+      else:
+         entityRefId = '%s:*' % entityType
+      # Only adapt the default paging, the paging of long retention stats
+      # is part of their retention settings.
+      if not pagingSize and pageTargetBytes and \
+            entityType not in LONG_RETENTION_STATS_ENTITY_TYPES:
+         queryPagers.append(AdaptiveQueryPager(
+            entityRefId, fields, endTime, minutes2Dump,
+            getPagingSize(priority, entityType),
+            collectInterval or getCollectInterval(entityType),
+            pageTargetBytes, maxPagingSize=60 * QUERY_TIME_RANGE_12_HOURS))
+      else:
+         ranges = buildRanges(minutes2Dump, endTime, priority, entityType,
+                              pagingSize=pagingSize, collectInterval=collectInterval)
+         queryPagers.append(QueryPager(entityRefId, fields, ranges, probe=probe))
+   return queryPagers
+
+class SchemaCache(object):
+   """Stats tables and columns known to be missing on each ESXi build.
+
+   The file keeps, for every build, the entity types whose table doesn't
+   exist and the labels which are not a column of their table, so the
+   queries known to fail are not sent again, not even in the next run.
+   The tables cached by an earlier run are only skipped once a query
+   confirms they are still missing in this run, and are dropped from the
+   cache once one is answered.
+   """
+   VERSION = 1
+
+   def __init__(self, filename, build):
+      self.filename = filename
+      self.build = build
+      self.builds = {}
+      self.changed = False
+      if filename and build:
+         self.Load()
+      schema = self.builds.setdefault(build, {})
+      self.missingEntityTypes = set(schema.get('missingEntityTypes', []))
+      # missing entity types confirmed by a query of this run
+      self.confirmedEntityTypes = set()
+      self.missingLabels = dict((entityType, set(labels)) for entityType, labels
+                                in schema.get('missingLabels', {}).items())
+
+   def Load(self):
+      try:
+         with open(self.filename) as f:
+            content = json.load(f)
+         if content.get('version') == self.VERSION:
+            self.builds = content['builds']
+      except (IOError, OSError, ValueError, KeyError, AttributeError):
+         self.builds = {}
+
+   def Save(self):
+      if not self.filename or not self.build or not self.changed:
+         return
+      self.builds[self.build] = {
+         'missingEntityTypes': sorted(self.missingEntityTypes),
+         'missingLabels': dict((entityType, sorted(labels)) for entityType, labels
+                               in self.missingLabels.items()),
+      }
+      tmpFilename = '%s.%d.tmp' % (self.filename, os.getpid())
+      try:
+         with open(tmpFilename, 'w') as f:
+            json.dump({'version': self.VERSION, 'builds': self.builds}, f,
+                      indent=1, sort_keys=True)
+         os.rename(tmpFilename, self.filename)
+         self.changed = False
+      except (IOError, OSError):
+         # the cache is only an optimization
+         pass
+
+   def IsMissingEntityType(self, entityType):
+      return entityType in self.confirmedEntityTypes
+
+   def IsCachedMissingEntityType(self, entityType):
+      return entityType in self.missingEntityTypes
+
+   def GetValidLabels(self, entityType, labels):
+      """Return the labels before the first one known to be missing."""
+      missingLabels = self.missingLabels.get(entityType)
+      if not missingLabels:
+         return labels
+      for i, label in enumerate(labels):
+         if label in missingLabels:
+            return labels[:i]
+      return labels
+
+   def AddMissingEntityType(self, entityType):
+      self.confirmedEntityTypes.add(entityType)
+      if entityType not in self.missingEntityTypes:
+         self.missingEntityTypes.add(entityType)
+         self.changed = True
+
+   def RemoveMissingEntityType(self, entityType):
+      if entityType in self.missingEntityTypes:
+         self.missingEntityTypes.discard(entityType)
+         self.changed = True
+
+   def AddMissingLabel(self, entityType, label):
+      labels = self.missingLabels.setdefault(entityType, set())
+      if label not in labels:
+         labels.add(label)
+         self.changed = True
+
+def getHostBuild(si):
+   try:
+      about = si.RetrieveServiceContent().about
+      return '%s-%s' % (about.version, about.build)
+   except Exception:
+      return None
+
+def isMissingTableFault(ex):
+   """Return whether an InvalidArgument fault says the table doesn't exist."""
+   invalidProperty = getattr(ex, 'invalidProperty', None) or ''
+   msg = getattr(ex, 'msg', None) or ''
+   return 'entityRefId' in invalidProperty or 'no such table' in msg
+
+# Refine the query pagers according to the result of a failed query.
 # Case 1. In this script, if the querySpec throw InvalidArgument exception, which means the
-#      entityRefId is not valid (the table doesn't exist), so in querySpecs list remove all
-#      the querySpec with same entityRefId.
+#      querySpec is not valid, so remove all the pagers with the same entityRefId.
+#      Only when the fault is about the entityRefId (the table doesn't exist) is it saved.
 # Case 2. If hit the "no such column" exception, this means that the field is not valid in
-#      some table, so update the query field of querySpec with same entityRefId
-def updateQuerySpecs(querySpecs, querySpec, ex):
+#      some table, so update the query fields of querySpec and of the pagers with same entityRefId
+# Both are saved in the schema cache, so later priorities and runs on the same build skip them.
+def updateQuerySpecs(queryPagers, querySpec, ex):
+   entityRefId = querySpec.entityRefId
+   entityType = getSpecEntityType(entityRefId)
    # In Case 1, the script need handle vmodl.fault.InvalidArgument exception.
    # This exception happens when script query some table whic not existed in the old version host.
-   # Remove all the querySpec with same entityRefId in querySpec list .
    if isinstance(ex, vmodl.fault.InvalidArgument):
-      entityRefId = querySpec.entityRefId
-      for qSpec in querySpecs:
-         if qSpec.entityRefId == entityRefId:
-            querySpecs.remove(qSpec)
+      if isMissingTableFault(ex):
+         schemaCache.AddMissingEntityType(entityType)
+      return [queryPager for queryPager in queryPagers
+              if queryPager.entityRefId != entityRefId]
 
    # In second case, the script needs catch the vmodl.fault.SystemError exception,
    # and rebuild the querySpec in this way:
@@ -978,59 +1111,71 @@ def updateQuerySpecs(querySpecs, querySpec, ex):
    # Other type exceptions will be caught, script continue to do next query.
    if isinstance(ex, vmodl.fault.SystemError):
       NO_SUCH_COLUMN = "no such column: "
-      msg = ex.msg
+      msg = ex.msg or ''
       labels = querySpec.labels
-      if not msg.startswith(NO_SUCH_COLUMN):
-         return
+      if not msg.startswith(NO_SUCH_COLUMN) or not labels:
+         return queryPagers
       startSkipField = msg[len(NO_SUCH_COLUMN):]
-      removeIdx = labels.index(startSkipField)
-      entityRefId = querySpec.entityRefId
-      for qSpec in querySpecs:
-         if qSpec.entityRefId == entityRefId:
-            querySpec.labels = labels[:removeIdx]
-   return querySpecs
-
-def printQueryResult(printSeparator, querySpec, withHeader):
-   statsArray = vpm.QueryVsanPerf(querySpecs=[querySpec])
-   if len(statsArray[0].sampleInfo) > 0:
-      # P1 and P2 metrics share one header, if there are no existed P2 metrics in
-      # database, then don't print seperator which before P2 result, and
-      # don't print P2 metrics either.
-      if printSeparator or not withHeader:
-         print(pagingResultSeparator)
-      else:
-         printSeparator = True
-      print(pyVmomi.SoapAdapter.Serialize(statsArray).decode('utf-8'))
-      return printSeparator
+      if startSkipField not in labels:
+         return queryPagers
+      schemaCache.AddMissingLabel(entityType, startSkipField)
+      querySpec.labels = labels[:labels.index(startSkipField)]
+      for queryPager in queryPagers:
+         if queryPager.entityRefId == entityRefId and queryPager.labels:
+            queryPager.labels = schemaCache.GetValidLabels(entityType, queryPager.labels)
+   return queryPagers
 
 def dumpStats(priority="P0", withHeader=True, endTime=None, startTime=None, pagingSize=None, collectInterval=None):
-   querySpecs = buildQuerySpec(priority=priority, endTime=endTime, startTime=startTime, pagingSize=pagingSize, collectInterval=collectInterval)
-   statsArray = None
+   queryPagers = buildQuerySpec(priority=priority, endTime=endTime, startTime=startTime, pagingSize=pagingSize, collectInterval=collectInterval)
+   # P1 and P2 metrics share one header, if there are no existed P2 metrics in
+   # database, then don't print seperator which before P2 result, and
+   # don't print P2 metrics either.
+   printer = StatsPrinter(pagingResultSeparator, withHeader)
+   collector = PerfStatsCollector(vpm, queryPagers, concurrency=queryConcurrency, batchSize=queryBatchSize,
+                                  printer=printer if canStreamResults and "with_dump" in selectedInfo else None)
 
    # Avoid keeping results of all tables in perfsvc memory and dump process memeory.
-   printSeparator = False
    if "with_dump" in selectedInfo:
       if withHeader:
          print('--------------SOAP stats dump--------------')
-      for querySpec in querySpecs:
+      for querySpec, statsArray, ex in collector.Collect():
+         if ex is None:
+            schemaCache.RemoveMissingEntityType(getSpecEntityType(querySpec.entityRefId))
+            if isinstance(statsArray, list):
+               printer.Print(statsArray)
+            else:
+               # the rest of a streamed page
+               statsArray.Print()
+            continue
+         if not isinstance(ex, vmodl.fault.SystemError) and \
+               not isinstance(ex, vmodl.fault.InvalidArgument):
+            continue
+         if isinstance(ex, vmodl.fault.InvalidArgument):
+            collector.Skip(querySpec.entityRefId)
+            queryPagers = updateQuerySpecs(queryPagers, querySpec, ex)
+            continue
+         labels = querySpec.labels
+         queryPagers = updateQuerySpecs(queryPagers, querySpec, ex)
+         if querySpec.labels == labels:
+            # nothing is learned from the error, retrying would fail again
+            continue
          try:
-            printSeparator = printQueryResult(printSeparator, querySpec, withHeader)
-         except Exception as ex:
-            if not isinstance(ex, vmodl.fault.SystemError) and \
-                  not isinstance(ex, vmodl.fault.InvalidArgument):
-               continue
-            querySpecs = updateQuerySpecs(querySpecs, querySpec, ex)
-            try:
-               printSeparator = printQueryResult(printSeparator, querySpec, withHeader)
-            except:
-               pass
+            statsArray = vpm.QueryVsanPerf(querySpecs=[querySpec])
+            printer.Print(statsArray)
+         except:
+            pass
    else:
       if withHeader:
          print('--------------Perf Service Entity Stats--------------')
-      for querySpec in querySpecs:
-         statsArray = vpm.QueryVsanPerf(querySpecs=[querySpec])
+      for querySpec, statsArray, ex in collector.Collect():
+         if ex is not None:
+            raise ex
+         schemaCache.RemoveMissingEntityType(getSpecEntityType(querySpec.entityRefId))
          for stats in statsArray:
             print(stats)
+   schemaCache.Save()
+
+schemaCache = SchemaCache(schemaCacheFile, getHostBuild(si))
 
 if selectedInfo in ['selective_with_dump'] and nodeInfos[0].isStatsMaster:
    try:
@@ -83,6 +83,15 @@ $latency_target = entry["latency_target"] || "Max"
 if $test_target != "k8s"
   $clear_cache = entry["clear_cache"]
   $vsan_debug = entry["vsan_debug"]
+  # Optional keys of perf-conf.yaml for the vmkstats of the vSAN debug mode:
+  #   vmkstats_slice: 300       # collect from the start of every test till its
+  #                             # end, warm-up included, in slices of this many
+  #                             # secs; 0 or missing collects a single minute
+  #                             # 30 minutes into the test
+  #   vmkstats_max_slices: 12   # keep only this many of the most recent slices
+  #                             # on the hosts; 0 or missing keeps them all
+  $vmkstats_slice = entry["vmkstats_slice"].to_i
+  $vmkstats_max_slices = entry["vmkstats_max_slices"].to_i
 
   $hosts_credential = entry["hosts_credential"]
 
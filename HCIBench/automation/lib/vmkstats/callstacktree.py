@@ -0,0 +1,160 @@
+"""
+Caller and callee trees of vmkstats samples
+
+Builds and prints the call stack trees vmcallstackview.jar prints in its
+text mode (--text), so that the reports of all the modules can be produced
+from one load of the vmkstats dump instead of one java run each.
+
+A caller tree is rooted at the outermost functions of the sampled stacks
+and its leaves are the functions the samples hit, a callee tree is the
+other way around. Every node counts the samples of the stacks going
+through it (total) and of those ending in it (self), in caller trees, or
+starting with it, in callee trees. Children are sorted by decreasing total
+count.
+
+Unlike the jar, which cuts the stacks to the depth printed as it loads
+them, the trees hold the whole stacks and the depth is only limited when
+they are printed: trees rerooted at a function keep the frames below it,
+and only the functions sampled get self counts.
+
+Example output, in samples:
+[1000] Caller Root [World:1001, 1002] [0]
+  -> [600] VSANServerMainLoop [0]
+  |  -> [400] LSOM_Read [400]
+  |  -> [200] LSOM_Write [200]
+  -> [400] DOMOwner [400]
+"""
+from collections import deque
+
+# Defaults of vmcallstackview.jar
+MAX_DEPTH = 15
+THRESHOLD = 0.2  # min percent of the samples of the nodes printed
+
+
+class CallStackTreeNode(object):
+    """Node of a call stack tree"""
+
+    __slots__ = ("name", "totalCount", "selfCount", "children")
+
+    def __init__(self, name):
+        self.name = name
+        self.totalCount = 0
+        self.selfCount = 0
+        # Child nodes by function name, in the order they were added
+        self.children = {}
+
+    def child(self, name):
+        """Return the child node of a function, adding it if needed"""
+        node = self.children.get(name)
+        if node is None:
+            node = self.children[name] = CallStackTreeNode(name)
+        return node
+
+    def sortedChildren(self):
+        """Return the children sorted by decreasing total count"""
+        return sorted(
+            self.children.values(), key=lambda node: -node.totalCount
+        )
+
+    def merge(self, other):
+        """Add the counts of another node and of its children"""
+        self.totalCount += other.totalCount
+        self.selfCount += other.selfCount
+        for node in other.children.values():
+            self.child(node.name).merge(node)
+
+    def text(self, total, percent):
+        """
+        Return the line of the node, or None if the node has less than
+        THRESHOLD percent of the total
+        """
+        pct = self.totalCount * 100.0 / total if total else 0.0
+        if pct < THRESHOLD:
+            return None
+        if percent:
+            selfPct = self.selfCount * 100.0 / total if total else 0.0
+            return "[%.2f] %s [%.2f]" % (pct, self.name, selfPct)
+        return "[%d] %s [%d]" % (self.totalCount, self.name, self.selfCount)
+
+    def write(self, out, total, percent, depth, prefix=""):
+        """
+        Print the node and its children down to depth levels below it
+
+        :param out: file to print to
+        :param total: sample count percents are relative to
+        :param percent: print percents of total instead of sample counts
+        :param depth: number of levels of children to print
+        :param prefix: indentation of the node
+        """
+        if depth < 0:
+            return
+        text = self.text(total, percent)
+        if text is None:
+            return
+        if prefix:
+            out.write(prefix[:-1] + "-> ")
+        out.write(text + "\n")
+
+        minCount = THRESHOLD * total / 100
+        children = self.sortedChildren()
+        for i, node in enumerate(children):
+            # Draw the branch down to the next child if it is printed
+            if i + 1 == len(children) or children[i + 1].totalCount < minCount:
+                node.write(out, total, percent, depth - 1, prefix + "   ")
+            else:
+                node.write(out, total, percent, depth - 1, prefix + "  |")
+
+
+def buildTree(title, stacks, caller=True):
+    """
+    Build the call stack tree of samples
+
+    :param title: name of the root node
+    :param stacks: iterable of (frames, count) of the samples, the frames
+                   being the function names of the stack, outermost first
+    :param caller: build the caller tree, else the callee tree
+    :return: the root node
+    """
+    root = CallStackTreeNode(title)
+    for frames, count in stacks:
+        root.totalCount += count
+        if not caller:
+            # Callee trees start at the function sampled
+            frames = frames[::-1]
+        node = root
+        for name in frames:
+            child = node.children.get(name)
+            if child is None:
+                child = node.children[name] = CallStackTreeNode(name)
+            child.totalCount += count
+            node = child
+        if caller:
+            node.selfCount += count
+        elif frames:
+            root.children[frames[0]].selfCount += count
+    return root
+
+
+def reroot(tree, name):
+    """
+    Return the tree of the subtrees of a function
+
+    The subtrees rooted at the nodes of the function, but for those below
+    another one of them, are merged into a new tree.
+
+    :param tree: call stack tree
+    :param name: function name
+    :return: the root node, or None if the function is not in tree
+    """
+    root = None
+    nodes = deque([tree])
+    while nodes:
+        node = nodes.popleft()
+        for child in node.children.values():
+            if child.name == name:
+                if root is None:
+                    root = CallStackTreeNode(name)
+                root.merge(child)
+            else:
+                nodes.append(child)
+    return root
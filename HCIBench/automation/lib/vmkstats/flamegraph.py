@@ -0,0 +1,708 @@
+"""
+Flame graph renderer
+
+A port of flamegraph.pl (https://github.com/brendangregg/FlameGraph, CDDL,
+Copyright 2011 Joyent, Inc., Copyright 2011 Brendan Gregg), which ships next
+to this module, for the options the vmkstats post-processing uses. It draws
+the same SVG, with the same zoom and search script, from stacks given in
+memory instead of a folded stacks file, so that the flame graphs of all the
+modules can be rendered without starting one perl process each.
+
+Example:
+    graph = FlameGraph()
+    graph.addStack("VSANServerMainLoop;LSOM_Read", 31)
+    graph.write("LSOM.svg")
+"""
+import random
+import re
+
+FONT_TYPE = "Verdana"
+IMAGE_WIDTH = 1200  # max width, pixels
+FRAME_HEIGHT = 16  # max height is dynamic
+FONT_SIZE = 12  # base text size
+FONT_WIDTH = 0.59  # avg width relative to fontsize
+
+_YPAD1 = FONT_SIZE * 4  # pad top, include title
+_YPAD2 = FONT_SIZE * 2 + 10  # pad bottom, include labels
+_XPAD = 10  # pad left and right
+_FRAMEPAD = 1  # vertical padding for frames
+
+_BLACK = "rgb(0,0,0)"
+
+_HEADER = """\
+<?xml version="1.0" standalone="no"?>
+<!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN" "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">
+<svg version="1.1" width="%(width)d" height="%(height)d" onload="init(evt)" viewBox="0 0 %(width)d %(height)d" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink">
+<!-- Flame graph stack visualization. See https://github.com/brendangregg/FlameGraph for latest version, and http://www.brendangregg.com/flamegraphs.html for examples. -->
+"""
+
+# Definitions and interactive JavaScript program of flamegraph.pl, with its
+# tunables filled in
+_SCRIPT = r"""<defs >
+	<linearGradient id="background" y1="0" y2="1" x1="0" x2="0" >
+		<stop stop-color="#eeeeee" offset="5%" />
+		<stop stop-color="#eeeeb0" offset="95%" />
+	</linearGradient>
+</defs>
+<style type="text/css">
+	.func_g:hover { stroke:black; stroke-width:0.5; cursor:pointer; }
+</style>
+<script type="text/ecmascript">
+<![CDATA[
+	var details, searchbtn, matchedtxt, svg;
+	function init(evt) {
+		details = document.getElementById("details").firstChild;
+		searchbtn = document.getElementById("search");
+		matchedtxt = document.getElementById("matched");
+		svg = document.getElementsByTagName("svg")[0];
+		searching = 0;
+	}
+
+	// mouse-over for info
+	function s(node) {		// show
+		info = g_to_text(node);
+		details.nodeValue = "Function: " + info;
+	}
+	function c() {			// clear
+		details.nodeValue = ' ';
+	}
+
+	// ctrl-F for search
+	window.addEventListener("keydown",function (e) {
+		if (e.keyCode === 114 || (e.ctrlKey && e.keyCode === 70)) {
+			e.preventDefault();
+			search_prompt();
+		}
+	})
+
+	// functions
+	function find_child(parent, name, attr) {
+		var children = parent.childNodes;
+		for (var i=0; i<children.length;i++) {
+			if (children[i].tagName == name)
+				return (attr != undefined) ? children[i].attributes[attr].value : children[i];
+		}
+		return;
+	}
+	function orig_save(e, attr, val) {
+		if (e.attributes["_orig_"+attr] != undefined) return;
+		if (e.attributes[attr] == undefined) return;
+		if (val == undefined) val = e.attributes[attr].value;
+		e.setAttribute("_orig_"+attr, val);
+	}
+	function orig_load(e, attr) {
+		if (e.attributes["_orig_"+attr] == undefined) return;
+		e.attributes[attr].value = e.attributes["_orig_"+attr].value;
+		e.removeAttribute("_orig_"+attr);
+	}
+	function g_to_text(e) {
+		var text = find_child(e, "title").firstChild.nodeValue;
+		return (text)
+	}
+	function g_to_func(e) {
+		var func = g_to_text(e);
+		if (func != null)
+			func = func.replace(/ .*/, "");
+		return (func);
+	}
+	function update_text(e) {
+		var r = find_child(e, "rect");
+		var t = find_child(e, "text");
+		var w = parseFloat(r.attributes["width"].value) -3;
+		var txt = find_child(e, "title").textContent.replace(/\([^(]*\)$/,"");
+		t.attributes["x"].value = parseFloat(r.attributes["x"].value) +3;
+
+		// Smaller than this size won't fit anything
+		if (w < 2*12*0.59) {
+			t.textContent = "";
+			return;
+		}
+
+		t.textContent = txt;
+		// Fit in full text width
+		if (/^ *$/.test(txt) || t.getSubStringLength(0, txt.length) < w)
+			return;
+
+		for (var x=txt.length-2; x>0; x--) {
+			if (t.getSubStringLength(0, x+2) <= w) {
+				t.textContent = txt.substring(0,x) + "..";
+				return;
+			}
+		}
+		t.textContent = "";
+	}
+
+	// zoom
+	function zoom_reset(e) {
+		if (e.attributes != undefined) {
+			orig_load(e, "x");
+			orig_load(e, "width");
+		}
+		if (e.childNodes == undefined) return;
+		for(var i=0, c=e.childNodes; i<c.length; i++) {
+			zoom_reset(c[i]);
+		}
+	}
+	function zoom_child(e, x, ratio) {
+		if (e.attributes != undefined) {
+			if (e.attributes["x"] != undefined) {
+				orig_save(e, "x");
+				e.attributes["x"].value = (parseFloat(e.attributes["x"].value) - x - 10) * ratio + 10;
+				if(e.tagName == "text") e.attributes["x"].value = find_child(e.parentNode, "rect", "x") + 3;
+			}
+			if (e.attributes["width"] != undefined) {
+				orig_save(e, "width");
+				e.attributes["width"].value = parseFloat(e.attributes["width"].value) * ratio;
+			}
+		}
+
+		if (e.childNodes == undefined) return;
+		for(var i=0, c=e.childNodes; i<c.length; i++) {
+			zoom_child(c[i], x-10, ratio);
+		}
+	}
+	function zoom_parent(e) {
+		if (e.attributes) {
+			if (e.attributes["x"] != undefined) {
+				orig_save(e, "x");
+				e.attributes["x"].value = 10;
+			}
+			if (e.attributes["width"] != undefined) {
+				orig_save(e, "width");
+				e.attributes["width"].value = parseInt(svg.width.baseVal.value) - (10*2);
+			}
+		}
+		if (e.childNodes == undefined) return;
+		for(var i=0, c=e.childNodes; i<c.length; i++) {
+			zoom_parent(c[i]);
+		}
+	}
+	function zoom(node) {
+		var attr = find_child(node, "rect").attributes;
+		var width = parseFloat(attr["width"].value);
+		var xmin = parseFloat(attr["x"].value);
+		var xmax = parseFloat(xmin + width);
+		var ymin = parseFloat(attr["y"].value);
+		var ratio = (svg.width.baseVal.value - 2*10) / width;
+
+		// XXX: Workaround for JavaScript float issues (fix me)
+		var fudge = 0.0001;
+
+		var unzoombtn = document.getElementById("unzoom");
+		unzoombtn.style["opacity"] = "1.0";
+
+		var el = document.getElementsByTagName("g");
+		for(var i=0;i<el.length;i++){
+			var e = el[i];
+			var a = find_child(e, "rect").attributes;
+			var ex = parseFloat(a["x"].value);
+			var ew = parseFloat(a["width"].value);
+			// Is it an ancestor
+			if (0 == 0) {
+				var upstack = parseFloat(a["y"].value) > ymin;
+			} else {
+				var upstack = parseFloat(a["y"].value) < ymin;
+			}
+			if (upstack) {
+				// Direct ancestor
+				if (ex <= xmin && (ex+ew+fudge) >= xmax) {
+					e.style["opacity"] = "0.5";
+					zoom_parent(e);
+					e.onclick = function(e){unzoom(); zoom(this);};
+					update_text(e);
+				}
+				// not in current path
+				else
+					e.style["display"] = "none";
+			}
+			// Children maybe
+			else {
+				// no common path
+				if (ex < xmin || ex + fudge >= xmax) {
+					e.style["display"] = "none";
+				}
+				else {
+					zoom_child(e, xmin, ratio);
+					e.onclick = function(e){zoom(this);};
+					update_text(e);
+				}
+			}
+		}
+	}
+	function unzoom() {
+		var unzoombtn = document.getElementById("unzoom");
+		unzoombtn.style["opacity"] = "0.0";
+
+		var el = document.getElementsByTagName("g");
+		for(i=0;i<el.length;i++) {
+			el[i].style["display"] = "block";
+			el[i].style["opacity"] = "1";
+			zoom_reset(el[i]);
+			update_text(el[i]);
+		}
+	}
+
+	// search
+	function reset_search() {
+		var el = document.getElementsByTagName("rect");
+		for (var i=0; i < el.length; i++) {
+			orig_load(el[i], "fill")
+		}
+	}
+	function search_prompt() {
+		if (!searching) {
+			var term = prompt("Enter a search term (regexp " +
+			    "allowed, eg: ^ext4_)", "");
+			if (term != null) {
+				search(term)
+			}
+		} else {
+			reset_search();
+			searching = 0;
+			searchbtn.style["opacity"] = "0.1";
+			searchbtn.firstChild.nodeValue = "Search"
+			matchedtxt.style["opacity"] = "0.0";
+			matchedtxt.firstChild.nodeValue = ""
+		}
+	}
+	function search(term) {
+		var re = new RegExp(term);
+		var el = document.getElementsByTagName("g");
+		var matches = new Object();
+		var maxwidth = 0;
+		for (var i = 0; i < el.length; i++) {
+			var e = el[i];
+			if (e.attributes["class"].value != "func_g")
+				continue;
+			var func = g_to_func(e);
+			var rect = find_child(e, "rect");
+			if (rect == null) {
+				// the rect might be wrapped in an anchor
+				// if nameattr href is being used
+				if (rect = find_child(e, "a")) {
+				    rect = find_child(r, "rect");
+				}
+			}
+			if (func == null || rect == null)
+				continue;
+
+			// Save max width. Only works as we have a root frame
+			var w = parseFloat(rect.attributes["width"].value);
+			if (w > maxwidth)
+				maxwidth = w;
+
+			if (func.match(re)) {
+				// highlight
+				var x = parseFloat(rect.attributes["x"].value);
+				orig_save(rect, "fill");
+				rect.attributes["fill"].value =
+				    "rgb(230,0,230)";
+
+				// remember matches
+				if (matches[x] == undefined) {
+					matches[x] = w;
+				} else {
+					if (w > matches[x]) {
+						// overwrite with parent
+						matches[x] = w;
+					}
+				}
+				searching = 1;
+			}
+		}
+		if (!searching)
+			return;
+
+		searchbtn.style["opacity"] = "1.0";
+		searchbtn.firstChild.nodeValue = "Reset Search"
+
+		// calculate percent matched, excluding vertical overlap
+		var count = 0;
+		var lastx = -1;
+		var lastw = 0;
+		var keys = Array();
+		for (k in matches) {
+			if (matches.hasOwnProperty(k))
+				keys.push(k);
+		}
+		// sort the matched frames by their x location
+		// ascending, then width descending
+		keys.sort(function(a, b){
+				return a - b;
+			if (a < b || a > b)
+				return a - b;
+			return matches[b] - matches[a];
+		});
+		// Step through frames saving only the biggest bottom-up frames
+		// thanks to the sort order. This relies on the tree property
+		// where children are always smaller than their parents.
+		for (var k in keys) {
+			var x = parseFloat(keys[k]);
+			var w = matches[keys[k]];
+			if (x >= lastx + lastw) {
+				count += w;
+				lastx = x;
+				lastw = w;
+			}
+		}
+		// display matched percent
+		matchedtxt.style["opacity"] = "1.0";
+		pct = 100 * count / maxwidth;
+		if (pct == 100)
+			pct = "100"
+		else
+			pct = pct.toFixed(1)
+		matchedtxt.firstChild.nodeValue = "Matched: " + pct + "%";
+	}
+	function searchover(e) {
+		searchbtn.style["opacity"] = "1.0";
+	}
+	function searchout(e) {
+		if (searching) {
+			searchbtn.style["opacity"] = "1.0";
+		} else {
+			searchbtn.style["opacity"] = "0.1";
+		}
+	}
+]]>
+</script>
+"""
+
+
+def _number(value):
+    """Format a number the way perl interpolates it in a string"""
+    return "%.15g" % value
+
+
+def _escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def _namehash(name):
+    """
+    Generate a vector hash for the name string, weighting early over
+    later characters, to pick the same colors for function names across
+    different flame graphs.
+    """
+    vector = 0.0
+    weight = 1.0
+    maxValue = 1.0
+    mod = 10
+    # if module name present, trunc to 1st char
+    name = re.sub(r".(.*?)`", "", name, count=1)
+    for c in name:
+        i = ord(c) % mod
+        vector += (float(i) / (mod - 1)) * weight
+        mod += 1
+        maxValue += 1 * weight
+        weight *= 0.70
+        if mod > 12:
+            break
+    return 1 - vector / maxValue
+
+
+def _hotColor(name, colorHash):
+    if colorHash:
+        v1 = _namehash(name)
+        v2 = v3 = _namehash(name[::-1])
+    else:
+        v1 = random.random()
+        v2 = random.random()
+        v3 = random.random()
+    return "rgb(%d,%d,%d)" % (
+        205 + int(50 * v3),
+        0 + int(230 * v1),
+        0 + int(55 * v2),
+    )
+
+
+def _scaleColor(value, maxValue):
+    """White for 0, shades of red for increases and of blue for decreases"""
+    r = g = b = 255
+    if value > 0:
+        g = b = int(210 * float(maxValue - value) / maxValue)
+    elif value < 0:
+        r = g = int(210 * float(maxValue + value) / maxValue)
+    return "rgb(%d,%d,%d)" % (r, g, b)
+
+
+class FlameGraph(object):
+    """Flame graph of a set of stack traces"""
+
+    def __init__(
+        self,
+        title="Flame Graph",
+        countName="samples",
+        minWidth=0.1,
+        colorHash=False,
+    ):
+        """
+        Initialize the flame graph
+
+        :param title: centered heading
+        :param countName: what are the counts of the stacks
+        :param minWidth: min function width, pixels
+        :param colorHash: color by function name instead of randomly
+        """
+        self.title = title
+        self.countName = countName
+        self.minWidth = minWidth
+        self.colorHash = colorHash
+        # Folded stack and count of every stack added
+        self.stacks = []
+
+    def addStack(self, stack, count, countBefore=None):
+        """
+        Add the samples of a stack trace
+
+        A differential flame graph is drawn when the stacks have a count
+        before: the frames are as wide as count, and colored by the change
+        in the samples ending in them, red for more and blue for fewer.
+
+        :param stack: frames separated by ';', outermost first
+        :param count: number of samples
+        :param countBefore: number of samples in the profile to compare to
+        """
+        self.stacks.append((stack, count, countBefore))
+
+    def mergeFrames(self):
+        """
+        Merge the stacks into frames the way flamegraph.pl does.
+
+        :return: the total count, the largest change of the count of a
+                 stack, and the list of frames as tuples of (function,
+                 depth, start, end, change of the samples ending in the
+                 frame or None), in the order they end
+        """
+        frames = []
+        last = []
+        starts = []
+        deltas = []
+        time = 0
+        maxDelta = 1
+        # flamegraph.pl sorts the input lines
+        lines = []
+        for stack, count, countBefore in self.stacks:
+            if countBefore is None:
+                line = "%s %s" % (stack, _number(count))
+            else:
+                line = "%s %s %s" % (
+                    stack,
+                    _number(countBefore),
+                    _number(count),
+                )
+            lines.append((line, stack, count, countBefore))
+        lines.sort()
+        for _, stack, count, countBefore in lines:
+            delta = None
+            if countBefore is not None:
+                delta = count - countBefore
+                maxDelta = max(maxDelta, abs(delta))
+            this = [""] + stack.split(";")
+            lenSame = 0
+            for a, b in zip(last, this):
+                if a != b:
+                    break
+                lenSame += 1
+            for i in range(len(last) - 1, lenSame - 1, -1):
+                frames.append((last[i], i, starts.pop(), time, deltas.pop()))
+            for i in range(lenSame, len(this)):
+                starts.append(time)
+                if delta is None:
+                    deltas.append(None)
+                else:
+                    deltas.append(delta if i == len(this) - 1 else 0)
+            last = this
+            time += count
+        for i in range(len(last) - 1, -1, -1):
+            frames.append((last[i], i, starts.pop(), time, deltas.pop()))
+        return time, maxDelta, frames
+
+    def render(self):
+        """Return the SVG of the flame graph"""
+        timemax, maxDelta, frames = self.mergeFrames()
+        if not timemax:
+            return self._renderError()
+
+        widthPerTime = float(IMAGE_WIDTH - 2 * _XPAD) / timemax
+        minWidthTime = self.minWidth / widthPerTime
+
+        # prune blocks that are too narrow and determine max depth
+        frames = [f for f in frames if f[3] - f[2] >= minWidthTime]
+        depthMax = max(frame[1] for frame in frames)
+
+        imageHeight = depthMax * FRAME_HEIGHT + _YPAD1 + _YPAD2
+        svg = [
+            _HEADER % {"width": IMAGE_WIDTH, "height": imageHeight},
+            _SCRIPT,
+        ]
+        svg.append(
+            self._rectangle(
+                0, 0, IMAGE_WIDTH, imageHeight, "url(#background)", ""
+            )
+        )
+        svg.append(
+            self._text(
+                FONT_SIZE + 5,
+                int(IMAGE_WIDTH / 2),
+                FONT_SIZE * 2,
+                self.title,
+                "middle",
+            )
+        )
+        svg.append(
+            self._text(
+                FONT_SIZE,
+                _XPAD,
+                imageHeight - (_YPAD2 / 2),
+                " ",
+                "",
+                'id="details"',
+            )
+        )
+        svg.append(
+            self._text(
+                FONT_SIZE,
+                _XPAD,
+                FONT_SIZE * 2,
+                "Reset Zoom",
+                "",
+                'id="unzoom" onclick="unzoom()" '
+                'style="opacity:0.0;cursor:pointer"',
+            )
+        )
+        svg.append(
+            self._text(
+                FONT_SIZE,
+                IMAGE_WIDTH - _XPAD - 100,
+                FONT_SIZE * 2,
+                "Search",
+                "",
+                'id="search" onmouseover="searchover()" '
+                'onmouseout="searchout()" onclick="search_prompt()" '
+                'style="opacity:0.1;cursor:pointer"',
+            )
+        )
+        svg.append(
+            self._text(
+                FONT_SIZE,
+                IMAGE_WIDTH - _XPAD - 100,
+                imageHeight - (_YPAD2 / 2),
+                " ",
+                "",
+                'id="matched"',
+            )
+        )
+
+        # draw frames
+        for func, depth, stime, etime, delta in frames:
+            if func == "" and depth == 0:
+                etime = timemax
+            x1 = _XPAD + stime * widthPerTime
+            x2 = _XPAD + etime * widthPerTime
+            y1 = imageHeight - _YPAD2 - (depth + 1) * FRAME_HEIGHT + _FRAMEPAD
+            y2 = imageHeight - _YPAD2 - depth * FRAME_HEIGHT
+
+            samples = "%.0f" % (etime - stime)
+            samplesText = "{:,}".format(int(samples))
+            if func == "" and depth == 0:
+                info = "all (%s %s, 100%%)" % (samplesText, self.countName)
+            else:
+                pct = "%.2f" % (100.0 * int(samples) / timemax)
+                info = "%s (%s %s, %s%%" % (
+                    _escape(func).replace('"', "&quot;"),
+                    samplesText,
+                    self.countName,
+                    pct,
+                )
+                if delta is not None:
+                    deltaPct = "%.2f" % (100.0 * delta / timemax)
+                    if delta > 0:
+                        deltaPct = "+" + deltaPct
+                    info += "; %s%%" % deltaPct
+                info += ")"
+
+            svg.append(
+                '<g class="func_g" onmouseover="s(this)" onmouseout="c()" '
+                'onclick="zoom(this)">\n'
+            )
+            svg.append("<title>%s</title>" % info)
+            svg.append(
+                self._rectangle(
+                    x1,
+                    y1,
+                    x2,
+                    y2,
+                    _hotColor(func, self.colorHash)
+                    if delta is None
+                    else _scaleColor(delta, maxDelta),
+                    'rx="2" ry="2"',
+                )
+            )
+
+            chars = int((x2 - x1) / (FONT_SIZE * FONT_WIDTH))
+            text = ""
+            if chars >= 3:  # room for one char plus two dots
+                text = func[:chars]
+                if chars < len(func):
+                    text = text[:-2] + ".."
+                text = _escape(text)
+            svg.append(
+                self._text(
+                    FONT_SIZE, x1 + 3, 3 + (y1 + y2) / 2.0, text, ""
+                )
+            )
+            svg.append("</g>\n")
+
+        svg.append("</svg>\n")
+        return "".join(svg)
+
+    def write(self, filename):
+        """Write the SVG of the flame graph to a file"""
+        with open(filename, "w") as fh:
+            fh.write(self.render())
+
+    def _renderError(self):
+        # emit an error message SVG, for tools automating flamegraph use
+        imageHeight = FONT_SIZE * 5
+        return "".join(
+            [
+                _HEADER % {"width": IMAGE_WIDTH, "height": imageHeight},
+                self._text(
+                    FONT_SIZE + 2,
+                    int(IMAGE_WIDTH / 2),
+                    FONT_SIZE * 2,
+                    "ERROR: No valid input provided to flamegraph.pl.",
+                    "middle",
+                ),
+                "</svg>\n",
+            ]
+        )
+
+    @staticmethod
+    def _rectangle(x1, y1, x2, y2, fill, extra):
+        x1 = "%0.1f" % x1
+        x2 = "%0.1f" % x2
+        return '<rect x="%s" y="%s" width="%0.1f" height="%0.1f" ' \
+            'fill="%s" %s />\n' % (
+                x1,
+                _number(y1),
+                float(x2) - float(x1),
+                y2 - y1,
+                fill,
+                extra,
+            )
+
+    @staticmethod
+    def _text(size, x, y, text, loc, extra=""):
+        return '<text text-anchor="%s" x="%0.2f" y="%s" font-size="%s" ' \
+            'font-family="%s" fill="%s" %s >%s</text>\n' % (
+                loc,
+                x,
+                _number(y),
+                _number(size),
+                FONT_TYPE,
+                _BLACK,
+                extra,
+                text,
+            )
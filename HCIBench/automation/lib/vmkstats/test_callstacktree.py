@@ -0,0 +1,137 @@
+"""
+Tests of the caller and callee trees of callstacktree.py
+
+The reports of the dump in testdata/dump are checked against the ones in
+testdata/golden, those vmcallstackview.jar should write in testdata/dump by:
+  java -jar vmcallstackview.jar --text -tag k --caller --samples
+  java -jar vmcallstackview.jar --text -tag k --caller
+  java -jar vmcallstackview.jar --text -tag k --callee --samples
+  java -jar vmcallstackview.jar --text -tag k --callee --maxdepth 1 --samples
+  java -jar vmcallstackview.jar --text -tag k --rootAt VSANServerMainLoop \
+      --caller --samples --world 1001
+and so on for the other files. The stacks of the dump are no deeper than
+the 15 levels printed, the jar cutting deeper ones as it loads them.
+
+UNVERIFIED: the reports of testdata/golden were worked out by hand from the
+format of the jar, not written by it. Compare them with those of the jar,
+and replace them if they differ, with:
+    python3 testdata/make_golden.py [--write]
+
+Run with:
+    python3 -m unittest test_callstacktree
+"""
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from callstacktree import MAX_DEPTH, buildTree, reroot
+from vmkstats_postprocess import VmkstatsParser
+
+_TESTDATA_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "testdata"
+)
+_DUMP_DIR = os.path.join(_TESTDATA_DIR, "dump")
+_GOLDEN_DIR = os.path.join(_TESTDATA_DIR, "golden")
+
+# Name of the report in testdata/golden and arguments of parse
+_REPORTS = [
+    ("caller.txt", dict(ctx="")),
+    ("caller_percent.txt", dict(ctx="", percent=True)),
+    ("callee.txt", dict(ctx="", caller=False)),
+    ("callee_depth1.txt", dict(ctx="", caller=False, maxDepth=1)),
+    (
+        "LSOMLLOG_caller.txt",
+        dict(ctx="LSOMLLOG", rootAt="VSANServerMainLoop", cpuids=["1001"]),
+    ),
+    (
+        "LSOMLLOG_caller_percent.txt",
+        dict(
+            ctx="LSOMLLOG",
+            rootAt="VSANServerMainLoop",
+            cpuids=["1001"],
+            percent=True,
+        ),
+    ),
+    (
+        "PLOG_caller.txt",
+        dict(ctx="PLOG", rootAt="VSANServerMainLoop", cpuids=["1002"]),
+    ),
+    ("DOM_caller.txt", dict(ctx="DOM", cpuids=["2001"])),
+]
+
+
+def readFile(filename):
+    with open(filename) as f:
+        return f.read()
+
+
+class GoldenReportTest(unittest.TestCase):
+    def setUp(self):
+        self.outputDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.outputDir)
+        self.parser = VmkstatsParser(
+            _DUMP_DIR, os.path.join(_DUMP_DIR, "vsanworlds.json")
+        )
+        self.assertTrue(self.parser.load())
+        self.parser.updateOdir(self.outputDir)
+
+    def testReports(self):
+        for name, kwargs in _REPORTS:
+            self.parser.parse(**kwargs)
+            self.assertEqual(
+                readFile(os.path.join(self.outputDir, name)),
+                readFile(os.path.join(_GOLDEN_DIR, name)),
+                name,
+            )
+
+
+class DeepStackTest(unittest.TestCase):
+    # 17 frames, the samples hit f17
+    FRAMES = ("f01", "f02", "VSANServerMainLoop") + tuple(
+        "f%02d" % i for i in range(4, 18)
+    )
+
+    def write(self, tree, total, depth=MAX_DEPTH):
+        out = io.StringIO()
+        tree.write(out, total, False, depth)
+        return [line.split("-> ")[-1] for line in out.getvalue().splitlines()]
+
+    def testReroot(self):
+        tree = buildTree(
+            "Caller Root []", [(self.FRAMES, 10), (self.FRAMES[:13], 5)]
+        )
+        tree = reroot(tree, "VSANServerMainLoop")
+        lines = self.write(tree, 15)
+        # The frames below the function are all printed
+        self.assertEqual(len(lines), 15)
+        self.assertEqual(lines[0], "[15] VSANServerMainLoop [0]")
+        self.assertEqual(lines[10], "[15] f13 [5]")
+        self.assertEqual(lines[-1], "[10] f17 [10]")
+        self.assertEqual(
+            [line for line in lines if not line.endswith(" [0]")],
+            ["[15] f13 [5]", "[10] f17 [10]"],
+        )
+
+    def testDepth(self):
+        tree = buildTree("Caller Root []", [(self.FRAMES, 10)])
+        lines = self.write(tree, 10)
+        self.assertEqual(len(lines), MAX_DEPTH + 1)
+        # The samples are not given to the last frame printed
+        self.assertEqual(lines[-1], "[10] f15 [0]")
+        self.assertEqual(
+            self.write(tree, 10, 1),
+            ["[10] Caller Root [] [0]", "[10] f01 [0]"],
+        )
+
+    def testCallee(self):
+        tree = buildTree("Callee Root []", [(self.FRAMES, 10)], caller=False)
+        lines = self.write(tree, 10)
+        self.assertEqual(len(lines), MAX_DEPTH + 1)
+        self.assertEqual(lines[1], "[10] f17 [10]")
+        self.assertEqual(lines[-1], "[10] VSANServerMainLoop [0]")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,204 @@
+"""
+Tests of vmkflames.py: the symbol lookup, checked against the linear scan of
+the symbol table it replaced, and the <module>.fl files of the dump in
+testdata/dump, checked against the ones in testdata/golden
+
+Run with:
+    python3 -m unittest test_vmkflames
+"""
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from vmkflames import VmkstatsFlames
+
+_TESTDATA_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "testdata"
+)
+_DUMP_DIR = os.path.join(_TESTDATA_DIR, "dump")
+_GOLDEN_DIR = os.path.join(_TESTDATA_DIR, "golden")
+
+# Start address, size and name of the symbols of symbolTable.k
+_SYMBOLS = [
+    (0x1000, 0x100, "Outer"),
+    # within Outer
+    (0x1080, 0x10, "Inner"),
+    (0x1200, 0x100, "Aliased"),
+    # same start, the last one read wins
+    (0x1200, 0x80, "Alias"),
+    # overlaps the end of Alias and goes past it
+    (0x1250, 0x200, "Overlapping"),
+    (0x1600, 0x0, "Empty"),
+    (0x2000, 0x10, "Last"),
+]
+
+
+def readFile(filename):
+    with open(filename) as f:
+        return f.read()
+
+
+def symbolTable(symbols):
+    return ["0x%x 0x%x %s\n" % symbol for symbol in symbols]
+
+
+def linearFindSymbol(flames, addr):
+    """
+    The lookup findSymbol replaced: the first function holding the address,
+    from the highest start address down
+    """
+    inaddr = int(addr, 16)
+    for a in sorted(flames.symAddrDict, key=lambda a: int(a, 16), reverse=True):
+        faddr = int(a, 16)
+        fsize = int(flames.symSizeDict[a], 16)
+        if inaddr in range(faddr, faddr + fsize):
+            return flames.symAddrDict[a]
+    return "SymNotFound"
+
+
+class FindSymbolTest(unittest.TestCase):
+    def makeFlames(self, symbols):
+        flames = VmkstatsFlames(
+            _DUMP_DIR, os.path.join(_DUMP_DIR, "vsanworlds.json")
+        )
+        flames.loadSymbols(symbolTable(symbols))
+        return flames
+
+    def assertLinearScan(self, flames, addrs):
+        for inaddr in addrs:
+            addr = "%x" % inaddr
+            self.assertEqual(
+                flames.findSymbol(addr), linearFindSymbol(flames, addr), addr
+            )
+
+    def testLookup(self):
+        flames = self.makeFlames(_SYMBOLS)
+        expected = {
+            # before the first symbol
+            0x0: "SymNotFound",
+            0xFFF: "SymNotFound",
+            0x1000: "Outer",
+            0x107F: "Outer",
+            0x1080: "Inner",
+            0x108F: "Inner",
+            # Outer again past Inner
+            0x1090: "Outer",
+            0x10FF: "Outer",
+            # gap
+            0x1100: "SymNotFound",
+            0x11FF: "SymNotFound",
+            0x1200: "Alias",
+            0x124F: "Alias",
+            0x1250: "Overlapping",
+            0x127F: "Overlapping",
+            # past Alias, within the size of Aliased it replaced
+            0x12C0: "Overlapping",
+            0x144F: "Overlapping",
+            0x1450: "SymNotFound",
+            0x1600: "SymNotFound",
+            0x2000: "Last",
+            0x200F: "Last",
+            # after the last symbol
+            0x2010: "SymNotFound",
+            0xFFFFFFFFFFFF: "SymNotFound",
+        }
+        for inaddr, symbol in sorted(expected.items()):
+            self.assertEqual(flames.findSymbol("%x" % inaddr), symbol)
+        self.assertLinearScan(flames, range(0xF00, 0x2100))
+
+    def testCache(self):
+        flames = self.makeFlames(_SYMBOLS)
+        self.assertEqual(flames.findSymbol("1100"), "SymNotFound")
+        self.assertEqual(flames.findSymbol("1080"), "Inner")
+        self.assertEqual(
+            flames.symCache, {"1100": "SymNotFound", "1080": "Inner"}
+        )
+        # cached lookups do not search the symbols again
+        flames.symStarts = flames.symEnds = flames.symMaxEnds = []
+        flames.symNames = []
+        self.assertEqual(flames.findSymbol("1100"), "SymNotFound")
+        self.assertEqual(flames.findSymbol("1080"), "Inner")
+        self.assertEqual(flames.findSymbol("1000"), "SymNotFound")
+
+    def testNoSymbols(self):
+        flames = self.makeFlames([])
+        self.assertEqual(flames.findSymbol("1000"), "SymNotFound")
+
+    def testRandomTables(self):
+        rand = random.Random(1)
+        for _ in range(20):
+            symbols = []
+            for i in range(rand.randint(1, 30)):
+                # mostly disjoint functions, some of them nested or
+                # overlapping
+                faddr = rand.randrange(0x1000, 0x3000, 0x10)
+                fsize = rand.choice([0, 0x8, 0x40, 0x100, 0x400])
+                symbols.append((faddr, fsize, "f%d" % i))
+            flames = self.makeFlames(symbols)
+            self.assertLinearScan(flames, range(0xF80, 0x3500, 0x4))
+
+
+class ProcessStatsTest(unittest.TestCase):
+    MODULES = ["LSOMLLOG", "PLOG", "DOM", "allWorlds"]
+
+    def setUp(self):
+        tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpDir)
+        self.dumpDir = os.path.join(tmpDir, "dump")
+        shutil.copytree(_DUMP_DIR, self.dumpDir)
+
+    def processStats(self):
+        flames = VmkstatsFlames(
+            self.dumpDir, os.path.join(self.dumpDir, "vsanworlds.json")
+        )
+        self.assertEqual(
+            flames.processStats(),
+            [os.path.join(self.dumpDir, m + ".fl") for m in self.MODULES],
+        )
+
+    def assertGolden(self):
+        for module in self.MODULES:
+            name = module + ".fl"
+            self.assertEqual(
+                readFile(os.path.join(self.dumpDir, name)),
+                readFile(os.path.join(_GOLDEN_DIR, name)),
+                name,
+            )
+
+    def testGolden(self):
+        # The largest trace id sampled in a module is written too, trace 3
+        # being the only one of PLOG
+        self.processStats()
+        self.assertGolden()
+
+    def testWorldOfTwoModules(self):
+        vsanworlds = os.path.join(self.dumpDir, "vsanworlds.json")
+        with open(vsanworlds) as fh:
+            worlds = json.load(fh)
+        # 1001 stays in LSOMLLOG, listed first
+        worlds["DOM"].append("1001")
+        with open(vsanworlds, "w") as fh:
+            json.dump(worlds, fh)
+        self.processStats()
+        self.assertGolden()
+
+    def testTraceNotInCallStacks(self):
+        # Trace 9 is not in callStacks, its samples are left out
+        with open(os.path.join(self.dumpDir, "samples"), "a") as fh:
+            fh.write("k:420000005010 9 0 500 0 1002 1002 0\n")
+            fh.write("k:420000005010 3 0 5 0 1002 1002 0\n")
+        self.processStats()
+        self.assertEqual(
+            readFile(os.path.join(self.dumpDir, "PLOG.fl")),
+            "CpuSched_StartWorld;VSANServerMainLoop;PLOG_Elevator 250\n",
+        )
+        self.assertNotIn(
+            " 500\n", readFile(os.path.join(self.dumpDir, "allWorlds.fl"))
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,148 @@
+"""
+Tests of vmkstats_diff.py on two copies of the dump in testdata/dump, the
+second one with 200 more samples of LSOM_Read in the LSOMLLOG world
+
+Run with:
+    python3 -m unittest test_vmkstats_diff
+"""
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+
+import vmkstats_diff
+
+_DUMP_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "testdata", "dump"
+)
+
+# Frame of the SVG, its title and the fill of its rectangle
+_FRAME_REGEX = re.compile(
+    r'<title>(?P<info>[^<]*)</title><rect [^>]*fill="(?P<fill>[^"]*)"'
+)
+
+
+def readReport(filename):
+    """Return the header and the rows of a _diff.txt report, split"""
+    with open(filename) as fh:
+        lines = fh.read().splitlines()
+    return lines[0], [line.split() for line in lines[2:]]
+
+
+def readFills(filename):
+    """Return the fill of the frames of an SVG, by function"""
+    with open(filename) as fh:
+        svg = fh.read()
+    return dict(
+        (match.group("info").split(" (")[0], match.group("fill"))
+        for match in _FRAME_REGEX.finditer(svg)
+    )
+
+
+class VmkstatsDiffTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpDir)
+        self.before = os.path.join(self.tmpDir, "before")
+        self.after = os.path.join(self.tmpDir, "after")
+        self.outputDir = os.path.join(self.tmpDir, "diff")
+        shutil.copytree(_DUMP_DIR, self.before)
+        shutil.copytree(_DUMP_DIR, self.after)
+        samplesFile = os.path.join(self.after, "samples")
+        with open(samplesFile) as fh:
+            samples = fh.read()
+        # LSOM_Read sampled in stack 2 of world 1001, 70 samples before
+        sample = "k:420000003010 2 0 70 0 1001 1001 0\n"
+        self.assertIn(sample, samples)
+        with open(samplesFile, "w") as fh:
+            fh.write(samples.replace(sample, sample.replace(" 70 ", " 270 ")))
+
+        argv = sys.argv
+        sys.argv = [
+            "vmkstats_diff.py",
+            "--before",
+            self.before,
+            "--after",
+            self.after,
+            "-o",
+            self.outputDir,
+        ]
+        try:
+            vmkstats_diff.main()
+        finally:
+            sys.argv = argv
+
+    def testAllWorldsReport(self):
+        header, rows = readReport(
+            os.path.join(self.outputDir, "allWorlds_diff.txt")
+        )
+        self.assertEqual(
+            header, "allWorlds: 1000 samples before, 1200 samples after"
+        )
+        # by the larger of the self and total changes, PLOG_Elevator moving
+        # only in total ahead of Net_Tx
+        self.assertEqual(
+            [(row[-1], row[2], row[5]) for row in rows],
+            [
+                ("LSOM_Read", "+15.50", "+10.50"),
+                ("Util_Memcpy", "-6.65", "-6.65"),
+                ("SSDLOG_Flush", "-6.33", "-6.33"),
+                ("PLOG_Elevator", "+0.00", "-4.08"),
+                ("VSANServerMainLoop", "+0.00", "+3.42"),
+                ("DOMOwner_Op", "+0.00", "-3.40"),
+                ("LSOM_Write", "+0.00", "-3.00"),
+                ("Net_Tx", "-2.52", "-2.52"),
+                ("CpuSched_StartWorld", "+0.00", "+0.00"),
+            ],
+        )
+        self.assertEqual(
+            rows[0], ["7.00", "22.50", "+15.50", "37.00", "47.50", "+10.50",
+                      "LSOM_Read"]
+        )
+
+    def testModuleReports(self):
+        header, rows = readReport(
+            os.path.join(self.outputDir, "LSOMLLOG_diff.txt")
+        )
+        self.assertEqual(
+            header, "LSOMLLOG: 550 samples before, 750 samples after"
+        )
+        self.assertEqual(
+            [(row[-1], row[2], row[5]) for row in rows[:4]],
+            [
+                ("LSOM_Read", "+23.27", "+8.73"),
+                ("Util_Memcpy", "-14.55", "-14.55"),
+                ("LSOM_Write", "+0.00", "-8.73"),
+                ("SSDLOG_Flush", "-8.73", "-8.73"),
+            ],
+        )
+        # the worlds of DOM did not change
+        header, rows = readReport(os.path.join(self.outputDir, "DOM_diff.txt"))
+        self.assertEqual(header, "DOM: 205 samples before, 205 samples after")
+        self.assertEqual(set(row[2] for row in rows), set(["+0.00"]))
+        self.assertEqual(set(row[5] for row in rows), set(["+0.00"]))
+
+    def testGraph(self):
+        fills = readFills(os.path.join(self.outputDir, "LSOMLLOG_diff.svg"))
+        # the 70 samples of LSOM_Read scale to 95 of the 750 after, the 300
+        # of Util_Memcpy to 409 and the 180 of SSDLOG_Flush to 245
+        self.assertEqual(
+            fills,
+            {
+                "all": "rgb(255,255,255)",
+                "CpuSched_StartWorld": "rgb(255,255,255)",
+                "VSANServerMainLoop": "rgb(255,255,255)",
+                "LSOM_Read": "rgb(255,0,0)",
+                "Util_Memcpy": "rgb(79,79,255)",
+                "LSOM_Write": "rgb(255,255,255)",
+                "SSDLOG_Flush": "rgb(132,132,255)",
+            },
+        )
+        fills = readFills(os.path.join(self.outputDir, "DOM_diff.svg"))
+        self.assertEqual(set(fills.values()), set(["rgb(255,255,255)"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
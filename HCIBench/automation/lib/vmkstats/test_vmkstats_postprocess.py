@@ -0,0 +1,78 @@
+"""
+Tests of the reports vmkstats_postprocess.py writes for time sliced
+collections, the slices being copies of the dump in testdata/dump
+
+Run with:
+    python3 -m unittest test_vmkstats_postprocess
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import vmkstats_postprocess
+from vmkstats_timeline import SLICES_FILE
+
+_DUMP_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "testdata", "dump"
+)
+
+
+class SlicedReportTest(unittest.TestCase):
+    def setUp(self):
+        self.dumpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dumpDir)
+        slices = []
+        for index in range(2):
+            sliceName = "slice-%04d" % index
+            shutil.copytree(_DUMP_DIR, os.path.join(self.dumpDir, sliceName))
+            slices.append(
+                {
+                    "slice": index,
+                    "dir": sliceName,
+                    "start": 1000.0 + 10 * index,
+                    "end": 1010.0 + 10 * index,
+                }
+            )
+        with open(os.path.join(self.dumpDir, SLICES_FILE), "w") as fh:
+            json.dump(slices, fh)
+
+    def runMain(self, *args):
+        argv = sys.argv
+        sys.argv = ["vmkstats_postprocess.py", "-o", self.dumpDir] + list(args)
+        try:
+            vmkstats_postprocess.main()
+        finally:
+            sys.argv = argv
+
+    def testReports(self):
+        self.runMain("--flamegraph", "--processes", "1")
+        self.assertTrue(
+            os.path.exists(os.path.join(self.dumpDir, "timeline", "DOM.csv"))
+        )
+        for sliceName in ("slice-0000", "slice-0001"):
+            sliceDir = os.path.join(self.dumpDir, sliceName)
+            for name in (
+                "caller.txt",
+                "callee_depth1.txt",
+                "LSOMLLOG_caller_percent.txt",
+                "allWorlds.svg",
+                "PLOG.svg",
+                os.path.join("flFiles", "DOM.fl"),
+            ):
+                self.assertTrue(
+                    os.path.exists(os.path.join(sliceDir, name)),
+                    os.path.join(sliceName, name),
+                )
+
+    def testNoFlamegraph(self):
+        self.runMain("--processes", "1")
+        sliceDir = os.path.join(self.dumpDir, "slice-0000")
+        self.assertTrue(os.path.exists(os.path.join(sliceDir, "caller.txt")))
+        self.assertFalse(os.path.exists(os.path.join(sliceDir, "flFiles")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+"""
+Write the reports of vmcallstackview.jar on testdata/dump, which
+test_callstacktree.py checks callstacktree.py against
+
+By default the reports of the jar are compared with the ones in
+testdata/golden, --write replaces them.
+
+Run with:
+    python3 testdata/make_golden.py [--java JAVA] [--jar JAR] [--write]
+"""
+import argparse
+import difflib
+import os
+import subprocess
+import sys
+
+_TESTDATA_DIR = os.path.dirname(os.path.abspath(__file__))
+_VMKSTATS_DIR = os.path.dirname(_TESTDATA_DIR)
+_DUMP_DIR = os.path.join(_TESTDATA_DIR, "dump")
+_GOLDEN_DIR = os.path.join(_TESTDATA_DIR, "golden")
+
+sys.path.insert(0, _VMKSTATS_DIR)
+from test_callstacktree import _REPORTS  # noqa: E402
+
+
+def jarArgs(ctx, rootAt=None, cpuids=None, caller=True, maxDepth=None, percent=False):
+    """
+    Arguments of vmcallstackview.jar for the arguments of
+    VmkstatsParser.parse
+
+    :param ctx: name of the report, unused by the jar
+    """
+    args = ["--text", "-tag", "k"]
+    if rootAt:
+        args += ["--rootAt", rootAt]
+    args.append("--caller" if caller else "--callee")
+    if maxDepth:
+        args += ["--maxdepth", str(maxDepth)]
+    if not percent:
+        args.append("--samples")
+    if cpuids:
+        args += ["--world", ",".join(cpuids)]
+    return args
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--java", default="java", help="java path")
+    parser.add_argument(
+        "--jar",
+        default=os.path.join(_VMKSTATS_DIR, "vmcallstackview.jar"),
+        help="vmcallstackview.jar file path",
+    )
+    parser.add_argument(
+        "--write",
+        action="store_true",
+        help="replace the reports of testdata/golden",
+    )
+    opts = parser.parse_args()
+
+    differ = False
+    for name, kwargs in _REPORTS:
+        cmd = [opts.java, "-jar", opts.jar] + jarArgs(**kwargs)
+        report = subprocess.check_output(cmd, cwd=_DUMP_DIR).decode()
+        goldenPath = os.path.join(_GOLDEN_DIR, name)
+        if opts.write:
+            with open(goldenPath, "w") as fh:
+                fh.write(report)
+            continue
+        with open(goldenPath) as fh:
+            golden = fh.read()
+        if report != golden:
+            differ = True
+            sys.stdout.writelines(
+                difflib.unified_diff(
+                    golden.splitlines(True),
+                    report.splitlines(True),
+                    os.path.join("golden", name),
+                    " ".join(cmd),
+                )
+            )
+    return 1 if differ else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
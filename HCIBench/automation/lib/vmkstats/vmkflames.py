@@ -17,6 +17,7 @@ Examples:
 
 """
 import argparse
+import bisect
 import json
 import logging
 import os
@@ -36,14 +37,11 @@ def readLines(filename):
         return None
 
 
-def sortDict(d):
-    """return copy of given dictionary with values sorted in descending
-       order
-
-    @param d: input dictionary
-    """
-    sd = sorted(d.items(), key=lambda i: i[0], reverse=True)
-    return sd
+def hasData(filename):
+    try:
+        return os.path.getsize(filename) > 0
+    except OSError:
+        return False
 
 
 class VmkstatsFlames:
@@ -58,21 +56,38 @@ class VmkstatsFlames:
         # Convert str to int
         for module in self.vsanworlds:
             self.vsanworlds[module] = [int(x) for x in self.vsanworlds[module]]
+        # A world belongs to the first module listing it
+        self.worldModules = {}
+        for module in self.vsanworlds:
+            for worldid in self.vsanworlds[module]:
+                self.worldModules.setdefault(worldid, module)
 
         self.SAMPLES = "samples"
         self.CALLSTACKS = "callStacks"
         self.SYMBOLTABLE = "symbolTable.k"
 
-        self.samples = ""
         self.callStacks = ""
         self.symbolTable = ""
         self.symCache = {}
         self.symAddrDict = {}
         self.symSizeDict = {}
+        # Symbols sorted by start address, see indexSymbols
+        self.symStarts = []
+        self.symEnds = []
+        self.symMaxEnds = []
+        self.symNames = []
         self.stackDict = {}
+        # Sample count by module and trace id, for the trace ids sampled
         self.traceCount = defaultdict(dict)
-        self.traceAddrs = defaultdict(dict)
-        self.idmax = defaultdict(int)
+        # Symbolized stack trace by trace id, see resolveTrace
+        self.resolvedTraces = {}
+        # Sample count by world id and sample key, the index in sampleKeys
+        # of the "k:<sampled address> <trace id>" of the samples, in the
+        # order they were first seen
+        self.worldSamples = {}
+        self.sampleKeys = []
+        # Functions of the callstack trace by trace id, see sampleFrames
+        self.traceFrames = {}
 
     def loadSymbols(self, symbolTable):
         """
@@ -93,32 +108,52 @@ class VmkstatsFlames:
                 fsym = msym.group(3)
                 self.symAddrDict[faddr] = fsym
                 self.symSizeDict[faddr] = fsize
+        self.indexSymbols()
 
-    def findSymbol(self, addr, sortedSym):
+    def indexSymbols(self):
+        """
+        Build the arrays findSymbol searches from symAddrDict and
+        symSizeDict: the start and end addresses of the functions sorted
+        by start address, and the largest end address of the functions
+        starting at or before each of them.
+        """
+        syms = sorted(
+            (int(a, 16), int(self.symSizeDict[a], 16), name)
+            for a, name in self.symAddrDict.items()
+        )
+        self.symStarts = [faddr for faddr, _, _ in syms]
+        self.symEnds = [faddr + fsize for faddr, fsize, _ in syms]
+        self.symNames = [name for _, _, name in syms]
+        self.symMaxEnds = []
+        maxEnd = 0
+        for end in self.symEnds:
+            maxEnd = max(maxEnd, end)
+            self.symMaxEnds.append(maxEnd)
+
+    def findSymbol(self, addr):
         """
         Finds the symbol that falls within a given function's text segment,
         given an address and populates to symCache for later faster lookups.
         If already available in the cache, it returns the symbol from cache.
-        Also caches the fact that address could not be resolved.
-        TBD: Opportunity to speed this up by using binary search
+        Also caches the fact that address could not be resolved, as
+        "SymNotFound".
         """
-        symbol = None
-        if self.symCache.get(addr, 0):
-            return self.symCache[addr]
+        symbol = self.symCache.get(addr)
+        if symbol is not None:
+            return symbol
 
         inaddr = int(addr, 16)
 
-        for a, _ in sortedSym:
-            faddr = int(a, 16)
-            fsize = int(self.symSizeDict[a], 16)
-            if inaddr in range(faddr, faddr + fsize):
-                self.symCache[addr] = self.symAddrDict[a]
-                symbol = self.symAddrDict[a]
+        # Functions do not overlap but for aliases, so the function starting
+        # last at or before inaddr almost always is the one
+        i = bisect.bisect_right(self.symStarts, inaddr) - 1
+        symbol = "SymNotFound"
+        while i >= 0 and self.symMaxEnds[i] > inaddr:
+            if self.symEnds[i] > inaddr:
+                symbol = self.symNames[i]
                 break
-        else:
-            # Didn't find the address cache
-            self.symCache[addr] = "SymNotFound"
-
+            i -= 1
+        self.symCache[addr] = symbol
         return symbol
 
     def loadCallstacks(self, callStacks):
@@ -140,36 +175,155 @@ class VmkstatsFlames:
     def putTraceForModule(self, module, traceid, samplecount):
         """
         Function for putting the parsed values from samples file
-        and the callstack trace for a specific module into a per
-        module data-structure.
+        for a specific module into a per module data-structure.
 
         :param module: name of the module
         :param traceid: callstack trace id
         :param samplecount: number of samples for this record
         """
-        self.traceCount[module][traceid] = self.traceCount[module].get(
-            traceid, 0
-        ) + int(samplecount)
-        if self.idmax[module] < int(traceid):
-            self.idmax[module] = int(traceid)
-        try:
-            self.traceAddrs[module][traceid] = self.stackDict[traceid]
-        except KeyError:
-            pass
+        counts = self.traceCount[module]
+        counts[traceid] = counts.get(traceid, 0) + samplecount
 
-    def processStats(self):
+    def loadSamples(self, samples):
+        """
+        samples file format:         k:42001950c264 907 0 2 9 0 2102771 0
+        This function adds up the sample count (4th field) of every callstack
+        trace id (2nd field) for all worlds, and for the module of the world
+        id (7th field) if any. It also adds it up per world for the sampled
+        address (1st field) and trace id, see worldStacks. Lines are consumed
+        one at a time.
         """
-        Main driver function for this class.
-        This function accomplishes the following:
 
-        Reads in the three files samples, callStacks, symbolTable.k and loads the latter two into
-        various dictionaries. It then goes over each sample and reconstructs the stacktrace based
-        on resolving the addresses in the callstackID to symbols.
+        # regex compile pattern for samples in a plain vmkstats collection of kernel
+        k = re.compile(
+            r"k:([\dabcdef]{1,}) (\d{1,}) (\d{1,}) (\d{1,}) (\d{1,}) (\d{1,}) (\d{1,}) (\d{1,})"
+        )
+
+        worldModules = self.worldModules
+        allCounts = self.traceCount["allWorlds"]
+        sampleKeys = self.sampleKeys
+        sampleKeyIndex = {}
+        worldSamples = defaultdict(dict)
+        for sample in samples:
+            ms = k.match(sample)
+            if not ms:
+                continue
+            traceid, samplecount, worldid = ms.group(2, 4, 7)
+            traceid = int(traceid)
+            samplecount = int(samplecount)
+
+            # Adding this record to allWorlds.
+            # Will add "allWorlds" as a dummy entry to self.vsanworlds later
+            allCounts[traceid] = allCounts.get(traceid, 0) + samplecount
+
+            module = worldModules.get(int(worldid))
+            if module is not None:
+                self.putTraceForModule(module, traceid, samplecount)
+
+            # Adding it to the world, keyed by sampled address and trace id
+            sample = sample[: ms.end(2)]
+            sampleKey = sampleKeyIndex.get(sample)
+            if sampleKey is None:
+                sampleKey = sampleKeyIndex[sample] = len(sampleKeys)
+                sampleKeys.append(sample)
+            counts = worldSamples[worldid]
+            counts[sampleKey] = counts.get(sampleKey, 0) + samplecount
+
+        for worldid, counts in worldSamples.items():
+            self.worldSamples[int(worldid)] = counts
 
-        It then creates file cpuFlame.fl which can then be used as input to flamegraph.pl to
-        generate a flamegraph in svg format.
+    def resolveTrace(self, traceid):
         """
-        self.samples = readLines(os.path.join(self.vmkstatsDir, self.SAMPLES))
+        Return the stack trace of a callstack trace id as symbols separated
+        by ';', outermost first, or "" if it is unknown or has a single
+        frame.
+        """
+        stackTrace = self.resolvedTraces.get(traceid)
+        if stackTrace is not None:
+            return stackTrace
+
+        # We now process the traces that looks like this at this stage:
+        # k:420019758c22;k:4200194bc3a9;k:42001975dd15 1
+        #
+        # The trace is now reversed and is in in kernel addresses
+        # Reverse the trace after splitting the addresses
+        #
+        # Remove the k: part of the address and resolve the addresses into
+        # symbols
+        addrs = self.stackDict.get(str(traceid), "").split()
+        resolvedTrace = [
+            self.findSymbol(a.replace("k:", "")) for a in reversed(addrs)
+        ]
+
+        # Do not use samples with count = 1
+        if len(resolvedTrace) <= 1:
+            stackTrace = ""
+        else:
+            stackTrace = ";".join(resolvedTrace)
+        self.resolvedTraces[traceid] = stackTrace
+        return stackTrace
+
+    def sampleFrames(self, sampleKey):
+        """
+        Return the functions of the stack of a sample key, outermost first,
+        as a tuple: the ones of its callstack trace followed by the sampled
+        one.
+        """
+        addr, traceid = self.sampleKeys[sampleKey].split()
+        frames = self.traceFrames.get(traceid)
+        if frames is None:
+            addrs = self.stackDict.get(traceid, "").split()
+            frames = self.traceFrames[traceid] = tuple(
+                self.findSymbol(a.replace("k:", "")) for a in reversed(addrs)
+            )
+        return frames + (self.findSymbol(addr.replace("k:", "")),)
+
+    def worldStacks(self, worldids=None):
+        """
+        Return the stacks sampled in a set of worlds, as a list of
+        (functions outermost first, sample count), in the order they were
+        first seen.
+
+        :param worldids: world ids, None for all the worlds
+        """
+        if worldids is None:
+            worldids = list(self.worldSamples)
+        counts = defaultdict(int)
+        for worldid in worldids:
+            for sampleKey, count in self.worldSamples.get(worldid, {}).items():
+                counts[sampleKey] += count
+        return [
+            (self.sampleFrames(sampleKey), counts[sampleKey])
+            for sampleKey in sorted(counts)
+        ]
+
+    def moduleStacks(self, module):
+        """
+        Return the stack traces sampled in the worlds of a module, or in all
+        the worlds for "allWorlds", as a list of (symbols outermost first
+        separated by ';', sample count) ordered by trace id. Traces with a
+        single frame are left out.
+        """
+        stacks = []
+        counts = self.traceCount.get(module, {})
+        for traceid in sorted(counts):
+            count = counts[traceid]
+            if count == 0:
+                continue
+            stackTrace = self.resolveTrace(traceid)
+            if stackTrace:
+                stacks.append((stackTrace, count))
+        return stacks
+
+    def load(self):
+        """
+        Loads the two files callStacks, symbolTable.k into various
+        dictionaries, and streams the samples file to add up the samples
+        of each callstack trace id per module.
+
+        Returns False if one of the files is missing or empty.
+        """
+        samplesFile = os.path.join(self.vmkstatsDir, self.SAMPLES)
         self.callStacks = readLines(
             os.path.join(self.vmkstatsDir, self.CALLSTACKS)
         )
@@ -177,7 +331,7 @@ class VmkstatsFlames:
             os.path.join(self.vmkstatsDir, self.SYMBOLTABLE)
         )
         if (
-            (not self.samples)
+            (not hasData(samplesFile))
             or (not self.callStacks)
             or (not self.symbolTable)
         ):
@@ -186,89 +340,44 @@ class VmkstatsFlames:
                 "One or more of the files: samples, callStacks, symbolTable.k"
                 "are not present in specified directory"
             )
-            return
+            return False
 
         # Load call stack trace addresses and symbol table into local
         # dictionaries
 
         self.loadSymbols(self.symbolTable)
-        sortedSym = sortDict(self.symAddrDict)
         self.loadCallstacks(self.callStacks)
 
-        # Read each sample and resolve to get stacktrace
-        # Write stacktrace and count to file cpuFlame.fl
-
-        # regex compile pattern for samples in a plain vmkstats collection of kernel
-        # Example: k:42001950c264 907 0 2 9 0 2102771 0
-
-        k = re.compile(
-            r"k:([\dabcdef]{1,}) (\d{1,}) (\d{1,}) (\d{1,}) (\d{1,}) (\d{1,}) (\d{1,}) (\d{1,})"
-        )
-
-        for sample in self.samples:
-            ms = k.match(sample)
-            if ms:
-                traceid = ms.group(2)
-                samplecount = ms.group(4)
-                worldid = int(ms.group(7))
+        # Read each sample and add it up per trace id
+        with open(samplesFile) as samples:
+            self.loadSamples(samples)
+        # Adding dummy entry for allWorlds
+        self.vsanworlds["allWorlds"] = []
+        return True
 
-                # Adding this record to allWorlds.
-                # Will add "allWorlds" as a dummy entry to self.vsanworlds later
-                self.putTraceForModule("allWorlds", traceid, samplecount)
+    def processStats(self):
+        """
+        Main driver function for this class.
+        This function accomplishes the following:
 
-                for module in self.vsanworlds:
-                    if worldid in self.vsanworlds[module]:
-                        break
-                else:
-                    continue
+        Loads the vmkstats output, see load. It then reconstructs the
+        stacktrace of each sampled trace id by resolving its addresses
+        to symbols.
 
-                self.putTraceForModule(module, traceid, samplecount)
+        It then creates a file <module>.fl per module which can then be used
+        as input to flamegraph.pl to generate a flamegraph in svg format.
+        """
+        if not self.load():
+            return
 
+        # Write stacktrace and count of the sampled trace ids to the
+        # files <module>.fl
         outputFiles = []
-        # Adding dummy entry for allWorlds
-        self.vsanworlds["allWorlds"] = []
         for module in self.vsanworlds:
             outputFile = os.path.join(self.vmkstatsDir, module + ".fl")
             outputFiles.append(outputFile)
             with open(outputFile, "w") as fh:
-                # We now process the traces that looks like this at this stage:
-                # k:420019758c22;k:4200194bc3a9;k:42001975dd15 1
-                #
-                # The trace is now reversed and is in in kernel addresses
-                # Reverse the trace after splitting the addresses at ';' and store it in reverseTrace
-                #
-                # Remove the k: part of the address and store it in noKTrace
-                #
-                # Resolve the addresses into symbols and store the trace in resolvedTrace
-                #
-                for i in range(self.idmax[module]):
-                    count = self.traceCount[module].get(str(i), 0)
-                    if count == 0:
-                        continue
-
-                    try:
-                        addrs = self.traceAddrs[module][str(i)]
-                        reverseTrace = ";".join(reversed(addrs.split()))
-                        if not reverseTrace:
-                            continue
-                    except KeyError:
-                        continue
-
-                    # Remove 'k:' and 'u:userworldID' from the address strings
-                    noKTrace = reverseTrace.replace("k:", "")
-
-                    # Resolve to symbol and create the stacktrace list
-                    resolvedTrace = [
-                        self.findSymbol(i, sortedSym)
-                        for i in noKTrace.split(";")
-                    ]
-
-                    # Do not use samples with count = 1
-                    if len(resolvedTrace) == 1:
-                        continue
-
-                    # create stacktrace
-                    stackTrace = ";".join(resolvedTrace)
+                for stackTrace, count in self.moduleStacks(module):
                     fh.write(stackTrace + " " + str(count) + "\n")
 
         return outputFiles
@@ -4,6 +4,7 @@ import logging
 import optparse
 import os
 import re
+import shutil
 import time
 from collections import defaultdict
 from logging.handlers import WatchedFileHandler
@@ -16,6 +17,9 @@ _LOG_FILE = "/tmp/vmkstats.log"
 
 _VMKSTATSDUMPER_CMD = "/usr/lib/vmware/vmkstats/bin/vmkstatsdumper"
 
+_DUMP_DIR = "hcibench_vmkstats_dumpDir"
+_SLICES_FILE = "slices.json"
+
 _WORLD_REGEX_MAP = {
     # LSOM Worlds
     "LSOMLLOG": r"^VSAN_(.*)_LSOMLLOG$",
@@ -121,10 +125,14 @@ class Vmkstats(object):
 
     def collect_stats(self, suffix="00:00:00"):
         """Collects stats"""
-        output_dir = self._output + "/hcibench_vmkstats_dumpDir" #self._output + "/sub-vmkstats-%s" % suffix
+        output_dir = self._output + "/" + _DUMP_DIR #self._output + "/sub-vmkstats-%s" % suffix
         cmd = "mkdir -p %s" % output_dir
         os.system(cmd)
         time.sleep(self._duration)
+        self.dump_stats(output_dir)
+
+    def dump_stats(self, output_dir):
+        """Stop the collection and dump the stats to output_dir"""
         vsi.set("/perf/vmkstats/command/stop", 1)
         vsi.set("/perf/vmkstats/command/drain", 1)
         time.sleep(1)
@@ -135,10 +143,61 @@ class Vmkstats(object):
         cmd = "%s -a -o %s" % (_VMKSTATSDUMPER_CMD, output_dir)
         os.system(cmd)
 
-    def collect_additional_stats(self, suffix="00:00:00"):
+    def collect_slices(self, slice_duration, max_slices=0):
+        """
+        Collect stats in slices of slice_duration secs for the duration
+
+        Every slice is dumped, with its world ids, to its own directory
+        slice-NNNN of the dump directory, so the per-cpu sample buffers
+        never hold more than one slice. The slices are listed, with the
+        times they started and stopped at, in slices.json, rewritten after
+        each slice so that an interrupted collection can still be
+        processed.
+
+        :param slice_duration: secs of every slice
+        :param max_slices: number of the most recent slices to keep on the
+                           host, all of them if 0
+        """
+        output_dir = self._output + "/" + _DUMP_DIR
+        cmd = "mkdir -p %s" % output_dir
+        os.system(cmd)
+        slices = []
+        end = time.time() + self._duration
+        index = 0
+        while time.time() < end:
+            slice_name = "slice-%04d" % index
+            slice_dir = os.path.join(output_dir, slice_name)
+            cmd = "mkdir -p %s" % slice_dir
+            os.system(cmd)
+            self.enable_vmkstats()
+            start = time.time()
+            time.sleep(max(0, min(slice_duration, end - start)))
+            stop = time.time()
+            self.dump_stats(slice_dir)
+            self.collect_additional_stats(output_dir=slice_dir)
+            Logger.info("Collected %s", slice_dir)
+            slices.append(
+                {
+                    "slice": index,
+                    "dir": slice_name,
+                    "start": round(start, 3),
+                    "end": round(stop, 3),
+                }
+            )
+            if max_slices and len(slices) > max_slices:
+                oldest = slices.pop(0)
+                shutil.rmtree(
+                    os.path.join(output_dir, oldest["dir"]), ignore_errors=True
+                )
+            with open(os.path.join(output_dir, _SLICES_FILE), "w") as fh:
+                fh.write(json.dumps(slices, indent=2))
+            index += 1
+
+    def collect_additional_stats(self, suffix="00:00:00", output_dir=None):
         """Collect additional stats"""
         # 1. Collect all the world ids
-        output_dir = self._output + "/hcibench_vmkstats_dumpDir" #self._output + "/sub-vmkstats-%s" % suffix
+        if output_dir is None:
+            output_dir = self._output + "/" + _DUMP_DIR #self._output + "/sub-vmkstats-%s" % suffix
         cmd = "ps -c > %s" % (os.path.join(output_dir, "worlds.txt"))
         os.system(cmd)
 
@@ -216,6 +275,24 @@ def main():
         help=" number of seconds to wait to collect vmkstats",
     )
 
+    opt.add_option(
+        "--slice",
+        "-s",
+        type="int",
+        action="store",
+        default=0,
+        help=" collect vmkstats in slices of this many seconds for the"
+        " whole duration instead of iterations",
+    )
+
+    opt.add_option(
+        "--max-slices",
+        type="int",
+        action="store",
+        default=0,
+        help=" number of the most recent slices to keep, all if 0",
+    )
+
     opts, _ = opt.parse_args()
 
     # Initialize logger
@@ -230,6 +307,13 @@ def main():
     if opts.vdfs:
         stats_obj.update_vdfs_pids()
 
+    if opts.slice > 0:
+        # Slices are drained as they go, so the duration is not capped
+        if opts.delay > 0:
+            time.sleep(opts.delay)
+        stats_obj.collect_slices(opts.slice, opts.max_slices)
+        return
+
     if opts.duration > 60:
         opts.duration = 60
 
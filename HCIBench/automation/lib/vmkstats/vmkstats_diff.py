@@ -0,0 +1,235 @@
+"""
+VMKstats Diff
+
+Compares two vmkstats output directories, e.g. of the same benchmark run
+before and after a vSAN build or a policy change, module by module of
+vsanworlds.json and for all the worlds.
+
+For every module it writes:
+<module>_diff.svg: differential flame graph of the samples of the worlds of
+                   the module. Frames are as wide as in the second run and
+                   colored by the change of the samples ending in them, red
+                   for more and blue for fewer, the first run being scaled
+                   to the sample count of the second one.
+<module>_diff.txt: functions whose share of the samples of the module moved
+                   the most, as the function sampled (self) or anywhere in
+                   the stack (total).
+
+The world ids of a module are read from the vsanworlds.json of each run.
+
+Syntax:
+<PATH>/vmkstats_diff.py --before <vmkstats dir> --after <vmkstats dir>
+                        -o <output dir> [--top N]
+"""
+import argparse
+import os
+import traceback
+from collections import defaultdict
+
+from flamegraph import FlameGraph
+from vmkflames import VmkstatsFlames
+
+ALL_WORLDS = "allWorlds"
+TOP_FUNCTIONS = 30
+
+
+class VmkstatsRun(object):
+    """Samples of one vmkstats output directory"""
+
+    def __init__(self, vmkstatsDir):
+        self.vmkstatsDir = vmkstatsDir
+        self._flames = VmkstatsFlames(
+            vmkstatsDir, os.path.join(vmkstatsDir, "vsanworlds.json")
+        )
+
+    def load(self):
+        """Load the vmkstats output, returns False if it is missing"""
+        return self._flames.load()
+
+    @property
+    def modules(self):
+        """Modules of vsanworlds.json and "allWorlds" """
+        return list(self._flames.vsanworlds)
+
+    def moduleStacks(self, module):
+        """
+        Return the sample count of every stack sampled in the worlds of a
+        module, or in all the worlds for "allWorlds"
+
+        :param module: module of vsanworlds.json or "allWorlds"
+        :return: dict of {functions outermost first separated by ';',
+                 sample count}
+        """
+        worldids = None
+        if module != ALL_WORLDS:
+            worldids = [
+                int(x) for x in self._flames.vsanworlds.get(module, [])
+            ]
+            if not worldids:
+                return {}
+        stacks = defaultdict(int)
+        for frames, count in self._flames.worldStacks(worldids):
+            stacks[";".join(frames)] += count
+        return stacks
+
+
+def functionCounts(stacks):
+    """
+    Return the samples of every function of stacks
+
+    :param stacks: dict of {stack, sample count}, see moduleStacks
+    :return: dict of {function, [self count, total count]}, where self
+             counts the samples of the function and total the samples of
+             the stacks it is in
+    """
+    counts = defaultdict(lambda: [0, 0])
+    for stack, count in stacks.items():
+        frames = stack.split(";")
+        counts[frames[-1]][0] += count
+        for name in set(frames):
+            counts[name][1] += count
+    return counts
+
+
+def writeDiffGraph(module, before, after, outputFile):
+    """
+    Write the differential flame graph of two sets of stacks
+
+    The counts before are scaled to the total count after.
+
+    :param module: module name, for the title
+    :param before: dict of {stack, sample count} of the first run
+    :param after: dict of {stack, sample count} of the second run
+    :param outputFile: SVG file to write
+    """
+    totalBefore = sum(before.values())
+    totalAfter = sum(after.values())
+    scale = float(totalAfter) / totalBefore if totalBefore else 0.0
+    graph = FlameGraph(title="Differential Flame Graph: %s" % module)
+    for stack in set(before) | set(after):
+        graph.addStack(
+            stack,
+            after.get(stack, 0),
+            int(round(before.get(stack, 0) * scale)),
+        )
+    print("Writing %s" % outputFile)
+    graph.write(outputFile)
+
+
+def writeDiffReport(module, before, after, outputFile, top=TOP_FUNCTIONS):
+    """
+    Write the functions whose share of the samples changed the most
+    between two sets of stacks, by the larger change of their self and
+    total percent
+
+    :param module: module name, for the title
+    :param before: dict of {stack, sample count} of the first run
+    :param after: dict of {stack, sample count} of the second run
+    :param outputFile: text file to write
+    :param top: number of functions to write
+    """
+    totalBefore = sum(before.values())
+    totalAfter = sum(after.values())
+    countsBefore = functionCounts(before)
+    countsAfter = functionCounts(after)
+
+    def pct(count, total):
+        return count * 100.0 / total if total else 0.0
+
+    rows = []
+    for name in set(countsBefore) | set(countsAfter):
+        selfBefore, totBefore = countsBefore.get(name, (0, 0))
+        selfAfter, totAfter = countsAfter.get(name, (0, 0))
+        selfBefore = pct(selfBefore, totalBefore)
+        selfAfter = pct(selfAfter, totalAfter)
+        totBefore = pct(totBefore, totalBefore)
+        totAfter = pct(totAfter, totalAfter)
+        rows.append(
+            (
+                selfAfter - selfBefore,
+                totAfter - totBefore,
+                name,
+                selfBefore,
+                selfAfter,
+                totBefore,
+                totAfter,
+            )
+        )
+    rows.sort(key=lambda row: (-max(abs(row[0]), abs(row[1])), row[2]))
+
+    print("Writing %s" % outputFile)
+    with open(outputFile, "w") as fh:
+        fh.write(
+            "%s: %d samples before, %d samples after\n"
+            % (module, totalBefore, totalAfter)
+        )
+        fh.write(
+            "%8s %8s %8s %8s %8s %8s  %s\n"
+            % ("self1%", "self2%", "delta", "total1%", "total2%", "delta",
+               "function")
+        )
+        for row in rows[:top]:
+            selfDelta, totDelta, name = row[:3]
+            selfBefore, selfAfter, totBefore, totAfter = row[3:]
+            fh.write(
+                "%8.2f %8.2f %+8.2f %8.2f %8.2f %+8.2f  %s\n"
+                % (selfBefore, selfAfter, selfDelta, totBefore, totAfter,
+                   totDelta, name)
+            )
+
+
+def main():
+    """Main function"""
+    args = argparse.ArgumentParser()
+    args.add_argument(
+        "--before",
+        action="store",
+        required=True,
+        help="vmkstats output directory of the first run",
+    )
+    args.add_argument(
+        "--after",
+        action="store",
+        required=True,
+        help="vmkstats output directory of the second run",
+    )
+    args.add_argument(
+        "--outputdir", "-o", action="store", required=True,
+        help="output directory",
+    )
+    args.add_argument(
+        "--top",
+        action="store",
+        type=int,
+        default=TOP_FUNCTIONS,
+        help="number of functions of the reports",
+    )
+    opts = args.parse_args()
+
+    runs = [VmkstatsRun(opts.before), VmkstatsRun(opts.after)]
+    for run in runs:
+        if not run.load():
+            print("No vmkstats output in %s" % run.vmkstatsDir)
+            return
+    if not os.path.isdir(opts.outputdir):
+        os.makedirs(opts.outputdir)
+
+    modules = runs[0].modules
+    modules += [mod for mod in runs[1].modules if mod not in modules]
+    for mod in modules:
+        try:
+            before = runs[0].moduleStacks(mod)
+            after = runs[1].moduleStacks(mod)
+            if not before and not after:
+                continue
+            prefix = os.path.join(opts.outputdir, mod + "_diff")
+            writeDiffGraph(mod, before, after, prefix + ".svg")
+            writeDiffReport(mod, before, after, prefix + ".txt", opts.top)
+        except Exception:
+            print("Comparing %s failed!" % mod)
+            traceback.print_exc()
+            # Continue with the other modules
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,70 @@
-"""VMKstats Parser"""
+"""
+VMKstats Parser
+
+Loads a vmkstats output directory once and writes from it the caller and
+callee trees of all the worlds and of every module of vsanworlds.json, the
+way vmcallstackview.jar prints them, and the flame graphs of the modules.
+The reports of the modules are written by worker processes forked after the
+load, so they share the parsed samples.
+
+The output of a time sliced collection (see vmkstats.py --slice) gets the
+timelines of vmkstats_timeline.py, and every slice, a vmkstats output
+directory of its own, gets the trees and flame graphs in its directory.
+"""
 import argparse
 import json
+import multiprocessing
 import os
-import subprocess
 import re
+import traceback
 
+from callstacktree import MAX_DEPTH, buildTree, reroot
+from flamegraph import FlameGraph
 from vmkflames import VmkstatsFlames
+from vmkstats_timeline import SLICES_FILE, readSlices, writeTimeline
 
-_JAVA = "java"
 _ROOT_MAP = {
     "LSOMLLOG": "VSANServerMainLoop",
     "PLOG": "VSANServerMainLoop",
 }
-_FLAMEGRAPH_PL = "flamegraph.pl"
+_FL_DIR = "flFiles"
+
+# Parser of the worker processes, see VmkstatsParser.run
+_workerParser = None
+
+
+def _initWorker(parser):
+    global _workerParser
+    _workerParser = parser
+
+
+def _runJob(job):
+    _workerParser.runJob(job)
+
+
+def removeEmptyFiles(directory):
+    """Delete the empty files under directory"""
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if not os.path.islink(path) and os.path.getsize(path) == 0:
+                os.remove(path)
 
 
 class VmkstatsParser(object):
     """VMKstats output parser"""
 
-    def __init__(self, outputDir, java, jar):
+    def __init__(self, outputDir, vsanworldsfile):
         """Initialize the vmkstats parser object"""
         self._odir = outputDir
-        self._java = java
-        self._jar = jar
-        self._parse_cmd = " ".join(
-            [self._java, "-jar", self._jar, "--text", "-tag", "k"]
-        )
-        self._flamegraph_cmd = " "
-        os.chdir(self._odir)
+        self._flames = VmkstatsFlames(outputDir, vsanworldsfile)
+        # Key and root of the last tree built, with the total sample count
+        # of its worlds, see parse
+        self._tree = (None, None, 0)
+
+    def load(self):
+        """Load the vmkstats output, returns False if it is missing"""
+        return self._flames.load()
 
     def updateOdir(self, odir):
         """Update the output dir"""
@@ -42,46 +79,69 @@ class VmkstatsParser(object):
         maxDepth=None,
         percent=False,
     ):
-        """Parse the vmkstats"""
-        cmd = self._parse_cmd
-        oFileName = ctx
-        if rootAt:
-            cmd += " --rootAt %s" % (rootAt)
+        """
+        Write the caller or callee tree of the samples of some worlds
+
+        Consecutive calls for the same tree, e.g. in samples and in percent,
+        build it once.
 
+        :param ctx: prefix of the report file name
+        :param rootAt: function to root the tree at
+        :param cpuids: world ids, all the worlds if None
+        :param caller: write the caller tree, else the callee tree
+        :param maxDepth: number of levels of the tree printed
+        :param percent: write percents of the samples instead of counts
+        """
+        oFileName = ctx
         if caller:
-            cmd += " --caller"
             oFileName += "_caller"
         else:
-            cmd += " --callee"
             oFileName += "_callee"
 
         if maxDepth:
-            cmd += " --maxdepth %d" % (maxDepth)
             oFileName += "_depth%d" % (maxDepth)
+        else:
+            maxDepth = MAX_DEPTH
 
         if percent:
             oFileName += "_percent"
-        else:
-            cmd += " --samples"
 
-        if cpuids:
-            cmd += " --world %s" % (",".join(cpuids))
         oFileName = oFileName.lstrip("_")
         oFileName += ".txt"
-        eFileName = oFileName + ".err"
         oFilePath = os.path.join(self._odir, oFileName)
-        eFilePath = os.path.join(self._odir, eFileName)
-        #print(cmd)
-        openf = open(oFilePath, "w")
-        opene = open(eFilePath, "w")
         try:
-            subprocess.call(cmd, stdout=openf, stderr=opene, cwd=self._odir, shell=True)
-            #Execute(cmd, wait=True, cwd=self._odir, ofName=oFilePath)
+            key = (tuple(cpuids or ()), rootAt, caller)
+            if self._tree[0] != key:
+                self._tree = (None, None, 0)
+                worldids = None
+                filters = ""
+                if cpuids:
+                    worldids = [int(x) for x in cpuids]
+                    filters = "World:" + ", ".join(str(x) for x in cpuids)
+                title = "%s Root [%s]" % (
+                    "Caller" if caller else "Callee",
+                    filters,
+                )
+                tree = buildTree(
+                    title,
+                    self._flames.worldStacks(worldids),
+                    caller,
+                )
+                total = tree.totalCount
+                if rootAt:
+                    tree = reroot(tree, rootAt)
+                self._tree = (key, tree, total)
+            _, tree, total = self._tree
+            if tree is None:
+                print("%s: no samples in %s" % (oFileName, rootAt))
+                return
+            with open(oFilePath, "w") as fh:
+                tree.write(fh, total, percent, maxDepth)
             self.demangle_funcnames(oFilePath)
-        except:
-            print(cmd + " Falied!")
+        except Exception:
+            print("Generating %s failed!" % oFileName)
+            traceback.print_exc()
             # Continue even if processing for one of the layers fails
-            pass
 
     @staticmethod
     def demangle_funcnames(filepath):
@@ -122,33 +182,127 @@ class VmkstatsParser(object):
             with open(filepath, "w") as fh:
                 fh.write("\n".join(processed_file))
 
-    def generateFlamegraph(self, vsanworldsfile, scriptDir):
+    def generateFlamegraph(self, module):
         """
-        Generate flamegraphs for the ctx with cpuids
+        Write the flame graph of the samples of a module, or of all the
+        worlds for "allWorlds", to <module>.svg and its stacks to
+        flFiles/<module>.fl
 
-        :param vsanworldsfile: vsanworlds.json file
-        :param scriptDir: Perfcloud directory
+        :param module: module of vsanworlds.json or "allWorlds"
         """
-        flamesObj = VmkstatsFlames(self._odir, vsanworldsfile)
-        outputFiles = flamesObj.processStats()
-        os.mkdir(os.path.join(self._odir, "flFiles"))
-        for outputFile in outputFiles:
-            if os.stat(outputFile).st_size:
-                outputSVG = outputFile.replace(".fl", ".svg")
-                cmd = "%s --minwidth 0 %s" % (
-                    os.path.join(scriptDir, _FLAMEGRAPH_PL),
-                    outputFile,
-                )
-                print(cmd)
-                f = open(outputSVG, "w")
-                subprocess.call(cmd, stdout=f, shell=True)
-                #Execute(cmd, wait=True, ofName=outputSVG)
-                cmd = "mv %s %s" % (
-                    outputFile,
-                    os.path.join(self._odir, "flFiles"),
-                )
-                subprocess.call(cmd,shell=True)
-                #Execute(cmd, wait=True)
+        stacks = self._flames.moduleStacks(module)
+        if not stacks:
+            return
+        outputFile = os.path.join(self._odir, _FL_DIR, module + ".fl")
+        graph = FlameGraph(minWidth=0)
+        with open(outputFile, "w") as fh:
+            for stackTrace, count in stacks:
+                fh.write(stackTrace + " " + str(count) + "\n")
+                graph.addStack(stackTrace, count)
+        outputSVG = os.path.join(self._odir, module + ".svg")
+        print("Writing %s" % outputSVG)
+        graph.write(outputSVG)
+
+    def runJob(self, job):
+        """
+        Run a job, a list of (method name, keyword arguments) of the
+        parser
+        """
+        for method, kwargs in job:
+            try:
+                getattr(self, method)(**kwargs)
+            except Exception:
+                print("%s(%s) failed!" % (method, kwargs))
+                traceback.print_exc()
+
+    def run(self, jobs, numProcesses=None):
+        """
+        Run jobs, see runJob, in worker processes forked from this one.
+        They run here one after the other if processes cannot be forked.
+
+        :param jobs: list of jobs
+        :param numProcesses: number of worker processes, the number of
+                             CPUs by default
+        """
+        numProcesses = min(
+            numProcesses or multiprocessing.cpu_count(), len(jobs)
+        )
+        try:
+            # Forked workers share the loaded vmkstats with this process
+            context = multiprocessing.get_context("fork")
+        except ValueError:
+            numProcesses = 1
+        if numProcesses <= 1:
+            for job in jobs:
+                self.runJob(job)
+            return
+        pool = context.Pool(numProcesses, _initWorker, (self,))
+        try:
+            for _ in pool.imap_unordered(_runJob, jobs):
+                pass
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+
+def writeReports(outputDir, flamegraph=False, numProcesses=None):
+    """
+    Write the caller and callee trees, and the flame graphs if asked for,
+    of a vmkstats output directory to it
+
+    :param outputDir: vmkstats output directory
+    :param flamegraph: also write the flame graphs of the modules
+    :param numProcesses: number of worker processes, the number of CPUs
+                         by default
+    """
+    vsanworldsfile = os.path.join(outputDir, "vsanworlds.json")
+    parser = VmkstatsParser(outputDir, vsanworldsfile)
+    if not parser.load():
+        return
+
+    # Generate global caller/callee files
+    jobs = [
+        [
+            ("parse", dict(ctx="")),
+            ("parse", dict(ctx="", percent=True)),
+        ],
+        [
+            ("parse", dict(ctx="", caller=False)),
+            ("parse", dict(ctx="", caller=False, percent=True)),
+        ],
+        [("parse", dict(ctx="", caller=False, maxDepth=1))],
+    ]
+
+    # Module wise parsing, larger modules first
+    modWorlds = json.load(open(vsanworldsfile))
+    for mod in sorted(modWorlds, key=lambda k: -len(modWorlds[k])):
+        root = _ROOT_MAP.get(mod)
+        job = [
+            ("parse", dict(ctx=mod, rootAt=root, cpuids=modWorlds[mod])),
+            (
+                "parse",
+                dict(
+                    ctx=mod, rootAt=root, cpuids=modWorlds[mod], percent=True
+                ),
+            ),
+        ]
+        if flamegraph:
+            job.append(("generateFlamegraph", dict(module=mod)))
+        jobs.append(job)
+
+    if flamegraph:
+        flDir = os.path.join(outputDir, _FL_DIR)
+        if not os.path.isdir(flDir):
+            os.mkdir(flDir)
+        jobs.insert(0, [("generateFlamegraph", dict(module="allWorlds"))])
+
+    parser.run(jobs, numProcesses)
+
+    # Delete zero size files
+    removeEmptyFiles(outputDir)
 
 
 def main():
@@ -157,47 +311,31 @@ def main():
     args.add_argument(
         "--outputdir", "-o", action="store", help="vmkstats output directory"
     )
-    args.add_argument(
-        "--scriptdir",
-        action="store",
-        default=None,
-        help="perfcloud directory path",
-    )
     args.add_argument(
         "--flamegraph", action="store_true", help="Generate flamegraphs",
     )
     args.add_argument(
-        "--java", action="store", default=_JAVA, help="java path"
-    )
-    args.add_argument(
-        "--jar", action="store", help="vmcallstackview.jar file path"
+        "--processes",
+        action="store",
+        type=int,
+        default=None,
+        help="number of worker processes, the number of CPUs by default",
     )
+    # No longer used, the reports and flamegraphs are generated in process
+    for option in ("--scriptdir", "--java", "--jar"):
+        args.add_argument(option, action="store", help=argparse.SUPPRESS)
     opts = args.parse_args()
 
-    parser = VmkstatsParser(opts.outputdir, opts.java, opts.jar)
-
-    # Generate global caller/callee files
-    parser.parse(ctx="")
-    parser.parse(ctx="", percent=True)
-    parser.parse(ctx="", caller=False)
-    parser.parse(ctx="", caller=False, percent=True)
-    parser.parse(ctx="", caller=False, maxDepth=1)
-
-    # Module wise parsing
-    vsanworldsfile = os.path.join(opts.outputdir, "vsanworlds.json")
-    modWorlds = json.load(open(vsanworldsfile))
-    for mod in sorted(modWorlds, key=lambda k: len(modWorlds[k])):
-        root = _ROOT_MAP.get(mod)
-        parser.parse(mod, rootAt=root, cpuids=modWorlds[mod])
-        parser.parse(mod, rootAt=root, cpuids=modWorlds[mod], percent=True)
-
-    if opts.scriptdir and opts.flamegraph:
-        parser.generateFlamegraph(vsanworldsfile, opts.scriptdir)
-
-    # Delete zero size files
-    cmd = "find %s -type f -empty -delete" % (opts.outputdir)
-    subprocess.call(cmd,shell=True)
-    #Execute(cmd, wait=True)
+    if os.path.exists(os.path.join(opts.outputdir, SLICES_FILE)):
+        writeTimeline(opts.outputdir, opts.processes)
+        outputDirs = [
+            os.path.join(opts.outputdir, entry["dir"])
+            for entry in readSlices(opts.outputdir)
+        ]
+    else:
+        outputDirs = [opts.outputdir]
+    for outputDir in outputDirs:
+        writeReports(outputDir, opts.flamegraph, opts.processes)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,223 @@
+"""
+VMKstats Timeline
+
+Builds the timeline of the functions sampled the most in every module of
+vsanworlds.json, and in all the worlds, from a time sliced vmkstats
+collection (see vmkstats.py --slice). Every slice is a vmkstats output
+directory of its own, listed in slices.json with the times it was collected
+between, so the timeline lines up with the fio/vdbench intervals of the run.
+
+For every module it writes timeline/<module>.csv, with a row per slice of:
+slice: index of the slice
+start, end: epoch secs the slice was collected between
+offset: secs from the start of the first slice
+samples: samples of the worlds of the module in the slice
+and a column per function in the top N of the module in any slice, with its
+percent of the samples of the module in every slice.
+
+Syntax:
+<PATH>/vmkstats_timeline.py -o <vmkstats dump dir> [--top N]
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import traceback
+from collections import defaultdict
+
+from vmkflames import VmkstatsFlames
+
+SLICES_FILE = "slices.json"
+TOP_FUNCTIONS = 10
+_TIMELINE_DIR = "timeline"
+
+
+def sliceProfile(sliceDir):
+    """
+    Return the samples of every function sampled in every module of a
+    slice, the functions being the ones the samples hit
+
+    :param sliceDir: vmkstats output directory of the slice
+    :return: dict of {module, dict of {function, sample count}}
+    """
+    profile = {}
+    try:
+        flames = VmkstatsFlames(
+            sliceDir, os.path.join(sliceDir, "vsanworlds.json")
+        )
+        if not flames.load():
+            return profile
+        for module, worldids in flames.vsanworlds.items():
+            if module == "allWorlds":
+                worldids = None
+            elif not worldids:
+                continue
+            else:
+                worldids = [int(x) for x in worldids]
+            counts = defaultdict(int)
+            for frames, count in flames.worldStacks(worldids):
+                counts[frames[-1]] += count
+            profile[module] = dict(counts)
+    except Exception:
+        print("Processing %s failed!" % sliceDir)
+        traceback.print_exc()
+    return profile
+
+
+def sliceProfiles(sliceDirs, numProcesses=None):
+    """
+    Return the profiles of slices, see sliceProfile, in worker processes
+
+    :param sliceDirs: vmkstats output directories of the slices
+    :param numProcesses: number of worker processes, the number of CPUs
+                         by default
+    """
+    numProcesses = min(
+        numProcesses or multiprocessing.cpu_count(), len(sliceDirs)
+    )
+    if numProcesses <= 1:
+        return [sliceProfile(sliceDir) for sliceDir in sliceDirs]
+    pool = multiprocessing.Pool(numProcesses)
+    try:
+        profiles = pool.map(sliceProfile, sliceDirs)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return profiles
+
+
+def writeModuleTimeline(module, slices, profiles, outputFile, top):
+    """
+    Write the timeline of the top functions of a module
+
+    :param module: module of vsanworlds.json or "allWorlds"
+    :param slices: entries of slices.json
+    :param profiles: profiles of the slices, see sliceProfile
+    :param outputFile: CSV file to write
+    :param top: number of functions of every slice to add
+    """
+    counts = [profile.get(module, {}) for profile in profiles]
+    functions = set()
+    totals = defaultdict(int)
+    for sliceCounts in counts:
+        for name, count in sliceCounts.items():
+            totals[name] += count
+        functions.update(
+            sorted(sliceCounts, key=lambda name: -sliceCounts[name])[:top]
+        )
+    functions = sorted(functions, key=lambda name: (-totals[name], name))
+
+    print("Writing %s" % outputFile)
+    firstStart = slices[0]["start"]
+    with open(outputFile, "w") as fh:
+        writer = csv.writer(fh)
+        writer.writerow(
+            ["slice", "start", "end", "offset", "samples"] + functions
+        )
+        for entry, sliceCounts in zip(slices, counts):
+            samples = sum(sliceCounts.values())
+            row = [
+                entry["slice"],
+                entry["start"],
+                entry["end"],
+                "%.3f" % (entry["start"] - firstStart),
+                samples,
+            ]
+            for name in functions:
+                pct = 0.0
+                if samples:
+                    pct = sliceCounts.get(name, 0) * 100.0 / samples
+                row.append("%.2f" % pct)
+            writer.writerow(row)
+
+
+def readSlices(dumpDir):
+    """
+    Return the entries of slices.json of a time sliced vmkstats collection
+    whose directory exists, sorted by start time
+
+    :param dumpDir: directory of the slices and of slices.json
+    """
+    with open(os.path.join(dumpDir, SLICES_FILE)) as fh:
+        slices = json.load(fh)
+    return [
+        entry
+        for entry in sorted(slices, key=lambda entry: entry["start"])
+        if os.path.isdir(os.path.join(dumpDir, entry["dir"]))
+    ]
+
+
+def writeTimeline(dumpDir, numProcesses=None, top=TOP_FUNCTIONS):
+    """
+    Write the timelines of the modules of a time sliced vmkstats collection
+    to dumpDir/timeline
+
+    :param dumpDir: directory of the slices and of slices.json
+    :param numProcesses: number of worker processes, the number of CPUs
+                         by default
+    :param top: number of functions of every slice to add to the timelines
+    """
+    slices = readSlices(dumpDir)
+    if not slices:
+        print("No vmkstats slices in %s" % dumpDir)
+        return
+    profiles = sliceProfiles(
+        [os.path.join(dumpDir, entry["dir"]) for entry in slices],
+        numProcesses,
+    )
+
+    timelineDir = os.path.join(dumpDir, _TIMELINE_DIR)
+    if not os.path.isdir(timelineDir):
+        os.mkdir(timelineDir)
+    modules = []
+    for profile in profiles:
+        modules += [mod for mod in profile if mod not in modules]
+    for mod in modules:
+        try:
+            writeModuleTimeline(
+                mod,
+                slices,
+                profiles,
+                os.path.join(timelineDir, mod + ".csv"),
+                top,
+            )
+        except Exception:
+            print("Generating the timeline of %s failed!" % mod)
+            traceback.print_exc()
+            # Continue with the other modules
+
+
+def main():
+    """Main function"""
+    args = argparse.ArgumentParser()
+    args.add_argument(
+        "--outputdir",
+        "-o",
+        action="store",
+        required=True,
+        help="vmkstats dump directory of the slices",
+    )
+    args.add_argument(
+        "--top",
+        action="store",
+        type=int,
+        default=TOP_FUNCTIONS,
+        help="number of functions of every slice to add to the timelines",
+    )
+    args.add_argument(
+        "--processes",
+        action="store",
+        type=int,
+        default=None,
+        help="number of worker processes, the number of CPUs by default",
+    )
+    opts = args.parse_args()
+    writeTimeline(opts.outputdir, opts.processes, opts.top)
+
+
+if __name__ == "__main__":
+    main()